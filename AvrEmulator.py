@@ -0,0 +1,386 @@
+#----------------------------------------------------------------------------
+# Name:         AvrEmulator.py
+# Purpose:      An in-process emulator of the x0xb0x's AVR109 bootloader.
+#               AvrEmulator looks like a pyserial Serial object, so it
+#               can be handed to any of the functions in AvrProgram in
+#               place of a real serial port.  It emulates an ATmega162:
+#               flash and EEPROM, page size, fuses (which set the
+#               bootloader address) and signature.
+#
+#               The time that the serial link and the chip would take is
+#               added up on a virtual clock rather than waited for, so
+#               programming can be benchmarked quickly.  Errors can be
+#               injected to exercise the recovery paths of programFlash.
+#
+#               Run this file to benchmark AvrProgram against it:
+#
+#                   python AvrEmulator.py [FILE.hex]
+#----------------------------------------------------------------------------
+
+import random
+import time
+import serial
+from AvrProgram import ATMEGA162_FLASH_SIZE, ATMEGA162_EEPROM_SIZE, ATMEGA162_FLASHPAGE_SIZE
+
+BOOTLOADER_ID = 'AVRBOOT'
+SUPPORTED_DEVICES = chr(0x44)           # ATmega162 device code
+ATMEGA162_SIGNATURE = chr(0x04) + chr(0x94) + chr(0x1E)
+
+#
+# High fuse with BOOTSZ = 01, which puts the bootloader at word address
+# 0x1E00, as on the x0xb0x.
+#
+DEFAULT_HIGH_FUSE = 0xDA
+DEFAULT_LOW_FUSE = 0xFF
+
+#
+# Timing model.  Every write() from the host costs a round trip through
+# the USB-serial adapter, and every byte costs 10 bit times at the baud
+# rate.  The flash and EEPROM write times are from the ATmega162
+# datasheet.
+#
+DEFAULT_BAUD_RATE = 19200
+USB_LATENCY = 0.002
+PAGE_ERASE_TIME = 0.004
+PAGE_WRITE_TIME = 0.0045
+EEPROM_WRITE_TIME = 0.0085
+
+CR = chr(0x0D)
+ESC = chr(0x1B)
+
+class AvrEmulator:
+    #
+    # blockSize      - The block size reported by 'b', or 0 to emulate a
+    #                  bootloader without block transfers, which answers
+    #                  'Z', 'B' and 'g' with '?'.
+    # errorRate      - The chance of each byte sent to the emulator being
+    #                  corrupted on the way.
+    # writeErrorRate - The chance of each write() raising a
+    #                  SerialException before the bytes are delivered.
+    # realtime       - Sleep for the emulated time instead of only adding
+    #                  it up on the virtual clock.
+    #
+    def __init__(self, port = 'emulator', baudRate = DEFAULT_BAUD_RATE, timeout = None,
+                 pageSize = ATMEGA162_FLASHPAGE_SIZE, blockSize = ATMEGA162_FLASHPAGE_SIZE,
+                 highFuse = DEFAULT_HIGH_FUSE, lowFuse = DEFAULT_LOW_FUSE,
+                 errorRate = 0.0, writeErrorRate = 0.0, seed = None, realtime = False):
+        self.portstr = port
+        self.timeout = timeout
+        self.baudrate = baudRate
+        self.byteTime = 10.0 / baudRate
+        self.pageSize = pageSize
+        self.blockSize = blockSize
+        self.highFuse = highFuse
+        self.lowFuse = lowFuse
+        self.errorRate = errorRate
+        self.writeErrorRate = writeErrorRate
+        self.random = random.Random(seed)
+        self.realtime = realtime
+        self.open = True
+
+        self.flash = bytearray(chr(0xFF) * ATMEGA162_FLASH_SIZE)
+        self.eeprom = bytearray(chr(0xFF) * ATMEGA162_EEPROM_SIZE)
+        self.pageBuffer = bytearray(chr(0xFF) * pageSize)
+        self.address = 0
+        self.ledOn = False
+        self.programming = False
+
+        self.input = ''
+        self.output = ''
+
+        #
+        # Counters for benchmarks and tests.
+        #
+        self.clock = 0.0
+        self.writes = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.pageWrites = 0
+        self.pageErases = 0
+        self.injectedErrors = 0
+
+    #
+    # SERIAL PORT INTERFACE
+    #
+    def setTimeout(self, timeout):
+        self.timeout = timeout
+
+    def isOpen(self):
+        return self.open
+
+    def close(self):
+        self.open = False
+
+    def inWaiting(self):
+        return len(self.output)
+
+    def flushInput(self):
+        self.output = ''
+
+    def write(self, data):
+        self.writes += 1
+        self.advance(USB_LATENCY + len(data) * self.byteTime)
+
+        if self.random.random() < self.writeErrorRate:
+            self.injectedErrors += 1
+            raise serial.SerialException('Emulated write error')
+
+        if self.errorRate > 0:
+            data = self.corrupt(data)
+
+        self.bytesIn += len(data)
+        self.input += data
+        self.process()
+
+    def read(self, size = 1):
+        data = self.output[:size]
+        self.output = self.output[size:]
+        self.bytesOut += len(data)
+        self.advance(len(data) * self.byteTime)
+
+        #
+        # A short read means that the host sat out the whole timeout.
+        #
+        if (len(data) < size) and (self.timeout != None):
+            self.advance(self.timeout)
+        return data
+
+    #
+    # EMULATION
+    #
+    def advance(self, seconds):
+        self.clock += seconds
+        if self.realtime:
+            time.sleep(seconds)
+
+    def corrupt(self, data):
+        data = bytearray(data)
+        for i in range(len(data)):
+            if self.random.random() < self.errorRate:
+                data[i] ^= 1 << self.random.randint(0, 7)
+                self.injectedErrors += 1
+        return str(data)
+
+    def reply(self, data):
+        self.output += data
+
+    #
+    # The flash is addressed in words, the EEPROM in bytes.
+    #
+    def flashAddress(self):
+        return (self.address * 2) % len(self.flash)
+
+    def pageAddress(self):
+        return self.flashAddress() - self.flashAddress() % self.pageSize
+
+    def erasePage(self, addr):
+        self.flash[addr:addr + self.pageSize] = chr(0xFF) * self.pageSize
+        self.pageErases += 1
+        self.advance(PAGE_ERASE_TIME)
+
+    #
+    # Like the real chip, writing a page can only clear bits, so a page
+    # that has not been erased first ends up with the AND of its old and
+    # new contents.
+    #
+    def writePage(self, addr, data):
+        for i in range(len(data)):
+            self.flash[addr + i] &= data[i]
+        self.pageWrites += 1
+        self.advance(PAGE_WRITE_TIME)
+
+    #
+    # Carry out as many complete commands as there are in the input.
+    # Commands that have not been completely received yet are left in the
+    # input until the rest of them arrives.
+    #
+    def process(self):
+        while len(self.input) > 0:
+            length = self.commandLength(self.input)
+            if length == None or len(self.input) < length:
+                return
+            command = self.input[:length]
+            self.input = self.input[length:]
+            self.execute(command)
+
+    def commandLength(self, data):
+        c = data[0]
+        if c in 'xyTcCD':
+            return 2
+        if c == 'A':
+            return 3
+        if c in 'BgZ':
+            if not self.blockSize:
+                return 1
+            if c == 'Z':
+                return 1 + self.pageSize
+            if len(data) < 4:
+                return None
+            if c == 'g':
+                return 4
+            return 4 + ((ord(data[1]) << 8) + ord(data[2]))
+        return 1
+
+    def execute(self, command):
+        c = command[0]
+
+        if c == ESC:
+            pass
+
+        elif c == 'S':
+            self.reply(BOOTLOADER_ID)
+        elif c == 't':
+            self.reply(SUPPORTED_DEVICES + chr(0))
+        elif c == 'T':
+            self.reply(CR)
+        elif c == 'a':
+            self.reply('Y')
+        elif c == 's':
+            self.reply(ATMEGA162_SIGNATURE)
+        elif c == 'N':
+            self.reply(chr(self.highFuse))
+        elif c == 'F':
+            self.reply(chr(self.lowFuse))
+        elif c in 'xy':
+            self.ledOn = (c == 'x')
+            self.reply(CR)
+        elif c == 'P':
+            self.programming = True
+            self.reply(CR)
+        elif c == 'L':
+            self.programming = False
+            self.reply(CR)
+
+        elif c == 'A':
+            self.address = (ord(command[1]) << 8) + ord(command[2])
+            self.reply(CR)
+
+        elif c == 'e':
+            for addr in range(0, self.bootloaderAddress(), self.pageSize):
+                self.erasePage(addr)
+            self.reply(CR)
+        elif c == 'E':
+            # The x0xb0x bootloader erases the page at the current address
+            self.erasePage(self.pageAddress())
+            self.reply(CR)
+
+        elif c == 'R':
+            addr = self.flashAddress()
+            self.reply(chr(self.flash[addr + 1]) + chr(self.flash[addr]))
+            self.address += 1
+        elif c in 'cC':
+            offset = self.flashAddress() % self.pageSize
+            if c == 'c':
+                self.pageBuffer[offset] = command[1]
+            else:
+                self.pageBuffer[offset + 1] = command[1]
+                self.address += 1
+            self.reply(CR)
+        elif c == 'm':
+            self.writePage(self.pageAddress(), self.pageBuffer)
+            self.pageBuffer = bytearray(chr(0xFF) * self.pageSize)
+            self.reply(CR)
+
+        elif c == 'd':
+            self.reply(chr(self.eeprom[self.address % len(self.eeprom)]))
+            self.address += 1
+        elif c == 'D':
+            self.eeprom[self.address % len(self.eeprom)] = command[1]
+            self.address += 1
+            self.advance(EEPROM_WRITE_TIME)
+            self.reply(CR)
+
+        elif not self.blockSize and c in 'bBgZ':
+            self.reply('?')
+        elif c == 'b':
+            self.reply('Y' + chr((self.blockSize >> 8) & 0xff) + chr(self.blockSize & 0xff))
+        elif c == 'Z':
+            # The x0xb0x bootloader's own page write: 'Z' and a whole page
+            self.writePage(self.pageAddress(), bytearray(command[1:]))
+            self.address += self.pageSize / 2
+            self.reply(CR)
+        elif c == 'B':
+            self.blockWrite(command[3], bytearray(command[4:]))
+        elif c == 'g':
+            self.blockRead(command[3], (ord(command[1]) << 8) + ord(command[2]))
+
+        else:
+            self.reply('?')
+
+    def blockWrite(self, memory, data):
+        if memory == 'F':
+            for i in range(0, len(data), self.pageSize):
+                self.writePage(self.pageAddress(), data[i:i + self.pageSize])
+                self.address += self.pageSize / 2
+        elif memory == 'E':
+            for b in data:
+                self.eeprom[self.address % len(self.eeprom)] = b
+                self.address += 1
+                self.advance(EEPROM_WRITE_TIME)
+        else:
+            self.reply('?')
+            return
+        self.reply(CR)
+
+    def blockRead(self, memory, size):
+        if memory == 'F':
+            addr = self.flashAddress()
+            self.reply(str(self.flash[addr:addr + size]))
+            self.address += size / 2
+        elif memory == 'E':
+            addr = self.address % len(self.eeprom)
+            self.reply(str(self.eeprom[addr:addr + size]))
+            self.address += size
+        else:
+            self.reply('?')
+
+    def bootloaderAddress(self):
+        return {0: 0x1C00, 1: 0x1E00, 2: 0x1F00, 3: 0x1F80}[(self.highFuse >> 1) & 3] * 2
+
+
+#
+# Benchmark AvrProgram against the emulator.
+#
+if __name__ == '__main__':
+    import sys
+    import os
+    import AvrProgram
+    import FlashMetrics
+    import IntelHexFormat
+
+    if len(sys.argv) > 1:
+        image = IntelHexFormat.IntelHexFile(sys.argv[1]).toByteString()
+    else:
+        # Roughly the size of the x0xb0x firmware, with a gap in the middle
+        image = os.urandom(9000) + chr(0xFF) * 2000 + os.urandom(1500)
+
+    changed = bytearray(image)
+    changed[100] ^= 0xFF
+    changed[5000] ^= 0xFF
+    changed = str(changed)
+
+    def benchmark(name, emulator, buffer, **options):
+        metrics = FlashMetrics.FlashMetrics()
+        start = emulator.clock
+        AvrProgram.doFlashProgramming(emulator, buffer, metrics = metrics, **options)
+        print '%-32s %7.2fs emulated, %5d writes, %s' % (name, emulator.clock - start,
+                                                         emulator.writes, metrics.summary())
+
+    benchmark('Block writes', AvrEmulator(), image)
+    benchmark('Block writes + verify', AvrEmulator(), image, verify = True)
+    benchmark('Slow mode + verify', AvrEmulator(blockSize = 0), image, verify = True)
+
+    emulator = AvrEmulator()
+    AvrProgram.doFlashProgramming(emulator, image)
+    emulator.writes = 0
+    benchmark('Differential reflash + verify', emulator, changed, verify = True, differential = True)
+
+    #
+    # Only inject errors while programming, then check that programFlash
+    # recovered from all of them.
+    #
+    emulator = AvrEmulator(writeErrorRate = 0.02, seed = 1)
+    benchmark('Write errors', emulator, image)
+    emulator.writeErrorRate = 0.0
+    badpages = AvrProgram.verifyFlash(image, emulator)
+    print '%d write errors injected, %d bad pages' % (emulator.injectedErrors, len(badpages))
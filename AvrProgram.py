@@ -8,6 +8,10 @@
 # Adapted from the JAvrProg project by Michael Broxton
 #
 
+import serial
+import FlashManifest
+import FlashMetrics
+
 #
 # Useful Constants
 #
@@ -16,69 +20,211 @@ ATMEGA162_EEPROM_SIZE = 512
 ATMEGA162_FLASHPAGE_SIZE = 128
 ATMEGA162_EEPROMPAGE_SIZE = 4
 
+#
+# Rough costs, used to decide whether reflashing only the changed pages
+# is quicker than programming the whole flash (see FlashCosts).  Every
+# command costs a round trip through the USB-serial adapter, and every
+# byte 10 bit times.  The page times are from the ATmega162 datasheet.
+#
+ROUND_TRIP_TIME = 0.002
+PAGE_ERASE_TIME = 0.004
+PAGE_WRITE_TIME = 0.0045
+DEFAULT_LINK_BAUD_RATE = 19200
+
+#
+# How many times in a row a page is retried in slow mode before giving up.
+#
+SLOW_MODE_RETRIES = 5
+
+#
+# How many pages, besides the first and the last, are read back to check
+# that a flash manifest matches the chip.
+#
+SPOT_CHECK_PAGES = 6
+
+CR = chr(0x0D)
+ESC = chr(0x1B)
+
+#
+# Serial timeouts for each phase of programming.  These are set once at
+# the start of a phase rather than before every read.  Reads return as
+# soon as the expected number of reply bytes has arrived, so a generous
+# timeout only costs time when something has gone wrong.
+#
+COMMAND_TIMEOUT = 0.1       # Short commands with a one byte reply
+PAGE_ERASE_TIMEOUT = 0.1    # Erasing one page of flash
+PROGRAM_TIMEOUT = 1.0       # Sending and writing one page of flash
+BLOCK_PROBE_TIMEOUT = 0.1   # Waiting to see if 'Z' is answered with '?'
+ERASE_TIMEOUT = 3.0         # Chip erase
+RECOVERY_TIMEOUT = 1.0      # Resynchronizing after a failed write
+EEPROM_BYTE_TIMEOUT = 0.01  # Added for each byte of an EEPROM block write
+
+#
+# COMMAND LAYER
+#
+# Every AVR109 command has a reply of a fixed length, so several commands
+# can be sent to the bootloader in a single write() and their replies
+# collected with a single read().  On USB-serial adapters every write
+# costs at least one USB frame, so this is much faster than writing each
+# byte of each command separately.
+#
+# AvrLink wraps a serial connection.  Commands are queued with queue()
+# and sent with flush(), or sent on their own with command().  The link
+# also remembers the serial timeout so that it is only changed when it
+# needs to be.
+#
+class AvrLink:
+    def __init__(self, serialconn):
+        self.serialconn = serialconn
+        self.portstr = serialconn.portstr
+        self.timeout = None
+        self.commands = []
+
+    def setTimeout(self, timeout):
+        if timeout != self.timeout:
+            self.serialconn.setTimeout(timeout)
+            self.timeout = timeout
+
+    def write(self, data):
+        self.serialconn.write(data)
+
+    def read(self, size = 1):
+        return self.serialconn.read(size)
+
+    def flushInput(self):
+        self.serialconn.flushInput()
+
+    #
+    # Queue 'command' to be sent on the next flush().  The bootloader will
+    # reply with 'replyLength' bytes.  If 'expected' is not None, the reply
+    # must be equal to it, otherwise an AVRException is raised with the
+    # message 'errorMessage'.
+    #
+    def queue(self, command, replyLength = 1, expected = CR, errorMessage = None):
+        self.commands.append((command, replyLength, expected, errorMessage))
+
+    #
+    # Send all of the queued commands in one write, read all of their
+    # replies in one read and check them.  Returns a list of the replies.
+    #
+    # Some bootloaders sometimes send a stray byte along with a reply.
+    # If 'strayByte' is given, every such byte is dropped from the
+    # replies (so it must not be part of any of the expected replies),
+    # and anything else left in the input once the replies have been read
+    # is thrown away, so that a stray byte can't shift the replies to the
+    # next commands.
+    #
+    def flush(self, strayByte = None):
+        commands = self.commands
+        self.commands = []
+        if len(commands) == 0:
+            return []
+
+        self.serialconn.write(''.join([c[0] for c in commands]))
+
+        replyLength = sum([c[1] for c in commands])
+        reply = ''
+        if replyLength > 0:
+            reply = self.serialconn.read(replyLength)
+            if strayByte != None:
+                reply = reply.replace(strayByte, '')
+                while len(reply) < replyLength:
+                    more = self.serialconn.read(replyLength - len(reply))
+                    if len(more) == 0:
+                        break
+                    reply += more.replace(strayByte, '')
+        if strayByte != None:
+            self.serialconn.flushInput()
+
+        replies = []
+        offset = 0
+        for (command, length, expected, errorMessage) in commands:
+            r = reply[offset:offset + length]
+            offset += length
+            if (expected != None) and (r != expected):
+                if errorMessage == None:
+                    errorMessage = 'Bad response to ' + command[0] + ' message'
+                raise AVRException, errorMessage
+            replies.append(r)
+        return replies
+
+    #
+    # Send a single command and return its reply.
+    #
+    def command(self, command, replyLength = 1, expected = CR, errorMessage = None):
+        self.queue(command, replyLength, expected, errorMessage)
+        return self.flush()[0]
+
+
+#
+# Returns an AvrLink for 'serialconn', which may already be one.
+#
+def avrLink(serialconn):
+    if isinstance(serialconn, AvrLink):
+        return serialconn
+    return AvrLink(serialconn)
+
+#
+# Returns 'metrics', or a FlashMetrics with no listeners if it is None, so
+# that the programming functions can always report their progress.
+#
+def flashMetrics(metrics):
+    if metrics == None:
+        return FlashMetrics.FlashMetrics()
+    return metrics
+
+def addressCommand(addr):
+    addr = addr / 2
+    return 'A' + chr((addr >> 8) & 0xff) + chr(addr & 0xff)
+
 #
 # BASIC UTILITIES
 #
 def setAddress(serialconn, addr):
-    addr = addr / 2
-    serialconn.write('A')
-    serialconn.write(chr((addr >> 8) & 0xff))
-    serialconn.write(chr(addr & 0xff))
-        
+    link = avrLink(serialconn)
     # print 'setting addr: ' + str(addr);
-    
-    serialconn.setTimeout(0.1)
-    b =  serialconn.read()
-    if b != chr(0x0d):
-        raise AVRException,'Bad response to setAddress message'
-      
-def eraseFlash(serialconn):
-        
-    setLED(serialconn)
-    serialconn.write('e')
-    
-    serialconn.setTimeout(3.0)
-    b =  serialconn.read()
-    
-    if b != chr(0x0d):
-        raise AVRException,'Bad response to erase message'
-    clearLED(serialconn)
-  
+    link.setTimeout(COMMAND_TIMEOUT)
+    link.command(addressCommand(addr), errorMessage = 'Bad response to setAddress message')
+
+def eraseFlash(serialconn, metrics = None):
+    link = avrLink(serialconn)
+    metrics = flashMetrics(metrics)
+    metrics.startPhase(FlashMetrics.PHASE_ERASE)
+
+    #
+    # The LED is turned on for the duration of the erase.  The bootloader
+    # only answers the 'y' once the erase is finished.
+    #
+    link.setTimeout(ERASE_TIMEOUT)
+    link.queue('x' + chr(0x00), errorMessage = 'Bad response to setLED message')
+    link.queue('e', errorMessage = 'Bad response to erase message')
+    link.queue('y' + chr(0x00), errorMessage = 'Bad response to setLED message')
+    link.flush()
+    metrics.finishPhase()
+
 def setLED(serialconn):
-    serialconn.write('x')
-    serialconn.write(chr(0x00));
-    
-    serialconn.setTimeout(0.1)
-    b =  serialconn.read()
-    if b != chr(0x0d):
-        raise AVRException,'Bad response to setLED message'
-        
-        
+    link = avrLink(serialconn)
+    link.setTimeout(COMMAND_TIMEOUT)
+    link.command('x' + chr(0x00), errorMessage = 'Bad response to setLED message')
+
 def clearLED(serialconn):
-    serialconn.write('y');
-    serialconn.write(chr(0x00));
-    
-    serialconn.setTimeout(0.1)
-    b =  serialconn.read()
-    if b != chr(0x0d):
-        raise AVRException,'Bad response to setLED message'
-        
-  
+    link = avrLink(serialconn)
+    link.setTimeout(COMMAND_TIMEOUT)
+    link.command('y' + chr(0x00), errorMessage = 'Bad response to setLED message')
+
 def readFuseH(serialconn):
-    serialconn.write('N')
-    
-    serialconn.setTimeout(0.1)
-    b =  serialconn.read()
+    link = avrLink(serialconn)
+    link.setTimeout(COMMAND_TIMEOUT)
+    b = link.command('N', expected = None)
     if len(b) != 0:
-        return ord(b)        
+        return ord(b)
     else:
         raise AVRException,'No x0xb0x detected on the serial port'
-    
+
 def readFuseL(serialconn):
-    serialconn.write('F')
-    
-    serialconn.setTimeout(0.1)
-    b =  serialconn.read()
+    link = avrLink(serialconn)
+    link.setTimeout(COMMAND_TIMEOUT)
+    b = link.command('F', expected = None)
     if len(b) != 0:
         return ord(b)
     else:
@@ -90,23 +236,111 @@ def readFuseL(serialconn):
 # the serial port.
 #
 def readWord(address, serialconn):
-    setAddress(serialconn, address)
-    serialconn.write('R');
+    link = avrLink(serialconn)
     try:
-        serialconn.setTimeout(1.0)
-        b =  serialconn.read(2)
+        link.setTimeout(RECOVERY_TIMEOUT)
+        link.queue(addressCommand(address), errorMessage = 'Bad response to setAddress message')
+        link.queue('R', 2, None)
+        b = link.flush()[1]
+        if len(b) != 2:
+            raise AVRException,'No response to readWord message'
 
         ret = (ord(b[0]) << 8) + ord(b[1])
         return ret;
 
     except serial.SerialException, e:
-        raise AVRException,'Bad response to readWord message: ' + e.value
+        raise AVRException,'Bad response to readWord message: ' + str(e)
+
+
+#
+# Try to get the bootloader back in sync after a write failed part way
+# through a page, by flooding it with escape characters.
+#
+def resynchronize(link, flood):
+    link.write(ESC * flood)
+    try:
+        link.setTimeout(RECOVERY_TIMEOUT)
+        link.read()     # MEME - this used to be serealconn.readbytes() in java!!!
+        link.flushInput()
+        link.setTimeout(PROGRAM_TIMEOUT)
+    except serial.SerialException, e:
+        raise AVRException,'Serial exception in response to restart message: ' + str(e)
+
+
+#
+# Work out which pages of 'buffer' between 'startaddr' and 'endaddr'
+# actually need to be written.  Pages that are all 0xFF are left alone,
+# since that is what the chip erase leaves behind.  Returns a list of
+# (start, end) address pairs, one for each run of consecutive non-blank
+# pages, so that each run can be streamed with a single setAddress.
+#
+def planPages(buffer, startaddr, endaddr, pagesize = ATMEGA162_FLASHPAGE_SIZE):
+    blankpage = chr(0xFF) * pagesize
+    runs = []
+    runstart = None
+    for addr in range(startaddr, endaddr, pagesize):
+        if buffer[addr:addr+pagesize] == blankpage:
+            if runstart != None:
+                runs.append((runstart, addr))
+                runstart = None
+        elif runstart == None:
+            runstart = addr
+    if runstart != None:
+        runs.append((runstart, endaddr))
+    return runs
+
+#
+# Work out which pages between 'startaddr' and 'endaddr' differ between
+# the new image in 'buffer' and the 'current' contents of the flash.
+# Returns a list of page addresses.
+#
+def changedPages(buffer, current, startaddr, endaddr, pagesize = ATMEGA162_FLASHPAGE_SIZE):
+    pages = []
+    for addr in range(startaddr, endaddr, pagesize):
+        if buffer[addr:addr+pagesize] != current[addr:addr+pagesize]:
+            pages.append(addr)
+    return pages
+
+#
+# Group a sorted list of page addresses into (start, end) runs of
+# consecutive pages, as returned by planPages.
+#
+def pageRuns(pages, pagesize = ATMEGA162_FLASHPAGE_SIZE):
+    runs = []
+    for addr in pages:
+        if len(runs) > 0 and runs[-1][1] == addr:
+            runs[-1] = (runs[-1][0], addr + pagesize)
+        else:
+            runs.append((addr, addr + pagesize))
+    return runs
 
-  
-  
-def programFlash(buffer, startaddr, endaddr, serialconn):
+#
+# Erase the given pages one at a time, leaving the rest of the flash
+# alone.
+#
+def erasePages(pages, serialconn, metrics = None):
+    link = avrLink(serialconn)
+    metrics = flashMetrics(metrics)
+    metrics.startPhase(FlashMetrics.PHASE_ERASE, len(pages))
+    link.setTimeout(PAGE_ERASE_TIMEOUT)
+    for addr in pages:
+        link.queue(addressCommand(addr), errorMessage = 'Bad response to setAddress message')
+        link.queue('E', errorMessage = 'Bad response to page erase message')
+        link.flush()
+        metrics.pageDone(addr, 0)
+    metrics.finishPhase()
+
+
+#
+# Program the non-blank pages of 'buffer' between 'startaddr' and
+# 'endaddr'.  If 'runs' is given, only those runs of pages (as returned
+# by planPages or pageRuns) are written.  Progress is reported to
+# 'metrics', a FlashMetrics.
+#
+def programFlash(buffer, startaddr, endaddr, serialconn, runs = None, metrics = None):
 
-    serialconn.setTimeout(0.1)
+    link = avrLink(serialconn)
+    metrics = flashMetrics(metrics)
 
     flashsize = ATMEGA162_FLASH_SIZE
     flashpagesize = ATMEGA162_FLASHPAGE_SIZE
@@ -116,236 +350,414 @@ def programFlash(buffer, startaddr, endaddr, serialconn):
     bootloaderAddr = 0
     usercodeAddr = 0
 
-    print 'Endaddr is ' + str(endaddr)
-
     if ((startaddr % flashpagesize != 0) | (endaddr % flashpagesize != 0)):
         raise AVRException, 'Start or end address does not line up with page sizes'
 
-    #    progressbar.setValue(0, 'Writing Address: 0x00');
-    print 'Writing Address: 0x00'
+    #
+    # The buffer may be a string or a bytearray; the pages are sent as
+    # strings.
+    #
+    buffer = str(buffer)
+    if runs == None:
+        runs = planPages(buffer, startaddr, endaddr, flashpagesize)
+
+    pagecount = sum([(runend - runstart) / flashpagesize for (runstart, runend) in runs])
+    metrics.startPhase(FlashMetrics.PHASE_PROGRAM, pagecount)
 
     # print 'Writing ' + (endaddr - startaddr) + ' bytes of Flash to ' + device.name()
-    setLED(serialconn)
-                                    
-    #
-    # First we check to make sure that autoincrementing works
-    #
-    serialconn.write('a')
-    b = serialconn.read()
-    if b != 'Y':
-        raise AVRException,'Bad response..want autoincrementing!' 
-        
-    #
-    # Enter programming mode
-    #
-    serialconn.write('P')
-    b = serialconn.read();
-    if b != chr(0x0D):
-        raise AVRException,'Bad response in programFlash to P message'
-    
-    setAddress(serialconn, startaddr)
-
-    fastmode = True; 
-                                    
-    for i in range(startaddr, endaddr, flashpagesize):
-        #        progressbar.setValue(i / (endaddr - startaddr), 'Writing Address: ' + hex(i).upper() )
-        print 'Writing Address: ' + hex(i).upper() 
-                                      
-        # Read the next page into buffer
-        
-        # print 'arraycopy(buffer, "+i+", flashpagebuffer, 0, "+flashpagesize+");"); ## fixme for debugging
-        flashpagebuffer = buffer[i:i+flashpagesize]
-                
+
+    #
+    # Turn on the LED, check to make sure that autoincrementing works and
+    # enter programming mode, all in one go.
+    #
+    link.setTimeout(COMMAND_TIMEOUT)
+    link.queue('x' + chr(0x00), errorMessage = 'Bad response to setLED message')
+    link.queue('a', 1, 'Y', 'Bad response..want autoincrementing!')
+    link.queue('P', errorMessage = 'Bad response in programFlash to P message')
+    link.flush()
+
+    link.setTimeout(PROGRAM_TIMEOUT)
+
+    fastmode = True;
+    probedBlockWrite = False
+    retries = 0
+
+    for (runstart, runend) in runs:
         #
-        # Check if this next page
-        # is all 0xFF and therefore blank, then skip it if it is
-        #                         
-        blankpage = True;
-        
-        for j in range(0, flashpagesize):
-            if flashpagebuffer[j] !=  chr(0xFF):
-                blankpage = False
-                break
-                
-        if (blankpage):
-            # print 'Skipping " + str(i)
-            setAddress(serialconn, i+flashpagesize)
-            continue
-            
-                                      
-        # if fastmode, do it fast!
-        if (fastmode):
-            #                tryagain:    ???
-            try:
-                serialconn.write('Z')
-                                          
-                if i == startaddr:	
-                    ret = '!'
-                    try:
-                        ret = serialconn.read();
-                    except serial.SerialException, e:
-                        raise AVRException,'Serial exception in response to Z message: ' + e.value
-                        
-                    # System.out.println("Fast?");
-                    if ret == '?':
-                        fastmode = False
+        # The address only needs setting at the start of each run, after
+        # that the bootloader autoincrements it from page to page.
+        #
+        link.command(addressCommand(runstart), errorMessage = 'Bad response to setAddress message')
+
+        i = runstart
+        while i < runend:
+            flashpagebuffer = buffer[i:i+flashpagesize]
+
+            # if fastmode, do it fast!
+            if (fastmode):
+                try:
+                    if not probedBlockWrite:
                         #
-                        # this is kinda icky, but basically, undo the incrementation & start over
+                        # A bootloader without block writes answers 'Z' with
+                        # '?' straight away.  Otherwise it silently waits for
+                        # the page, so this read times out.
                         #
-                        i -= flashpagesize
-                        continue
-                                            
-                    print 'Using block write mode'
-                        
-                # serialconn.send_slow(flashpagebuffer, flashpagesize);
-                serialconn.write(flashpagebuffer)
-                                          
-                b = serialconn.read()
-                if b != chr(0x0D):
-                    raise AVRException,'Bad response during fast write'
-                continue
-            except serial.SerialException, e:
-                # try again?
-                print 'Serial exception during write: ' + e.value
-                print 'Restarting from address ' + str(i)
-                                          
-                for n in range(0,flashpagesize+5):
-                    serialconn.write(chr(0x1B))
-                serialconn.write(chr(0x1B))
-                serialconn.write(chr(0x1B))
-                serialconn.write(chr(0x1B))
-                try:
-                    serialconn.setTimeout(1.0)
-                    serialconn.read()     # MEME - this used to be serealconn.readbytes() in java!!!
-                    serialconn.setTimeout(0.1)
+                        probedBlockWrite = True
+                        link.write('Z')
+                        link.setTimeout(BLOCK_PROBE_TIMEOUT)
+                        try:
+                            ret = link.read();
+                        except serial.SerialException, e:
+                            raise AVRException,'Serial exception in response to Z message: ' + str(e)
+                        link.setTimeout(PROGRAM_TIMEOUT)
+
+                        # System.out.println("Fast?");
+                        if ret == '?':
+                            #
+                            # Start this page over in slow mode.
+                            #
+                            fastmode = False
+                            metrics.setFastMode(False)
+                            continue
+
+                        metrics.setFastMode(True)
+                        link.command(flashpagebuffer, errorMessage = 'Bad response during fast write')
+                    else:
+                        link.command('Z' + flashpagebuffer, errorMessage = 'Bad response during fast write')
+
+                    metrics.pageDone(i, flashpagesize)
+                    i += flashpagesize
+                    continue
                 except serial.SerialException, e:
-                    raise AVRException,'Serial exception in response to restart message: ' + e.value
-                    
-                setAddress(serialconn, i)
-                i -= flashpagesize   # (to undo the forloop increment)
-                serialconn.write('E') # erase page
-                serialconn.read()    # read 0x0D
-                continue
+                    # try again?
+                    print 'Serial exception during write: ' + str(e)
+                    print 'Restarting from address ' + str(i)
+                    metrics.retry(i, str(e))
 
-        else:
-            #
-            # ok slow mode, send one byte at a time :(
-            #
-            try:
-                for j in range(0,flashpagesize,2):
-                    serialconn.write('c')
-                    serialconn.write(flashpagebuffer[j])
-                    b = serialconn.read()
-                    if b != char(0x0D):
-                        raise AVRException,'Bad response to c message in slow mode'
-                    serialconn.write('C');
-                    serialconn.write(flashpagebuffer[j+1]);
-                    
-                    for q in range(0,5):
-                        b = serialconn.read()
-                        if b != chr(0x3F): # !!! FIXME: why does this happen??
-                            break
-                            
-                        if b != chr(0x0D):
-                            raise AVRException, 'Bad response to C message in slow mode'
-            except serial.SerialException, e:
-                # hmm, we didnt get a response, lets try again
-                print 'No response, restarting from address ' + str(i)
-                serialconn.write(chr(0x1B))
-                serialconn.write(chr(0x1B))
-                serialconn.write(chr(0x1B))
-                serialconn.write(chr(0x1B))
+                    resynchronize(link, flashpagesize + 5 + 4)
+
+                    #
+                    # Erase the page and start it over.
+                    #
+                    link.queue(addressCommand(i), errorMessage = 'Bad response to setAddress message')
+                    link.queue('E', 1, None) # erase page
+                    link.flush()
+                    continue
+
+            else:
+                #
+                # ok slow mode, send one byte at a time :(
+                #
+                # Each word is sent with a 'c' (low byte) and 'C' (high byte)
+                # command, which autoincrements the address.  The address is
+                # then reset to the start of the page, the page is written with
+                # 'm' and the address is moved on to the next page of the run.
+                # All of this goes to the bootloader in a single write.
+                #
+                # The bootloader sometimes answers 'C' with a '?' before the
+                # 0x0D.  Every reply here is 0x0D, so the '?'s are simply
+                # dropped, and the input is cleared after each page.
+                #
                 try:
-                    serialconn.setTimeout(1.0)
-                    serialconn.read()     # MEME - this used to be serealconn.readbytes() in java!!!
-                    serialconn.setTimeout(0.1)
-                except serial.SerialException, e:
-                    raise AVRException,'Serial exception in response to restart message: ' + e.value
-                
-                setAddress(serialconn, i)
-                i -= flashpagesize   # (to undo the forloop increment)
-                continue
+                    for j in range(0,flashpagesize,2):
+                        link.queue('c' + flashpagebuffer[j], errorMessage = 'Bad response to c message in slow mode')
+                        link.queue('C' + flashpagebuffer[j+1], errorMessage = 'Bad response to C message in slow mode')
+
+                    # stupid autoincrement means we have to reset the address!
+                    link.queue(addressCommand(i), errorMessage = 'Bad response to setAddress message')
+                    link.queue('m', errorMessage = 'Bad response to m message')
+                    if i + flashpagesize < runend:
+                        link.queue(addressCommand(i+flashpagesize), errorMessage = 'Bad response to setAddress message')
+                    link.flush('?')
+                except (serial.SerialException, AVRException), e:
+                    #
+                    # No reply, or a garbled one: get back in step with the
+                    # bootloader and write the page again.
+                    #
+                    print 'Bad or no response, restarting from address ' + str(i)
+                    metrics.retry(i, str(e))
+                    retries += 1
+                    if retries > SLOW_MODE_RETRIES:
+                        raise AVRException, 'Too many errors writing the page at address ' + hex(i).upper()
+                    resynchronize(link, 4)
+                    link.command(addressCommand(i), errorMessage = 'Bad response to setAddress message')
+                    continue
+
+                retries = 0
+
+                metrics.pageDone(i, flashpagesize)
+                i += flashpagesize
+
+    # turn off the LED and leave programming mode
+    link.setTimeout(COMMAND_TIMEOUT)
+    link.queue('y' + chr(0x00), errorMessage = 'Bad response to setLED message')
+    link.queue('L', errorMessage = 'Bad response to L message')
+    link.flush()
+    metrics.finishPhase()
+
+
+#
+# READBACK
+#
+# Bootloaders that support block transfers answer 'b' with 'Y' and their
+# block size, and send a block of flash in reply to 'g'.  Older ones only
+# have 'R', which reads one word (high byte first) and autoincrements.
+#
+# The bootloader cannot buffer what it is sent while it is busy sending
+# a reply, so each read is its own round trip rather than being batched.
+#
+
+#
+# Returns the block size of the bootloader, or 0 if it does not support
+# block transfers.
+#
+def blockSize(serialconn):
+    link = avrLink(serialconn)
+    link.setTimeout(COMMAND_TIMEOUT)
+    recvdata = link.command('b', 3, None)
+    if len(recvdata) != 3 or recvdata[0] != 'Y':
+        return 0
+    return (ord(recvdata[1]) << 8) + ord(recvdata[2])
+
+def readFlashPage(serialconn, addr, size, blocksize):
+    link = avrLink(serialconn)
+    if blocksize > 0:
+        data = ''
+        while len(data) < size:
+            n = min(blocksize, size - len(data))
+            block = link.command('g' + chr((n >> 8) & 0xff) + chr(n & 0xff) + 'F', n, None)
+            if len(block) != n:
+                raise AVRException,'No response to block read message'
+            data += block
+        return data
+
+    words = []
+    for j in range(0, size, 2):
+        b = link.command('R', 2, None)
+        if len(b) != 2:
+            raise AVRException,'No response to readWord message'
+        words.append(b[1] + b[0])
+    return ''.join(words)
+
+#
+# Read the flash from 'startaddr' to 'endaddr' (by default the whole
+# application area below the bootloader) and return it as a string.
+#
+def readFlash(serialconn, startaddr = 0, endaddr = None, metrics = None):
+    link = avrLink(serialconn)
+    metrics = flashMetrics(metrics)
+    flashpagesize = ATMEGA162_FLASHPAGE_SIZE
+
+    if endaddr == None:
+        endaddr = getBootloaderAddress(link)
+
+    blocksize = blockSize(link)
+
+    link.setTimeout(PROGRAM_TIMEOUT)
+    link.command(addressCommand(startaddr), errorMessage = 'Bad response to setAddress message')
+
+    metrics.startPhase(FlashMetrics.PHASE_READ, len(range(startaddr, endaddr, flashpagesize)))
+    data = []
+    for addr in range(startaddr, endaddr, flashpagesize):
+        data.append(readFlashPage(link, addr, min(flashpagesize, endaddr - addr), blocksize))
+        metrics.pageDone(addr, len(data[-1]))
+    metrics.finishPhase()
+    return ''.join(data)
+
+#
+# Compare the flash with 'buffer'.  Only the pages that programFlash
+# would have written are read back.  Returns a list of the addresses of
+# the pages that differ, which is empty if the flash matches.
+#
+def verifyFlash(buffer, serialconn, startaddr = 0, endaddr = None, metrics = None):
+    link = avrLink(serialconn)
+    metrics = flashMetrics(metrics)
+    flashpagesize = ATMEGA162_FLASHPAGE_SIZE
+
+    buffer = str(buffer)
+    if endaddr == None:
+        endaddr = min(getBootloaderAddress(link), len(buffer))
+
+    blocksize = blockSize(link)
+    link.setTimeout(PROGRAM_TIMEOUT)
+
+    runs = planPages(buffer, startaddr, endaddr, flashpagesize)
+    metrics.startPhase(FlashMetrics.PHASE_VERIFY, sum([(runend - runstart) / flashpagesize for (runstart, runend) in runs]))
+
+    badpages = []
+    for (runstart, runend) in runs:
+        link.command(addressCommand(runstart), errorMessage = 'Bad response to setAddress message')
+        for addr in range(runstart, runend, flashpagesize):
+            size = min(flashpagesize, runend - addr)
+            if readFlashPage(link, addr, size, blocksize) != buffer[addr:addr+size]:
+                badpages.append(addr)
+            metrics.pageDone(addr, size)
+    metrics.finishPhase()
+    return badpages
+
+
+#
+# EEPROM
+#
+# EEPROM addresses are byte addresses, unlike flash addresses which are
+# word addresses.  With block support, the EEPROM is read and written in
+# blocks using memory type 'E'.  Otherwise it is done a byte at a time
+# with 'd' and 'D'.  The bootloader writes each byte before it replies,
+# so the timeout of a write grows with the size of the block.
+#
+def eepromAddressCommand(addr):
+    return 'A' + chr((addr >> 8) & 0xff) + chr(addr & 0xff)
+
+def checkEEPROMRange(startaddr, size):
+    if (startaddr < 0) or (startaddr + size > ATMEGA162_EEPROM_SIZE):
+        raise AVRException, 'EEPROM image does not fit in the ' + str(ATMEGA162_EEPROM_SIZE) + ' byte EEPROM'
+
+#
+# Write 'image' into the EEPROM starting at 'startaddr'.
+#
+def programEEPROM(image, serialconn, startaddr = 0, metrics = None):
+    link = avrLink(serialconn)
+    metrics = flashMetrics(metrics)
+
+    image = str(image)
+    checkEEPROMRange(startaddr, len(image))
+
+    blocksize = blockSize(link)
+
+    setLED(link)
+    link.setTimeout(PROGRAM_TIMEOUT)
+    link.command(eepromAddressCommand(startaddr), errorMessage = 'Bad response to setAddress message')
 
-            # stupid autoincrement means we have to reset the address!
-            setAddress(serialconn, i)
-            serialconn.write('m')
-                                        
-            if b != chr(0x0D):
-                raise AVRException, 'Bad response to m message'
-                
-            setAddress(serialconn, i+flashpagesize)
+    if blocksize > 0:
+        metrics.startPhase(FlashMetrics.PHASE_EEPROM, len(range(0, len(image), blocksize)))
+        for i in range(0, len(image), blocksize):
+            block = image[i:i+blocksize]
+            link.setTimeout(PROGRAM_TIMEOUT + len(block) * EEPROM_BYTE_TIMEOUT)
+            link.command('B' + chr((len(block) >> 8) & 0xff) + chr(len(block) & 0xff) + 'E' + block,
+                         errorMessage = 'Bad response to EEPROM block write')
+            metrics.pageDone(startaddr + i, len(block))
+    else:
+        metrics.startPhase(FlashMetrics.PHASE_EEPROM, len(image))
+        link.setTimeout(PROGRAM_TIMEOUT)
+        for i in range(len(image)):
+            link.command('D' + image[i], errorMessage = 'Bad response to EEPROM write')
+            metrics.pageDone(startaddr + i, 1)
 
-    #    progressbar.setValue(100, 'Upload Complete')
-    print 'Upload Complete'
-    clearLED(serialconn)
-                                    
-    # leave programming mode
-    serialconn.write('L')
-    b = serialconn.read();
-    if b != chr(0x0D):
-        raise AVRException, 'Bad response to m message'
+    metrics.finishPhase()
+    clearLED(link)
+    print 'EEPROM Upload Complete'
 
+#
+# Read 'size' bytes of the EEPROM starting at 'startaddr' and return them
+# as a string.
+#
+def readEEPROM(serialconn, size = ATMEGA162_EEPROM_SIZE, startaddr = 0):
+    link = avrLink(serialconn)
 
-def findAVRBoard(serialconnection):
+    checkEEPROMRange(startaddr, size)
 
-    print 'Attempting to locate an AVR chip on port ' + serialconnection.portstr
+    blocksize = blockSize(link)
+
+    link.setTimeout(PROGRAM_TIMEOUT)
+    link.command(eepromAddressCommand(startaddr), errorMessage = 'Bad response to setAddress message')
+
+    data = ''
+    if blocksize > 0:
+        while len(data) < size:
+            n = min(blocksize, size - len(data))
+            block = link.command('g' + chr((n >> 8) & 0xff) + chr(n & 0xff) + 'E', n, None)
+            if len(block) != n:
+                raise AVRException,'No response to EEPROM block read message'
+            data += block
+    else:
+        for i in range(size):
+            b = link.command('d', 1, None)
+            if len(b) != 1:
+                raise AVRException,'No response to EEPROM read message'
+            data += b
+    return data
+
+
+#
+# Ask the bootloader on the other end of the serial port to identify
+# itself.  Returns the 7 byte identifier string (e.g. 'AVRBOOT'), or None
+# if no bootloader answered before the timeout.
+#
+def probeBootloader(serialconn, timeout = 0.250):
+    link = avrLink(serialconn)
+
+    #
+    # Reading exactly 7 bytes lets the read return as soon as the
+    # identifier has arrived instead of always waiting for the timeout.
+    #
+    link.setTimeout(timeout)
+    recvdata = link.command(ESC + ESC + ESC + ESC + 'S', 7, None)
+    if len(recvdata) != 7:
+        return None
+    return recvdata
+
+
+def findAVRBoard(serialconnection, attempts = 3):
+
+    link = avrLink(serialconnection)
+
+    print 'Attempting to locate an AVR chip on port ' + link.portstr
 
     #
     # Make several attempts to establish a connection to the
     # bootloader on the AVR.
     #
-    for i in range(0,3):
-        serialconnection.write(chr(0x1B))
-        serialconnection.write(chr(0x1B))
-        serialconnection.write(chr(0x1B))
-        serialconnection.write(chr(0x1B))
-        serialconnection.write('S')
+    recvdata = None
+    for i in range(0, attempts):
         try:
-            serialconnection.setTimeout(0.250)
-            recvdata = serialconnection.read(100)  # Read up to 100 bytes before the timeout fires
+            recvdata = probeBootloader(link)
         except serial.SerialException, e:
-            print 'Serial exception occured in findAVRBoard: ' + e.value
-        if recvdata != '':
+            print 'Serial exception occured in findAVRBoard: ' + str(e)
+        if recvdata != None:
             break
-  
-    if (recvdata == '') or (len(recvdata) != 7):
-        # print 'Length: ' + str(len(recvdata))
+
+    if recvdata == None:
         print 'Failed.'
         raise AVRException, 'The x0xb0x did not respond.  Check to be sure that the x0xb0x is in the Bootload mode.'
         return False
-    
+
     # Else...
     print 'Found ' + recvdata
 
     #
-    # Get supported devices
+    # Get supported devices.  The list is terminated by a zero byte, so
+    # read until it arrives rather than waiting for the timeout.
     #
-    serialconnection.write('t')
     try:
-        serialconnection.setTimeout(0.1)
-        recvdata = serialconnection.read(100) # Read up to 100 bytes before the timeout fires
+        link.setTimeout(COMMAND_TIMEOUT)
+        link.write('t')
+        recvdata = ''
+        b = link.read()
+        while b != '' and b != chr(0):
+            recvdata += b
+            b = link.read()
     except serial.SerialException, e:
-        print 'Serial exception occured in findAVRBoard: ' + e.value
+        print 'Serial exception occured in findAVRBoard: ' + str(e)
         return False
 
-    if recvdata[-1] != chr(0):
+    if b != chr(0):
         return False
-    
+
     print 'supported: '
 
-    for i in range(0,len(recvdata)-1):
+    for i in range(0,len(recvdata)):
         #          DeviceDescriptor d = (DeviceDescriptor)DevicesByID.get(new Byte(recvdata[i]));
         print 'Ordinal device ID value: ' + str(ord(recvdata[i]))
-            
-    return True;
 
+    return True;
 
-def doFlashProgramming(serialconnection, hexfilebuffer):
 
-    #
-    # get the address from the fuses
-    #
-    highfuse = readFuseH(serialconnection)
+#
+# Returns the byte address of the bootloader, which is set by the
+# BOOTSZ bits of the high fuse.
+#
+def getBootloaderAddress(serialconn):
+    highfuse = readFuseH(serialconn)
     highfuse >>= 1
     highfuse &= 3
 
@@ -358,22 +770,356 @@ def doFlashProgramming(serialconnection, hexfilebuffer):
     else:
         bootloadAddr = 0x1C00
 
-    bootloadAddr *= 2
+    return bootloadAddr * 2
+
+
+#
+# Returns the three signature bytes of the chip as a hex string.
+#
+def readSignature(serialconn):
+    link = avrLink(serialconn)
+    link.setTimeout(COMMAND_TIMEOUT)
+    b = link.command('s', 3, None)
+    if len(b) != 3:
+        raise AVRException,'No response to signature message'
+    return ''.join(['%02X' % ord(c) for c in b])
+
+#
+# Returns a tuple that identifies the x0xb0x being programmed: the
+# serial port it is on, the bootloader and chip signatures and the fuses.
+#
+def deviceIdentity(serialconn):
+    link = avrLink(serialconn)
+    bootloader = probeBootloader(link)
+    if bootloader == None:
+        raise AVRException,'No x0xb0x detected on the serial port'
+    return (link.portstr, bootloader, readSignature(link),
+            '%02X' % readFuseH(link), '%02X' % readFuseL(link))
+
+#
+# Read the given pages of flash and return a list of their contents.
+#
+def readPages(pages, serialconn, metrics = None, phase = FlashMetrics.PHASE_READ):
+    link = avrLink(serialconn)
+    metrics = flashMetrics(metrics)
+    flashpagesize = ATMEGA162_FLASHPAGE_SIZE
+
+    blocksize = blockSize(link)
+    link.setTimeout(PROGRAM_TIMEOUT)
+
+    metrics.startPhase(phase, len(pages))
+    data = []
+    nextaddr = None
+    for addr in pages:
+        #
+        # The bootloader moves on to the next page by itself.
+        #
+        if addr != nextaddr:
+            link.command(addressCommand(addr), errorMessage = 'Bad response to setAddress message')
+        data.append(readFlashPage(link, addr, flashpagesize, blocksize))
+        nextaddr = addr + flashpagesize
+        metrics.pageDone(addr, flashpagesize)
+    metrics.finishPhase()
+    return data
+
+#
+# Estimates of how long the ways of programming the flash take, from the
+# number of pages they read, write and erase.
+#
+class FlashCosts:
+    def __init__(self, serialconn, pagesize = ATMEGA162_FLASHPAGE_SIZE):
+        link = avrLink(serialconn)
+        byteTime = 10.0 / getattr(link.serialconn, 'baudrate', DEFAULT_LINK_BAUD_RATE)
+        self.readPage = ROUND_TRIP_TIME + (4 + pagesize) * byteTime
+        self.writePage = ROUND_TRIP_TIME + (4 + pagesize + 1) * byteTime + PAGE_WRITE_TIME
+        self.erasePage = ROUND_TRIP_TIME + (3 + 1 + 1 + 1) * byteTime + PAGE_ERASE_TIME
+        self.pagesize = pagesize
+
+    #
+    # Erasing the chip and writing the non-blank pages of 'buffer'.
+    #
+    def fullFlash(self, buffer, endaddr):
+        blankpage = chr(0xFF) * self.pagesize
+        pages = range(0, endaddr, self.pagesize)
+        written = [addr for addr in pages if buffer[addr:addr+self.pagesize] != blankpage]
+        return len(pages) * PAGE_ERASE_TIME + len(written) * self.writePage
+
+    #
+    # Erasing 'pages' and writing those that are not blank in 'buffer'.
+    #
+    def reflash(self, buffer, pages):
+        blankpage = chr(0xFF) * self.pagesize
+        written = [addr for addr in pages if buffer[addr:addr+self.pagesize] != blankpage]
+        return len(pages) * self.erasePage + len(written) * self.writePage
+
+    def readBack(self, pages):
+        return len(pages) * self.readPage
+
+#
+# Pages that are blank in 'buffer' are simply erased when reflashing
+# differentially, rather than being read back to see if they need to be.
+# Returns the pages of 'buffer' between 0 and 'endaddr' that hold data,
+# i.e. the ones that are read back.
+#
+def imagePages(buffer, endaddr, pagesize = ATMEGA162_FLASHPAGE_SIZE):
+    blankpage = chr(0xFF) * pagesize
+    return [addr for addr in range(0, endaddr, pagesize) if buffer[addr:addr+pagesize] != blankpage]
+
+#
+# Pick the pages to spot check out of 'pages': the first, the last and
+# 'count' evenly spaced ones in between.
+#
+def spotCheckPages(pages, count = SPOT_CHECK_PAGES):
+    if len(pages) <= count + 2:
+        return list(pages)
+    picks = set([0, len(pages) - 1])
+    for i in range(1, count + 1):
+        picks.add(i * (len(pages) - 1) / (count + 1))
+    return [pages[i] for i in sorted(picks)]
+
+#
+# Read back the pages of the flash that 'buffer' holds data for, and
+# return the pages that have to be reflashed: those that differ, and all
+# of the pages that are blank in 'buffer'.  Returns None if the bootloader
+# has no block reads, or if reading the pages back would take longer
+# than programming the whole flash would.
+#
+def readChangedPages(buffer, serialconn, endaddr, metrics = None):
+    link = avrLink(serialconn)
+    flashpagesize = ATMEGA162_FLASHPAGE_SIZE
+    if blockSize(link) == 0:
+        return None
+
+    readpages = imagePages(buffer, endaddr, flashpagesize)
+    imageset = set(readpages)
+    blankpages = [addr for addr in range(0, endaddr, flashpagesize) if addr not in imageset]
+
+    #
+    # Even if nothing has changed, the blank pages have to be erased.
+    #
+    costs = FlashCosts(link, flashpagesize)
+    if costs.readBack(readpages) + costs.reflash(buffer, blankpages) >= costs.fullFlash(buffer, endaddr):
+        print 'Reading the flash back would take longer than programming it'
+        return None
+
+    current = readPages(readpages, link, metrics)
+    changed = [addr for (addr, data) in zip(readpages, current)
+               if data != buffer[addr:addr+flashpagesize]]
+    return sorted(changed + blankpages)
+
+#
+# Erase the given pages and write those that are not blank in 'buffer',
+# leaving the rest of the flash alone.  Returns the runs of pages that
+# were written.
+#
+def reflashPages(buffer, pages, serialconn, endaddr, metrics = None):
+    link = avrLink(serialconn)
+    flashpagesize = ATMEGA162_FLASHPAGE_SIZE
+
+    #
+    # Pages that are blank in the new image only need erasing.
+    #
+    blankpage = chr(0xFF) * flashpagesize
+    writepages = [addr for addr in pages if buffer[addr:addr+flashpagesize] != blankpage]
+    runs = pageRuns(writepages, flashpagesize)
+
+    if len(pages) > 0:
+        setLED(link)
+        erasePages(pages, link, metrics)
+        clearLED(link)
+    if len(runs) > 0:
+        programFlash(buffer, 0, endaddr, link, runs, metrics)
+    return runs
+
+
+#
+# Program 'hexfilebuffer' into the application area of the flash.
+#
+# differential - Read back the pages that the image holds data for, and
+#                only erase and write the pages that have changed (the
+#                pages that are blank in the image are just erased).
+#                Not done if it can't be quicker than a plain flash.
+# manifest     - A FlashManifest.  If it holds a manifest for this device,
+#                the changed pages are worked out from it.  Every x0xb0x
+#                looks the same to the bootloader, so the manifest may
+#                belong to another unit that was on the same port: a few
+#                of the pages that it says can be skipped are spot checked
+#                first, and if any of them does not match, the changed
+#                pages are found as for 'differential'.  A new manifest
+#                is recorded once programming has finished.
+# verify       - Read the application area back and check it.
+# metrics      - A FlashMetrics to report progress to.
+#
+# If so many pages have changed that it would be quicker, the whole chip
+# is erased and programmed anyway (see FlashCosts).
+#
+def doFlashProgramming(serialconnection, hexfilebuffer, verify = False, differential = False, manifest = None, metrics = None):
+
+    link = avrLink(serialconnection)
+    metrics = flashMetrics(metrics)
+    flashpagesize = ATMEGA162_FLASHPAGE_SIZE
+
+    #
+    # get the address from the fuses
+    #
+    bootloadAddr = getBootloaderAddress(link)
     print 'Bootloader is at addr ' + str(bootloadAddr)
 
     #
-    # Erase the flash memory
+    # Images only cover the addresses that the hex file contains, so pad
+    # the image with blank (0xFF) bytes out to a whole number of pages.
     #
-    eraseFlash(serialconnection)
+    hexfilebuffer = str(hexfilebuffer)
+    if len(hexfilebuffer) % flashpagesize != 0:
+        hexfilebuffer += chr(0xFF) * (flashpagesize - len(hexfilebuffer) % flashpagesize)
+
+    endaddr = min(bootloadAddr, len(hexfilebuffer))
 
     #
-    # Program the chip!
+    # Differential programming compares the whole application area, so
+    # that code left over past the end of the new image is erased too.
     #
-    programFlash(hexfilebuffer, 0, min(bootloadAddr, len(hexfilebuffer)), serialconnection)
-        
+    fullbuffer = hexfilebuffer[:endaddr] + chr(0xFF) * (bootloadAddr - endaddr)
+
+    pages = None
+    if manifest != None:
+        key = FlashManifest.deviceKey(deviceIdentity(link))
+        pages = manifest.changedPages(key, fullbuffer, bootloadAddr, flashpagesize)
+
+        if pages != None:
+            #
+            # Spot check a few of the pages that would be skipped against
+            # the manifest.  If the chip was programmed by something else,
+            # or is a different unit, the changed pages are found by
+            # reading the flash back instead.
+            #
+            changed = set(pages)
+            skipped = [addr for addr in range(0, bootloadAddr, flashpagesize) if addr not in changed]
+            checkpages = spotCheckPages(skipped)
+            for (addr, data) in zip(checkpages, readPages(checkpages, link, metrics)):
+                if manifest.expectedPageHash(key, addr) != FlashManifest.pageHash(data):
+                    print 'Flash manifest is out of date'
+                    pages = None
+                    differential = True
+                    break
+
+        #
+        # Forget the manifest until programming has succeeded.
+        #
+        manifest.forget(key)
+        manifest.save()
+
+    if (pages == None) and differential:
+        pages = readChangedPages(fullbuffer, link, bootloadAddr, metrics)
+
+    #
+    # If so many pages have changed that it is quicker, the whole chip is
+    # erased and programmed anyway.
+    #
+    if pages != None:
+        costs = FlashCosts(link, flashpagesize)
+        if costs.reflash(fullbuffer, pages) >= costs.fullFlash(fullbuffer, bootloadAddr):
+            pages = None
+
+    if pages != None:
+        print 'Changed pages: ' + str(len(pages))
+        runs = reflashPages(fullbuffer, pages, link, bootloadAddr, metrics)
+    else:
+        #
+        # Erase the flash memory
+        #
+        eraseFlash(link, metrics)
+
+        #
+        # Program the chip!
+        #
+        runs = planPages(hexfilebuffer, 0, endaddr, flashpagesize)
+        programFlash(hexfilebuffer, 0, endaddr, link, runs, metrics)
+
+    #
+    # Read the programmed pages back and check them.
+    #
+    if verify:
+        badpages = verifyFlash(fullbuffer, link, 0, bootloadAddr, metrics)
+        if len(badpages) != 0:
+            raise AVRException, 'Verify failed at address ' + hex(badpages[0]).upper()
+        print 'Verify Complete'
+
+    if manifest != None:
+        manifest.record(key, fullbuffer, bootloadAddr, flashpagesize)
+        manifest.save()
+
+    metrics.finish()
+
 
 class AVRException(Exception):
     def __init__(self, value):
         self.value = value
     def __str__(self):
         return repr(self.value)
+
+
+#
+# Command line programmer:
+#
+#    python AvrProgram.py [options] PORT FILE.hex
+#    python AvrProgram.py --dump FILE.hex PORT
+#
+if __name__ == '__main__':
+    import sys
+    import optparse
+    import IntelHexFormat
+    from Globals import DEFAULT_BAUD_RATE
+
+    parser = optparse.OptionParser(usage = '%prog [options] PORT FILE.hex\n       %prog --dump FILE.hex PORT')
+    parser.add_option('--verify', action = 'store_true', default = False,
+                      help = 'read the programmed pages back and check them')
+    parser.add_option('--differential', action = 'store_true', default = False,
+                      help = 'only erase and write the pages that have changed')
+    parser.add_option('--manifest', action = 'store_true', default = False,
+                      help = 'use the flash manifest of the device to find the changed pages')
+    parser.add_option('--dump', metavar = 'FILE.hex',
+                      help = 'read the application area of the flash back into a hex file')
+    parser.add_option('--record-size', type = 'int', default = 16,
+                      help = 'data bytes per record when dumping (default 16)')
+    (options, args) = parser.parse_args()
+    if options.dump:
+        if len(args) != 1:
+            parser.error('a serial port is required')
+    elif len(args) != 2:
+        parser.error('a serial port and a hex file are required')
+
+    #
+    # The metrics only hold a weak reference to the progress listener.
+    #
+    progress = FlashMetrics.ConsoleProgress()
+    metrics = FlashMetrics.FlashMetrics()
+    metrics.RegisterListener(progress, 'ALL')
+
+    serialconnection = serial.Serial(args[0], DEFAULT_BAUD_RATE)
+    try:
+        if not findAVRBoard(serialconnection):
+            sys.exit(1)
+
+        if options.dump:
+            image = readFlash(serialconnection, metrics = metrics)
+            metrics.finish()
+            f = open(options.dump, 'w')
+            try:
+                IntelHexFormat.writeIntelHex(f, image, options.record_size)
+            finally:
+                f.close()
+        else:
+            import FirmwareCache
+            ihx = FirmwareCache.loadFirmware(args[1])
+
+            manifest = None
+            if options.manifest:
+                manifest = FlashManifest.FlashManifest()
+
+            doFlashProgramming(serialconnection, ihx.toByteString(), options.verify,
+                               options.differential, manifest, metrics)
+    except AVRException, e:
+        print 'Programming failed: ' + e.value
+        sys.exit(1)
+    serialconnection.close()
@@ -0,0 +1,234 @@
+#----------------------------------------------------------------------------
+# Name:         FirmwareCache.py
+# Purpose:      An on-disk cache of parsed firmware images, so that
+#               flashing the same release again does not have to parse
+#               its hex file again.  For each hex file the cache holds
+#               the flat binary image (a .bin file) and a JSON file with
+#               the file's path, modification time, size and sha1, the
+#               sha1 of the binary image, and the image's segments and
+#               the pages that hold data.
+#
+#               A cached image is used as is if the hex file's
+#               modification time and size have not changed.  If they
+#               have, the hex file is hashed, and the cached image is
+#               still used if its contents are the same.  The binary image
+#               is checked against its sha1 whenever it is read.  If it
+#               is missing or damaged, the hex file is parsed and
+#               cached again.
+#
+#               The cache lives in ~/.c0ntr0l/firmware-cache.
+#----------------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.c0ntr0l', 'firmware-cache')
+CACHE_VERSION = 2
+
+#
+# The page size that the page map is worked out for.
+#
+CACHE_PAGE_SIZE = 128
+
+def fileHash(fileName):
+    f = open(fileName, 'rb')
+    try:
+        return hashlib.sha1(f.read()).hexdigest()
+    finally:
+        f.close()
+
+#
+# A firmware image loaded from the cache.  It has the same methods as
+# IntelHexFile for getting at the image.
+#
+class CachedFirmwareImage:
+    def __init__(self, fileName, binName, info):
+        self.fileName = fileName
+        self.numberOfBytes = info['numberOfBytes']
+        self.segments = [tuple(segment) for segment in info['segments']]
+        self.pageSize = info['pageSize']
+        self.pageMap = info['pages']
+
+        #
+        # A firmware image is at most the size of the flash, so it is
+        # simply read in.
+        #
+        self.data = ''
+        if self.numberOfBytes > 0:
+            f = open(binName, 'rb')
+            try:
+                self.data = f.read()
+            finally:
+                f.close()
+            if len(self.data) != self.numberOfBytes:
+                raise IOError('Cached firmware image ' + binName + ' is the wrong size')
+        if hashlib.sha1(self.data).hexdigest() != info['binSha1']:
+            raise IOError('Cached firmware image ' + binName + ' is damaged')
+
+    def toByteString(self, size = None, startAddress = 0):
+        if size is None:
+            size = self.numberOfBytes - startAddress
+        data = self.data[startAddress:startAddress + size]
+        if len(data) < size:
+            data += chr(0xFF) * (size - len(data))
+        return data
+
+    #
+    # Returns one page of the image without copying it, if it is within
+    # the image.
+    #
+    def page(self, address, pageSize):
+        if address + pageSize <= self.numberOfBytes:
+            return buffer(self.data, address, pageSize)
+        return self.toByteString(pageSize, address)
+
+    def pages(self, pageSize):
+        if pageSize == self.pageSize:
+            addresses = self.pageMap
+        else:
+            addresses = pageAddresses(self.segments, pageSize)
+        for address in addresses:
+            yield (address, self.page(address, pageSize))
+
+    def ranges(self):
+        return self.segments
+
+
+#
+# Returns the start addresses of the pages that the (start, end)
+# 'ranges' hold data in.
+#
+def pageAddresses(ranges, pageSize):
+    pages = []
+    for (start, end) in ranges:
+        page = start - (start % pageSize)
+        if pages and pages[-1] >= page:
+            page = pages[-1] + pageSize
+        while page < end:
+            pages.append(page)
+            page += pageSize
+    return pages
+
+
+class FirmwareCache:
+    def __init__(self, cacheDir = None):
+        if cacheDir == None:
+            cacheDir = CACHE_DIR
+        self.cacheDir = cacheDir
+
+    def cacheNames(self, fileName):
+        key = hashlib.sha1(os.path.abspath(fileName)).hexdigest()
+        base = os.path.join(self.cacheDir, key)
+        return (base + '.json', base + '.bin')
+
+    #
+    # Returns the image of the hex file 'fileName', from the cache if
+    # possible, otherwise by parsing the file and adding it to the cache.
+    #
+    def load(self, fileName):
+        (infoName, binName) = self.cacheNames(fileName)
+        stat = os.stat(fileName)
+
+        info = self.readInfo(infoName)
+        if info != None:
+            try:
+                if (info['mtime'] == stat.st_mtime) and (info['size'] == stat.st_size):
+                    return CachedFirmwareImage(fileName, binName, info)
+
+                #
+                # The file has been touched or copied, but may well still
+                # be the same release.
+                #
+                if info['sha1'] == fileHash(fileName):
+                    image = CachedFirmwareImage(fileName, binName, info)
+                    info['mtime'] = stat.st_mtime
+                    info['size'] = stat.st_size
+                    self.writeFile(infoName, json.dumps(info))
+                    return image
+            except EnvironmentError, e:
+                #
+                # The binary image is missing or damaged: parse
+                # the hex file again and replace the entry.
+                #
+                print 'Cached firmware image is not usable: ' + str(e)
+
+        return self.store(fileName, stat)
+
+    def readInfo(self, infoName):
+        try:
+            f = open(infoName, 'r')
+            try:
+                info = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError), e:
+            return None
+
+        if info.get('version') != CACHE_VERSION:
+            return None
+        return info
+
+    #
+    # Parse a hex file and add it to the cache.
+    #
+    def store(self, fileName, stat):
+        import IntelHexFormat
+
+        (infoName, binName) = self.cacheNames(fileName)
+        sha1 = fileHash(fileName)
+        ihx = IntelHexFormat.IntelHexFile(fileName)
+
+        data = ihx.toByteString()
+        ranges = ihx.image.ranges()
+        info = {
+            'version': CACHE_VERSION,
+            'path': os.path.abspath(fileName),
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'sha1': sha1,
+            'binSha1': hashlib.sha1(data).hexdigest(),
+            'numberOfBytes': ihx.numberOfBytes,
+            'segments': ranges,
+            'pageSize': CACHE_PAGE_SIZE,
+            'pages': pageAddresses(ranges, CACHE_PAGE_SIZE)
+            }
+
+        if not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir)
+
+        #
+        # The image goes in before the info that says it is valid.
+        #
+        self.writeFile(binName, data)
+        self.writeFile(infoName, json.dumps(info))
+        return CachedFirmwareImage(fileName, binName, info)
+
+    #
+    # Write a cache file through a temporary file, so that an interrupted
+    # write never leaves a partial file behind.
+    #
+    def writeFile(self, fileName, data):
+        tempName = fileName + '.tmp'
+        f = open(tempName, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        if os.name == 'nt' and os.path.exists(fileName):
+            os.remove(fileName)
+        os.rename(tempName, fileName)
+
+
+#
+# Returns the image of the hex file 'fileName', using the firmware cache.
+# If the cache can't be used (e.g. the home directory is read only), the
+# file is simply parsed.
+#
+def loadFirmware(fileName, cacheDir = None):
+    try:
+        return FirmwareCache(cacheDir).load(fileName)
+    except EnvironmentError, e:
+        import IntelHexFormat
+        print 'Firmware cache is not available: ' + str(e)
+        return IntelHexFormat.IntelHexFile(fileName)
@@ -0,0 +1,149 @@
+#----------------------------------------------------------------------------
+# Name:         FlashManifest.py
+# Purpose:      Remembers what was last flashed onto each x0xb0x.  After
+#               a successful program, a manifest holding the hash of the
+#               image and of each of its pages is recorded for the
+#               device.  The next time that device is flashed, the pages
+#               that need to change can be worked out from the manifest
+#               without reading the chip back.
+#
+#               Devices are identified by the serial port they are on,
+#               the bootloader and chip signatures and the fuses.  Every
+#               x0xb0x has the same signatures and fuses, so this really
+#               only tells ports apart: a manifest is a hint that
+#               AvrProgram checks against the chip before relying on it.
+#               The manifests are kept in a JSON file in ~/.c0ntr0l.
+#               One FlashManifest can be shared by several threads (see
+#               FlashStation).
+#----------------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+import threading
+
+MANIFEST_DIR = os.path.join(os.path.expanduser('~'), '.c0ntr0l')
+MANIFEST_FILE = 'flash-manifests.json'
+
+def pageHash(data):
+    return hashlib.sha1(data).hexdigest()
+
+#
+# Returns the key under which the manifest of a device is stored.
+# 'identity' is the tuple returned by AvrProgram.deviceIdentity().
+#
+def deviceKey(identity):
+    return '/'.join([str(part) for part in identity])
+
+
+class FlashManifest:
+    def __init__(self, fileName = None):
+        if fileName == None:
+            fileName = os.path.join(MANIFEST_DIR, MANIFEST_FILE)
+        self.fileName = fileName
+        self.manifests = {}
+        self.lock = threading.Lock()
+
+        #
+        # A missing or unreadable manifest file just means that nothing
+        # is known about any device yet.
+        #
+        try:
+            f = open(self.fileName, 'r')
+            try:
+                self.manifests = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError), e:
+            self.manifests = {}
+
+    def save(self):
+        self.lock.acquire()
+        try:
+            self.writeFile()
+        finally:
+            self.lock.release()
+
+    def writeFile(self):
+        directory = os.path.dirname(self.fileName)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        #
+        # Write to a temporary file first so that an interrupted save
+        # does not leave a corrupt manifest file behind.
+        #
+        tempName = self.fileName + '.tmp'
+        f = open(tempName, 'w')
+        try:
+            json.dump(self.manifests, f)
+        finally:
+            f.close()
+        if os.name == 'nt' and os.path.exists(self.fileName):
+            os.remove(self.fileName)
+        os.rename(tempName, self.fileName)
+
+    #
+    # Record that 'buffer' has been programmed into the first 'endaddr'
+    # bytes of the flash of the device 'key'.
+    #
+    def record(self, key, buffer, endaddr, pagesize):
+        buffer = str(buffer)[:endaddr]
+        buffer += chr(0xFF) * (endaddr - len(buffer))
+        manifest = {
+            'imageHash': pageHash(buffer),
+            'endAddress': endaddr,
+            'pageSize': pagesize,
+            'pages': [pageHash(buffer[addr:addr+pagesize]) for addr in range(0, endaddr, pagesize)]
+            }
+        self.lock.acquire()
+        try:
+            self.manifests[key] = manifest
+        finally:
+            self.lock.release()
+
+    #
+    # Forget the manifest of a device, e.g. before it is reprogrammed, so
+    # that an interrupted program does not leave a stale manifest.
+    #
+    def forget(self, key):
+        self.lock.acquire()
+        try:
+            if key in self.manifests:
+                del self.manifests[key]
+        finally:
+            self.lock.release()
+
+    #
+    # Returns the hash that the manifest holds for the page at 'addr', or
+    # None if it is not known.
+    #
+    def expectedPageHash(self, key, addr):
+        manifest = self.manifests.get(key)
+        if manifest == None:
+            return None
+        page = addr / manifest['pageSize']
+        if page >= len(manifest['pages']):
+            return None
+        return manifest['pages'][page]
+
+    #
+    # Work out which pages of the flash of device 'key' differ from
+    # 'buffer'.  Returns a list of page addresses, or None if there is no
+    # usable manifest for the device.
+    #
+    def changedPages(self, key, buffer, endaddr, pagesize):
+        manifest = self.manifests.get(key)
+        if (manifest == None) or (manifest['endAddress'] != endaddr) or (manifest['pageSize'] != pagesize):
+            return None
+
+        buffer = str(buffer)[:endaddr]
+        buffer += chr(0xFF) * (endaddr - len(buffer))
+        if pageHash(buffer) == manifest['imageHash']:
+            return []
+
+        pages = []
+        for addr in range(0, endaddr, pagesize):
+            if pageHash(buffer[addr:addr+pagesize]) != manifest['pages'][addr / pagesize]:
+                pages.append(addr)
+        return pages
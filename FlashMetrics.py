@@ -0,0 +1,160 @@
+#----------------------------------------------------------------------------
+# Name:         FlashMetrics.py
+# Purpose:      Progress and throughput reporting for AvrProgram.  A
+#               FlashMetrics object is a notification center that the
+#               programming functions report to as they go.  It keeps
+#               count of the pages done, the bytes transferred, the
+#               retries and the time spent in each phase (erase,
+#               program, verify...), and notifies its listeners of each
+#               change.  The listeners are passed the FlashMetrics
+#               object itself, so they can read whatever they need.
+#
+#               ConsoleProgress is a listener that prints a progress
+#               line on the terminal.
+#----------------------------------------------------------------------------
+
+from NotificationCenter import NotificationCenter
+import sys
+import time
+
+#
+# Programming phases
+#
+PHASE_ERASE = 'erase'
+PHASE_PROGRAM = 'program'
+PHASE_READ = 'read'
+PHASE_VERIFY = 'verify'
+PHASE_EEPROM = 'eeprom'
+
+#
+# Notification keys
+#
+PHASE_STARTED = 'phase started'
+PHASE_FINISHED = 'phase finished'
+PAGE_DONE = 'page done'
+RETRY = 'retry'
+SLOW_MODE = 'slow mode'
+FINISHED = 'finished'
+
+class FlashMetrics(NotificationCenter):
+    def __init__(self):
+        NotificationCenter.__init__(self)
+        self.startTime = time.time()
+        self.phase = None
+        self.phaseStart = None
+        self.pagesDone = 0
+        self.pagesTotal = 0
+        self.bytesDone = 0
+        self.address = None
+        self.event = None
+
+        #
+        # These cover every phase.  'phaseTimes' is a list of (phase,
+        # seconds) pairs in the order the phases ran.
+        #
+        self.retries = 0
+        self.lastRetry = None
+        self.fastMode = None
+        self.phaseTimes = []
+        self.totalBytes = 0
+
+    #
+    # Listeners can tell what has happened from 'event', which is the
+    # notification key.
+    #
+    def notify(self, event):
+        self.event = event
+        self.NotifyListeners(self, event)
+
+    def startPhase(self, phase, pagesTotal = 0):
+        if self.phase != None:
+            self.finishPhase()
+        self.phase = phase
+        self.phaseStart = time.time()
+        self.pagesDone = 0
+        self.pagesTotal = pagesTotal
+        self.bytesDone = 0
+        self.address = None
+        self.notify(PHASE_STARTED)
+
+    def finishPhase(self):
+        if self.phase == None:
+            return
+        self.phaseTimes.append((self.phase, time.time() - self.phaseStart))
+        self.notify(PHASE_FINISHED)
+        self.phase = None
+
+    def pageDone(self, address, size):
+        self.pagesDone += 1
+        self.bytesDone += size
+        self.totalBytes += size
+        self.address = address
+        self.notify(PAGE_DONE)
+
+    def retry(self, address, message):
+        self.retries += 1
+        self.lastRetry = (address, message)
+        self.notify(RETRY)
+
+    #
+    # Called once it is known whether the bootloader takes whole pages
+    # ('Z' block writes) or has to be sent a byte at a time.
+    #
+    def setFastMode(self, fastMode):
+        self.fastMode = fastMode
+        if not fastMode:
+            self.notify(SLOW_MODE)
+
+    def finish(self):
+        self.finishPhase()
+        self.notify(FINISHED)
+
+    #
+    # Throughput of the current phase.
+    #
+    def bytesPerSecond(self):
+        if self.phaseStart == None:
+            return 0.0
+        elapsed = time.time() - self.phaseStart
+        if elapsed <= 0:
+            return 0.0
+        return self.bytesDone / elapsed
+
+    def elapsed(self):
+        return time.time() - self.startTime
+
+    def summary(self):
+        phases = ', '.join(['%s %.2fs' % (phase, seconds) for (phase, seconds) in self.phaseTimes])
+        s = 'Total %.2fs (%s), %d bytes' % (self.elapsed(), phases, self.totalBytes)
+        if self.fastMode == False:
+            s += ', slow mode'
+        if self.retries > 0:
+            s += ', %d retries' % self.retries
+        return s
+
+
+#
+# A listener that shows the progress of each phase on the terminal, one
+# line per phase, followed by a summary once programming has finished.
+#
+class ConsoleProgress:
+    def __init__(self, stream = sys.stdout):
+        self.stream = stream
+
+    def NotificationCallback(self, metrics):
+        if metrics.event == FINISHED:
+            self.stream.write(metrics.summary() + '\n')
+            return
+
+        line = '\r%-8s' % metrics.phase
+        if metrics.pagesTotal > 0:
+            line += ' %3d/%-3d pages' % (metrics.pagesDone, metrics.pagesTotal)
+        line += ' %7.0f bytes/s' % metrics.bytesPerSecond()
+        if metrics.fastMode == False:
+            line += ' (slow mode)'
+        if metrics.retries > 0:
+            line += ' %d retries' % metrics.retries
+        if metrics.event == PHASE_FINISHED:
+            line += '\n'
+        self.stream.write(line)
+        self.stream.flush()
@@ -0,0 +1,237 @@
+#----------------------------------------------------------------------------
+# Name:         FlashStation.py
+# Purpose:      Flashes a batch of x0xb0xes at once.  The firmware image
+#               is parsed once, then every serial port with a x0xb0x in
+#               bootload mode gets its own worker thread, which finds the
+#               bootloader, programs the image and verifies it.  The
+#               workers all share the same (immutable) image string.
+#               Each unit's progress is kept in a status table.
+#
+#               The GUI shows the table in FlashStationDialog.  From the
+#               command line:
+#
+#                   python FlashStation.py [--differential] [--manifest] FILE.hex [PORT ...]
+#
+#               If no ports are given, every bootloader port is used.
+#----------------------------------------------------------------------------
+
+from Globals import *
+import threading
+import os
+
+#
+# Unit states
+#
+UNIT_WAITING = 'waiting'
+UNIT_CONNECTING = 'connecting'
+UNIT_DONE = 'done'
+UNIT_FAILED = 'failed'
+
+#
+# Parse a firmware file into the image string that is shared by every
+# unit.
+#
+def loadImage(fileName):
+    import FirmwareCache
+    return FirmwareCache.loadFirmware(fileName).toByteString()
+
+#
+# Returns the serial ports that have a x0xb0x in bootload mode on them.
+# Ports that are links to the same device (e.g. /dev/serial/by-id names)
+# are only returned once, so that no unit is flashed twice at once.
+#
+def findBootloaderPorts(portNames = None):
+    import SerialDiscovery
+
+    if portNames == None:
+        portNames = SerialDiscovery.listSerialPorts()
+
+    devices = {}
+    for portName in portNames:
+        device = os.path.realpath(portName)
+        if device not in devices:
+            devices[device] = portName
+    portNames = devices.values()
+    portNames.sort()
+
+    found = SerialDiscovery.discoverX0xb0x(portNames)
+    return [portName for portName in portNames
+            if found.get(portName) == SerialDiscovery.X0XB0X_BOOTLOADER_MODE]
+
+
+#
+# Flashes one unit.  'callback(unit)' is called from the worker thread
+# whenever the state or progress of the unit changes.
+#
+class FlashUnit(threading.Thread):
+    def __init__(self, portName, image, verify = True, differential = False, callback = None, manifest = None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.portName = portName
+        self.image = image
+        self.verify = verify
+        self.differential = differential
+        self.manifest = manifest
+        self.callback = callback
+
+        self.state = UNIT_WAITING
+        self.phase = ''
+        self.percent = 0
+        self.message = ''
+        self.summary = ''
+
+    def run(self):
+        import serial
+        import AvrProgram
+        import FlashMetrics
+
+        metrics = FlashMetrics.FlashMetrics()
+        metrics.RegisterListener(self, 'ALL')
+
+        serialconnection = None
+        try:
+            try:
+                self.setState(UNIT_CONNECTING)
+                serialconnection = serial.Serial(self.portName, DEFAULT_BAUD_RATE)
+                if not AvrProgram.findAVRBoard(serialconnection):
+                    raise AvrProgram.AVRException, 'No x0xb0x bootloader found'
+
+                AvrProgram.doFlashProgramming(serialconnection, self.image, verify = self.verify,
+                                              differential = self.differential, manifest = self.manifest,
+                                              metrics = metrics)
+                self.summary = metrics.summary()
+                self.setState(UNIT_DONE, self.summary)
+
+            except AvrProgram.AVRException, e:
+                self.setState(UNIT_FAILED, str(e.value))
+            except Exception, e:
+                # Serial errors, and anything else, only fail this unit
+                self.setState(UNIT_FAILED, str(e))
+        finally:
+            if serialconnection:
+                serialconnection.close()
+
+    def setState(self, state, message = ''):
+        self.state = state
+        self.message = message
+        if state == UNIT_DONE:
+            self.percent = 100
+        self.changed()
+
+    def changed(self):
+        if self.callback:
+            self.callback(self)
+
+    #
+    # Progress reports from the FlashMetrics of this unit.
+    #
+    def NotificationCallback(self, metrics):
+        if metrics.phase == None:
+            return
+        self.phase = metrics.phase
+        if metrics.pagesTotal > 0:
+            self.percent = metrics.pagesDone * 100 / metrics.pagesTotal
+        else:
+            self.percent = 0
+        self.message = '%.0f bytes/s' % metrics.bytesPerSecond()
+        if metrics.fastMode == False:
+            self.message += ' (slow mode)'
+        if metrics.retries > 0:
+            self.message += ', %d retries' % metrics.retries
+        self.changed()
+
+    def isFinished(self):
+        return self.state in (UNIT_DONE, UNIT_FAILED)
+
+
+class FlashStation:
+    #
+    # 'image' is the firmware as a string, e.g. from
+    # IntelHexFile.toByteString().  'callback(unit)' is called whenever a
+    # unit changes, from that unit's worker thread.  'manifest' is a
+    # FlashManifest that all the units share, if any.
+    #
+    def __init__(self, image, portNames, verify = True, differential = False, callback = None, manifest = None):
+        self.image = str(image)
+        self.units = [FlashUnit(portName, self.image, verify, differential, callback, manifest)
+                      for portName in portNames]
+
+    def start(self):
+        for unit in self.units:
+            unit.start()
+
+    def isFinished(self):
+        for unit in self.units:
+            if not unit.isFinished():
+                return False
+        return True
+
+    def wait(self, timeout = None):
+        for unit in self.units:
+            unit.join(timeout)
+
+    def failedUnits(self):
+        return [unit for unit in self.units if unit.state == UNIT_FAILED]
+
+    #
+    # Returns the status of every unit as a list of (port, state, phase,
+    # percent, message) rows.
+    #
+    def statusTable(self):
+        return [(unit.portName, unit.state, unit.phase, unit.percent, unit.message)
+                for unit in self.units]
+
+    def statusText(self):
+        lines = []
+        for (portName, state, phase, percent, message) in self.statusTable():
+            if state in (UNIT_DONE, UNIT_FAILED):
+                phase = ''
+            lines.append('%-28s %-10s %-8s %3d%%  %s' % (portName, state, phase, percent, message))
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import optparse
+
+    parser = optparse.OptionParser(usage = '%prog [options] FILE.hex [PORT ...]')
+    parser.add_option('--differential', action = 'store_true', default = False,
+                      help = 'only erase and write the pages that have changed')
+    parser.add_option('--manifest', action = 'store_true', default = False,
+                      help = 'use the flash manifest of each unit to find the changed pages')
+    parser.add_option('--no-verify', dest = 'verify', action = 'store_false', default = True,
+                      help = 'do not read the programmed pages back')
+    (options, args) = parser.parse_args()
+    if len(args) < 1:
+        parser.error('a hex file is required')
+
+    image = loadImage(args[0])
+
+    if len(args) > 1:
+        portNames = args[1:]
+    else:
+        portNames = findBootloaderPorts()
+    if len(portNames) == 0:
+        print 'No x0xb0xes in bootload mode were found.'
+        sys.exit(1)
+
+    manifest = None
+    if options.manifest:
+        import FlashManifest
+        manifest = FlashManifest.FlashManifest()
+
+    station = FlashStation(image, portNames, options.verify, options.differential, manifest = manifest)
+    start = time.time()
+    station.start()
+    while not station.isFinished():
+        time.sleep(1.0)
+        print station.statusText()
+        print
+    station.wait()
+
+    print station.statusText()
+    print '%d units flashed in %.1fs, %d failed' % (len(station.units), time.time() - start,
+                                                   len(station.failedUnits()))
+    if len(station.failedUnits()) > 0:
+        sys.exit(1)
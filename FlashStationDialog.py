@@ -0,0 +1,136 @@
+#----------------------------------------------------------------------------
+# Name:         FlashStationDialog.py
+# Purpose:      The dialog box of the flashing station (see
+#               FlashStation.py).  It finds the x0xb0xes in bootload
+#               mode, flashes them all at once and shows a table with
+#               the progress of each unit.  The main window imports this
+#               module when the dialog is first opened.
+#----------------------------------------------------------------------------
+
+from Globals import *
+import wx
+import FlashStation
+
+ID_FLASH_STATION_START = wx.NewId()
+ID_FLASH_STATION_RESCAN = wx.NewId()
+
+COLUMN_PORT = 0
+COLUMN_STATE = 1
+COLUMN_PHASE = 2
+COLUMN_PROGRESS = 3
+COLUMN_MESSAGE = 4
+
+class FlashStationDialog(wx.Dialog):
+    def __init__(self, parent, fileName):
+        wx.Dialog.__init__(self, parent, -1, 'Flashing Station - ' + fileName, size = (640, 360),
+                           style = wx.DEFAULT_DIALOG_STYLE | wx.RESIZE_BORDER)
+        self.image = FlashStation.loadImage(fileName)
+        self.station = None
+
+        self.unitList = wx.ListCtrl(self, -1, style = wx.LC_REPORT | wx.LC_SINGLE_SEL)
+        self.unitList.InsertColumn(COLUMN_PORT, 'Port', width = 180)
+        self.unitList.InsertColumn(COLUMN_STATE, 'State', width = 80)
+        self.unitList.InsertColumn(COLUMN_PHASE, 'Phase', width = 70)
+        self.unitList.InsertColumn(COLUMN_PROGRESS, 'Progress', width = 70)
+        self.unitList.InsertColumn(COLUMN_MESSAGE, 'Details', width = 220)
+
+        self.statusText = wx.StaticText(self, -1, '')
+        self.rescanButton = wx.Button(self, ID_FLASH_STATION_RESCAN, 'Find Units')
+        self.startButton = wx.Button(self, ID_FLASH_STATION_START, 'Flash All')
+        self.closeButton = wx.Button(self, wx.ID_CANCEL, 'Close')
+
+        buttonSizer = wx.BoxSizer(wx.HORIZONTAL)
+        buttonSizer.Add(self.statusText, 1, wx.ALIGN_CENTER_VERTICAL | wx.ALL, 5)
+        buttonSizer.Add(self.rescanButton, 0, wx.ALL, 5)
+        buttonSizer.Add(self.startButton, 0, wx.ALL, 5)
+        buttonSizer.Add(self.closeButton, 0, wx.ALL, 5)
+
+        sizer = wx.BoxSizer(wx.VERTICAL)
+        sizer.Add(self.unitList, 1, wx.EXPAND | wx.ALL, 5)
+        sizer.Add(buttonSizer, 0, wx.EXPAND)
+        self.SetSizer(sizer)
+
+        self.Bind(wx.EVT_BUTTON, self.HandleButtonAction, self.rescanButton)
+        self.Bind(wx.EVT_BUTTON, self.HandleButtonAction, self.startButton)
+        self.Bind(wx.EVT_BUTTON, self.HandleButtonAction, self.closeButton)
+        self.Bind(wx.EVT_CLOSE, self.OnClose)
+
+        self.FindUnits()
+
+    def HandleButtonAction(self, event):
+        if event.GetId() == ID_FLASH_STATION_RESCAN:
+            self.FindUnits()
+        elif event.GetId() == ID_FLASH_STATION_START:
+            self.StartFlashing()
+        elif event.GetId() == wx.ID_CANCEL:
+            if not self.IsFlashing():
+                event.Skip()
+
+    #
+    # The units keep programming their chips after the dialog has gone,
+    # and the main window could open their ports again, so the dialog
+    # stays open until every unit has finished.
+    #
+    def OnClose(self, event):
+        if self.IsFlashing():
+            if event.CanVeto():
+                event.Veto()
+                return
+            self.station.wait()
+        event.Skip()
+
+    def IsFlashing(self):
+        return (self.station != None) and not self.station.isFinished()
+
+    def FindUnits(self):
+        self.statusText.SetLabel('Looking for x0xb0xes in bootload mode...')
+        wx.SafeYield()
+
+        self.portNames = FlashStation.findBootloaderPorts()
+        self.unitList.DeleteAllItems()
+        for portName in self.portNames:
+            row = self.unitList.InsertStringItem(self.unitList.GetItemCount(), portName)
+            self.unitList.SetStringItem(row, COLUMN_STATE, FlashStation.UNIT_WAITING)
+
+        self.statusText.SetLabel(str(len(self.portNames)) + ' units found.')
+        self.startButton.Enable(len(self.portNames) > 0)
+
+    def StartFlashing(self):
+        self.rescanButton.Enable(False)
+        self.startButton.Enable(False)
+        self.closeButton.Enable(False)
+        self.statusText.SetLabel('Flashing...')
+
+        #
+        # The units report from their worker threads, so the table is
+        # updated in the GUI thread.
+        #
+        self.station = FlashStation.FlashStation(self.image, self.portNames,
+                                                 callback = self.UnitChanged)
+        self.station.start()
+
+    def UnitChanged(self, unit):
+        wx.CallAfter(self.UpdateUnit, unit)
+
+    def UpdateUnit(self, unit):
+        #
+        # The dialog may have been closed while the units were flashing.
+        #
+        if not self or not self.station:
+            return
+
+        row = self.station.units.index(unit)
+        phase = unit.phase
+        if unit.isFinished():
+            phase = ''
+        self.unitList.SetStringItem(row, COLUMN_STATE, unit.state)
+        self.unitList.SetStringItem(row, COLUMN_PHASE, phase)
+        self.unitList.SetStringItem(row, COLUMN_PROGRESS, str(unit.percent) + '%')
+        self.unitList.SetStringItem(row, COLUMN_MESSAGE, unit.message)
+
+        if self.station.isFinished():
+            failed = len(self.station.failedUnits())
+            self.statusText.SetLabel('Finished: ' + str(len(self.station.units) - failed) + ' flashed, ' +
+                                     str(failed) + ' failed.')
+            self.rescanButton.Enable(True)
+            self.closeButton.Enable(True)
@@ -47,6 +47,19 @@ SYNCMSG_OUT = 'Sync Out'
 SYNCMSG_IN_MIDI = 'MIDI Sync In'
 SYNCMSG_IN_DIN = 'DIN Sync In'
 
+#
+# Sync sources, as sent in the Set Sync message (see docs/serial_protocol.txt)
+#
+SYNC_NONE = 0x00
+SYNC_MIDI_IN = 0x01
+SYNC_MIDI_OUT = 0x02
+SYNC_DIN_IN = 0x03
+SYNC_DIN_OUT = 0x04
+
+SYNC_Dict = {SYNCMSG_OUT     : SYNC_NONE,
+             SYNCMSG_IN_MIDI : SYNC_MIDI_IN,
+             SYNCMSG_IN_DIN  : SYNC_DIN_IN }
+
 
 #
 # Note and pattern related constants
@@ -75,6 +88,11 @@ MIDI_Dict = {'C'   : 0x17,
              'B'   : 0x22,
              'C\'' : 0x23 }
 
+#
+# The other way round: the name of each note value.
+#
+MIDI_Names = dict([(value, name) for (name, value) in MIDI_Dict.items()])
+
 
 
 #
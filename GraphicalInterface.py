@@ -41,8 +41,9 @@
 from Globals import *
 import wx
 
+import StartupTimer
+import FlashMetrics
 from PatternEditGrid import PatternEditGrid
-from PatternPlayGrid import PatternPlayGrid
 
 
 DEFAULT_MAINWINDOW_SIZE = (600, 450)
@@ -65,6 +66,7 @@ ID_EDIT_SHIFTR = wx.NewId()
 ID_EDIT_SHIFTL = wx.NewId()
 
 ID_X0XB0X_UPLOAD_FIRMWARE = wx.NewId()
+ID_X0XB0X_FLASH_STATION = wx.NewId()
 ID_X0XB0X_DUMP_EEPROM = wx.NewId()
 ID_X0XB0X_RESTORE_EEPROM = wx.NewId()
 ID_X0XB0X_ERASE_EEPROM = wx.NewId()
@@ -130,6 +132,14 @@ class MainWindow(wx.Frame):
         #
         wx.InitAllImageHandlers()
 
+        #
+        # The global parameters section is built after the first paint
+        # (see OnFirstPaint), so its controls do not exist yet.
+        #
+        self.tempoText = None
+        self.tempoSlider = None
+        self.isX0xb0xEnabled = False
+
         #
         # Initialize various components of the GUI
         #
@@ -149,8 +159,23 @@ class MainWindow(wx.Frame):
         #
         # Once everything has been set up, show the frame.
         #
+        self.Bind(wx.EVT_PAINT, self.OnFirstPaint)
         self.Show(True)
 
+    #
+    # Called when the main window is painted for the first time.  Anything
+    # that isn't needed to draw the pattern editor (the secondary panels
+    # and the serial port discovery) is deferred until this point so that
+    # the window appears as quickly as possible.
+    #
+    def OnFirstPaint(self, event):
+        event.Skip()
+        self.Unbind(wx.EVT_PAINT)
+        StartupTimer.mark(StartupTimer.STARTUP_FIRST_PAINT)
+
+        wx.CallAfter(self.SetupGlobalParameters)
+        wx.CallAfter(self.controller.discoverSerialPorts)
+
 
     #---------------------------------------------------------------------
     #
@@ -306,6 +331,10 @@ class MainWindow(wx.Frame):
         #                       divider2.GetPosition()[1]+5))
         #label2.SetFont(biglabelfont)
 
+        # The pattern play grid should be imported when this section is
+        # built rather than at the top of this file:
+        #
+        #from PatternPlayGrid import PatternPlayGrid
         #self.patternPlayGrid = PatternPlayGrid(self)
 
         # Man, couldnt you put this in the widget -- ada
@@ -337,6 +366,24 @@ class MainWindow(wx.Frame):
         #                                style = (wx.TE_PROCESS_ENTER),
         #                                validator = textValidator)
 
+        #
+        # Use some sizers to help keep everything in the window nicely proportioned
+        # if the window is resized.
+        #
+        self.sizer = wx.BoxSizer(wx.VERTICAL)
+#        self.sizer.Add(self.splitter, 1, wx.EXPAND)
+        self.SetSizer(self.sizer)
+        self.SetAutoLayout(1)
+
+    #---------------------------------------------------------------------
+    #
+    # Set up the global parameters section at the bottom of the main
+    # window.  This is called once the main window has been painted.
+    #
+    def SetupGlobalParameters(self):
+        biglabelfont = wx.Font(14, wx.TELETYPE, wx.NORMAL, wx.NORMAL, faceName = "Courier")
+        labelfont = wx.Font(11, wx.DEFAULT, wx.NORMAL, wx.NORMAL)
+
         divider3 = wx.StaticLine(self, -1, pos = (15,self.pe_SaveButton.GetPosition()[1]+50), size = (569,1),
                                 style = wx.LI_HORIZONTAL)
         label3 = wx.StaticText(self, -1, "Global Parameters",
@@ -390,14 +437,8 @@ class MainWindow(wx.Frame):
 
         #self.controller.setSync(self.syncChoice.GetString(self.syncChoice.GetSelection()))
 
-        #
-        # Use some sizers to help keep everything in the window nicely proportioned
-        # if the window is resized.
-        #
-        self.sizer = wx.BoxSizer(wx.VERTICAL)
-#        self.sizer.Add(self.splitter, 1, wx.EXPAND)
-        self.SetSizer(self.sizer)
-        self.SetAutoLayout(1)
+        if not self.isX0xb0xEnabled:
+            self.tempoSlider.Disable()
 
     #---------------------------------------------------------------------
     #
@@ -422,6 +463,7 @@ class MainWindow(wx.Frame):
         
         self.x0xmenu = wx.Menu()
         self.x0xmenu.Append(ID_X0XB0X_UPLOAD_FIRMWARE, "Upload firmware...\tCTRL-U", "Upload a new .HEX file to the x0xb0x firmware")
+        self.x0xmenu.Append(ID_X0XB0X_FLASH_STATION, "Flashing station...", "Upload a .HEX file to every x0xb0x in bootload mode at once")
         self.x0xmenu.AppendSeparator()
         self.x0xmenu.Append(ID_X0XB0X_DUMP_EEPROM, "Backup EEPROM", "Backup EEPROM to the hard disk")
         self.x0xmenu.Append(ID_X0XB0X_RESTORE_EEPROM, "Restore EEPROM", "Restore EEPROM from a backup on the hard drive")
@@ -460,6 +502,7 @@ class MainWindow(wx.Frame):
         wx.EVT_MENU(self, ID_X0XB0X_REFRESH_SERIAL, self.HandleMenuAction)
         wx.EVT_MENU(self, ID_X0XB0X_PING, self.HandleMenuAction)
         wx.EVT_MENU(self, ID_X0XB0X_UPLOAD_FIRMWARE, self.HandleMenuAction)
+        wx.EVT_MENU(self, ID_X0XB0X_FLASH_STATION, self.HandleMenuAction)
         wx.EVT_MENU(self, ID_X0XB0X_DUMP_EEPROM, self.HandleMenuAction)
         wx.EVT_MENU(self, ID_X0XB0X_RESTORE_EEPROM, self.HandleMenuAction)
         wx.EVT_MENU(self, ID_X0XB0X_ERASE_EEPROM, self.HandleMenuAction)
@@ -550,6 +593,32 @@ class MainWindow(wx.Frame):
             self.controller.displayModalStatusError("Please select a bank and location")
             return False
 
+    #
+    # Look for a x0xb0x on all of the serial ports and connect to it.  The
+    # selected port is used if it has a x0xb0x attached, otherwise the
+    # selection is switched to the port the x0xb0x was found on.  Returns
+    # true if a x0xb0x was found, false otherwise.
+    #
+    def ConnectX0xb0x(self):
+        print "Connecting..."
+        port = self.controller.findX0xb0xPort()
+        if port == None:
+            return False
+
+        self.controller.selectSerialPort(port)
+        self.controller.updateSelectedSerialPort(port)
+        if self.controller.openSerialPort():
+            if self.controller.sendPing():
+                self.controller.connectSerialPort()
+                self.statusBar.SetStatusText("Found x0xb0x", 0)
+                self.controller.readTempo()
+                self.x0xb0xEnable()
+                return True
+            else:
+                self.controller.closeSerialPort()
+                self.statusBar.SetStatusText("Did not find x0xb0x", 0)
+        return False
+
 #---------------------------------------------------------------------------
 # UTILITY CLASSES (classes that are used by the main GUI class above)
 #
@@ -574,7 +643,9 @@ class MainWindow(wx.Frame):
         self.editmenu.Enable(ID_EDIT_PASTE, True)
         self.editmenu.Enable(ID_EDIT_SHIFTR, True)
         self.editmenu.Enable(ID_EDIT_SHIFTL, True)
-        self.tempoSlider.Enable()
+        if self.tempoSlider:
+            self.tempoSlider.Enable()
+        self.isX0xb0xEnabled = True
         
     def x0xb0xDisable(self):
         self.x0xmenu.Enable(ID_X0XB0X_DUMP_EEPROM, False)
@@ -593,7 +664,9 @@ class MainWindow(wx.Frame):
         self.editmenu.Enable(ID_EDIT_PASTE, False)
         self.editmenu.Enable(ID_EDIT_SHIFTR, False)
         self.editmenu.Enable(ID_EDIT_SHIFTL, False)
-        self.tempoSlider.Disable()
+        if self.tempoSlider:
+            self.tempoSlider.Disable()
+        self.isX0xb0xEnabled = False
     #
     # ====================== Actions ============================
     #
@@ -687,27 +760,17 @@ class MainWindow(wx.Frame):
 
         elif event.GetId() == ID_EDIT_SHIFTR:
             tmp = self.patternEditGrid.getPattern()
-            tmp.shift(-1)
+            tmp.rotate(1)
             self.patternEditGrid.update(tmp)
             self.pe_SaveButton.Enable()
         elif event.GetId() == ID_EDIT_SHIFTL:
             tmp = self.patternEditGrid.getPattern()
-            tmp.shift(1)
+            tmp.rotate(-1)
             self.patternEditGrid.update(tmp)
             self.pe_SaveButton.Enable()
 
         elif event.GetId() == ID_X0XB0X_CONNECT:
-            print "Connecting..."
-            if self.controller.openSerialPort():
-                if self.controller.sendPing():
-                    self.controller.connectSerialPort()
-                    self.statusBar.SetStatusText("Found x0xb0x", 0)
-                    self.controller.readTempo()
-                    self.x0xb0xEnable()
-                else:
-                    self.controller.closeSerialPort()
-                    self.statusBar.SetStatusText("Did not find x0xb0x", 0)
-
+            self.ConnectX0xb0x()
 
         elif event.GetId() == ID_X0XB0X_DISCONNECT:
             print "Disconnecting..."
@@ -717,8 +780,11 @@ class MainWindow(wx.Frame):
             
         elif event.GetId() == ID_X0XB0X_RECONNECT_SERIAL:
             print "Reconnecting"
-            self.controller.closeSerialPort()
-            self.controller.openSerialPort()
+            if self.controller.reconnectSerialPort():
+                self.statusBar.SetStatusText("Reconnected to x0xb0x", 0)
+                self.x0xb0xEnable()
+            else:
+                self.x0xb0xDisable()
 
         elif event.GetId() == ID_X0XB0X_PING:
             self.controller.sendPing()
@@ -740,6 +806,27 @@ class MainWindow(wx.Frame):
                     errorDialog.ShowModal()
 
 
+        elif event.GetId() == ID_X0XB0X_FLASH_STATION:
+            d = wx.FileDialog(self, 'Choose a x0xb0x firmware file', style = wx.FD_OPEN, wildcard = "HEX files (*.hex)|*.hex|All files (*.*)|*.*")
+            d.ShowModal()
+            if len(d.GetPath()) != 0:
+                #
+                # The flashing station opens the serial ports itself.
+                #
+                import FlashStationDialog
+                self.controller.closeSerialPort()
+                self.x0xb0xDisable()
+                try:
+                    dialog = FlashStationDialog.FlashStationDialog(self, d.GetPath())
+                    dialog.ShowModal()
+                    dialog.Destroy()
+                except Exception, e:
+                    errorDialog = wx.MessageDialog(self,
+                                                  message = 'The following exception occured while starting the flashing station:\n\nException: ' + str(e),
+                                                  caption = 'Flashing Station Error',
+                                                  style = wx.OK)
+                    errorDialog.ShowModal()
+
         elif event.GetId() == ID_X0XB0X_DUMP_EEPROM:
             #
             # Dump eeprom
@@ -774,6 +861,41 @@ class MainWindow(wx.Frame):
         elif event.GetId() >= ID_SERIAL_PORT:
             self.controller.selectSerialPort(self.portMenu.GetLabel(event.GetId()))
 
+# -------------------------------------------------------
+#
+# FLASH PROGRESS DIALOG
+#
+# Listens to a FlashMetrics and shows the progress of each programming
+# phase.  The dialog goes away once programming has finished.
+#
+
+class FlashProgressDialog:
+    def __init__(self, parent, metrics):
+        self.dialog = wx.ProgressDialog('Uploading Firmware', 'Connecting to the x0xb0x...', 100, parent,
+                                        style = wx.PD_APP_MODAL | wx.PD_ELAPSED_TIME)
+        metrics.RegisterListener(self, 'ALL')
+
+    def NotificationCallback(self, metrics):
+        if self.dialog == None:
+            return
+
+        if metrics.event == FlashMetrics.FINISHED:
+            self.dialog.Destroy()
+            self.dialog = None
+            return
+
+        message = metrics.phase.capitalize()
+        percent = 0
+        if metrics.pagesTotal > 0:
+            message += ': %d of %d pages' % (metrics.pagesDone, metrics.pagesTotal)
+            percent = min(99, metrics.pagesDone * 100 / metrics.pagesTotal)
+        message += ', %.0f bytes/s' % metrics.bytesPerSecond()
+        if metrics.fastMode == False:
+            message += ' (slow mode)'
+        if metrics.retries > 0:
+            message += ', %d retries' % metrics.retries
+        self.dialog.Update(percent, message)
+
 # -------------------------------------------------------
 #
 # VALIDATOR CLASS
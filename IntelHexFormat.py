@@ -24,8 +24,13 @@
 #
 
 
-import string
 import binascii
+import bisect
+
+DATA_RECORD = 0x00
+EOF_RECORD = 0x01
+EXTENDED_SEGMENT_RECORD = 0x02
+EXTENDED_LINEAR_RECORD = 0x04
 
 class IntelHexFile:
     """
@@ -44,75 +49,286 @@ class IntelHexFile:
 
     returns a string of hexadecimal numbers more suitable for
     being read by people.
-    """
 
-    dataRecordString = '00'
-    eofRecordString = '01'
-    extendedSegmentRecordString = '02'
-    extendedLinearRecordString = '04'
+    The file is loaded in a single pass with readRecords (see
+    below), and the data of each record is copied straight into a
+    SparseImage, so only the address ranges that the file actually
+    contains take up memory.
+
+    IntelHexFormat.IntelHexFile('MyHexFile.hex').writeFile('Copy.hex')
+
+    writes the image back out with writeIntelHex.
+    """
 
     def __init__(self, fileName):
-        self.numberOfBytes = 0
         self.fileName = fileName
+        self.image = SparseImage()
+
         file = open(self.fileName,'r')
-        self.records = []
-        line=file.readline()
-        while line:
-            self.records.append(IntelHexFileRecord(line))
-            if self.records[-1].startAddress + self.records[-1].recordLength > self.numberOfBytes:
-                self.numberOfBytes = self.records[-1].startAddress + self.records[-1].recordLength
-            line=file.readline()
-
-        # Meme - testing
-        self.numberOfBytes = 32768
-        file.close()
+        try:
+            for (address, data) in readRecords(file):
+                self.image.write(address, data)
+        finally:
+            file.close()
+
+        #
+        # The address just past the last byte of data in the file.
+        #
+        self.numberOfBytes = self.image.endAddress()
 
     def toHexArray(self, size=None, startAddress=0):
         "This method returns an array of hex strings as they would appear in memory."
 
-        if size is None:
-            size = self.numberOfBytes
-        hexArray = ['ff']*self.numberOfBytes
-        if size>0:
-            for record in self.records:
-                if record.recordType == self.dataRecordString:
-                    for i in range(record.recordLength):
-                        hexArray[record.startAddress + i] = record.dataBytes[2*i:2*i+2]
-        else:
-            print '   Warning: size is zero or negative.'
-        return hexArray[startAddress:startAddress+size]
+        hexString = self.toHexString(size, startAddress)
+        return [hexString[i:i+2] for i in range(0, len(hexString), 2)]
 
     def toHexString(self, size=None, startAddress=0):
         "This method returns a single hex string as they would appear in memory."
 
-        if size is None:
-            size = self.numberOfBytes
-        hexArray = self.toHexArray(size, startAddress)
-        hexString = ''
-        for hexByte in hexArray:
-            hexString = hexString + hexByte
-        return hexString
+        return binascii.b2a_hex(self.toByteString(size, startAddress))
 
     def toByteString(self, size=None, startAddress=0):
         "This method returns a single string of bytes as they would appear in memory."
 
         if size is None:
-            size = self.numberOfBytes
-        hexString = self.toHexString(size, startAddress)
-        return binascii.a2b_hex(hexString)
-        
-class IntelHexFileRecord:
-    "A class for representing a single record (line) in an Intel hex file."
-    
-    def __init__(self, line):
-        if line[0] == ':':
-            self.recordLength = int(line[1:3],16)
-            self.startAddress = int(line[3:7],16)
-            self.recordType = line[7:9]
-            self.dataBytes = line[9:9+2*self.recordLength]
-            self.checksum = int(line[9+2*self.recordLength:2+9+2*self.recordLength],16)
-        else:
-            print '   ERROR.  The following record is malformed:'
-            print line
+            size = self.numberOfBytes - startAddress
+        return str(self.image.read(startAddress, size))
+
+    def page(self, address, pageSize):
+        "This method returns a memoryview of one page of the image."
+
+        return self.image.page(address, pageSize)
+
+    def pages(self, pageSize):
+        "This method yields (address, memoryview) for every page that contains data."
+
+        for address in self.image.pageAddresses(pageSize):
+            yield (address, self.image.page(address, pageSize))
+
+    def writeFile(self, fileName, recordSize=16):
+        "This method writes the image to an Intel hex file."
+
+        file = open(fileName, 'w')
+        try:
+            writeIntelHex(file, self.image, recordSize)
+        finally:
+            file.close()
+
+
+def readRecords(file):
+    """
+    Reads Intel hex records from the file object 'file' one line at a
+    time, and yields (address, data) for each data record, where data
+    is a bytearray.  Nothing else is kept, so any size of file can be
+    read in constant memory.
+
+    Each record is decoded with binascii.unhexlify and its length and
+    checksum are verified.  Extended segment (02) and extended linear
+    (04) address records are supported.  Reading stops at the end of
+    file (01) record.
+    """
+
+    baseAddress = 0
+    lineNumber = 0
+    for line in file:
+        lineNumber += 1
+        line = line.strip()
+        if not line:
+            continue
+        if line[0] != ':':
+            raise IntelHexException('Line ' + str(lineNumber) + ' is not an Intel hex record: ' + line)
+
+        try:
+            record = bytearray(binascii.unhexlify(line[1:]))
+        except (TypeError, binascii.Error), e:
+            raise IntelHexException('Line ' + str(lineNumber) + ' contains invalid hex digits: ' + line)
+
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise IntelHexException('Line ' + str(lineNumber) + ' has the wrong length: ' + line)
+        if sum(record) & 0xFF != 0:
+            raise IntelHexException('Line ' + str(lineNumber) + ' has a bad checksum: ' + line)
+
+        recordLength = record[0]
+        recordType = record[3]
+        if recordType == DATA_RECORD:
+            yield (baseAddress + (record[1] << 8) + record[2], record[4:4 + recordLength])
+        elif recordType == EXTENDED_SEGMENT_RECORD:
+            baseAddress = ((record[4] << 8) + record[5]) << 4
+        elif recordType == EXTENDED_LINEAR_RECORD:
+            baseAddress = ((record[4] << 8) + record[5]) << 16
+        elif recordType == EOF_RECORD:
+            break
+
+
+def formatRecord(recordType, address, data):
+    "Returns one Intel hex record, with its checksum, as a line of text."
+
+    record = bytearray([len(data), (address >> 8) & 0xFF, address & 0xFF, recordType])
+    record += data
+    record.append(-sum(record) & 0xFF)
+    return ':' + binascii.hexlify(record).upper() + '\n'
+
+
+def writeIntelHex(file, image, recordSize=16, startAddress=0):
+    """
+    Writes 'image' to the file object 'file' as Intel hex records of
+    'recordSize' (normally 16 or 32) data bytes, followed by an end of
+    file record.
+
+    'image' is either a SparseImage, or a string or bytearray holding
+    the memory from 'startAddress' on.  Each line is written as soon as
+    it is made, so any size of image can be written in constant memory.
+    Records never cross a 64K boundary, and an extended linear address
+    (04) record is written whenever the upper 16 bits of the address
+    change.
+    """
+
+    if recordSize < 1 or recordSize > 255:
+        raise IntelHexException('Record size must be between 1 and 255 bytes')
+
+    if isinstance(image, SparseImage):
+        segments = image.segments()
+    else:
+        segments = [(startAddress, memoryview(image))]
+
+    upperAddress = 0
+    for (base, data) in segments:
+        offset = 0
+        while offset < len(data):
+            address = base + offset
+            if (address >> 16) != upperAddress:
+                upperAddress = address >> 16
+                file.write(formatRecord(EXTENDED_LINEAR_RECORD, 0, bytearray([upperAddress >> 8, upperAddress & 0xFF])))
+
+            size = min(recordSize, len(data) - offset, 0x10000 - (address & 0xFFFF))
+            file.write(formatRecord(DATA_RECORD, address & 0xFFFF, data[offset:offset + size].tobytes()))
+            offset += size
+
+    file.write(formatRecord(EOF_RECORD, 0, ''))
+
+
+class SparseImage:
+    """
+    A sparse memory image.  The image is kept as a sorted list of
+    segments, each of which is a base address and a bytearray of
+    data.  Writes that touch or overlap existing segments are
+    coalesced with them, so there is never more than one segment
+    covering any address and there are never two adjacent segments.
+    Reads of addresses that hold no data return the fill byte (0xFF,
+    the value of erased flash).
+    """
+
+    def __init__(self, fill=0xFF):
+        self.fill = fill
+        self._bases = []
+        self._segments = []
+
+    def write(self, address, data):
+        if len(data) == 0:
+            return
+        end = address + len(data)
+
+        #
+        # Intel hex files are almost always in address order, so check
+        # for an append to the last segment first.
+        #
+        if self._bases and (self._bases[-1] + len(self._segments[-1]) == address):
+            self._segments[-1].extend(data)
+            return
+
+        #
+        # Find the segments that overlap or touch [address, end).
+        #
+        first = bisect.bisect_right(self._bases, address) - 1
+        if first < 0 or self._bases[first] + len(self._segments[first]) < address:
+            first += 1
+        last = first
+        while last < len(self._bases) and self._bases[last] <= end:
+            last += 1
+
+        if first == last:
+            self._bases.insert(first, address)
+            self._segments.insert(first, bytearray(data))
+            return
+
+        newBase = min(address, self._bases[first])
+        newEnd = max(end, self._bases[last - 1] + len(self._segments[last - 1]))
+        merged = bytearray(chr(self.fill)) * (newEnd - newBase)
+        for i in range(first, last):
+            offset = self._bases[i] - newBase
+            merged[offset:offset + len(self._segments[i])] = self._segments[i]
+        merged[address - newBase:end - newBase] = data
+
+        self._bases[first:last] = [newBase]
+        self._segments[first:last] = [merged]
+
+    def read(self, address, size):
+        "Returns a bytearray of 'size' bytes starting at 'address'."
+
+        result = bytearray(chr(self.fill)) * size
+        end = address + size
+        i = max(0, bisect.bisect_right(self._bases, address) - 1)
+        while i < len(self._bases) and self._bases[i] < end:
+            base = self._bases[i]
+            segment = self._segments[i]
+            start = max(address, base)
+            stop = min(end, base + len(segment))
+            if start < stop:
+                result[start - address:stop - address] = segment[start - base:stop - base]
+            i += 1
+        return result
+
+    def page(self, address, pageSize):
+        """
+        Returns a memoryview of 'pageSize' bytes starting at 'address'.
+        If a single segment holds the whole page, this does not copy.
+        """
+
+        i = bisect.bisect_right(self._bases, address) - 1
+        if i >= 0 and address + pageSize <= self._bases[i] + len(self._segments[i]):
+            offset = address - self._bases[i]
+            return memoryview(self._segments[i])[offset:offset + pageSize]
+        return memoryview(self.read(address, pageSize))
+
+    def segments(self):
+        "Yields (base address, memoryview) for each segment, in address order."
+
+        for i in range(len(self._bases)):
+            yield (self._bases[i], memoryview(self._segments[i]))
+
+    def ranges(self):
+        "Returns a list of (start, end) address ranges that hold data."
+
+        return [(self._bases[i], self._bases[i] + len(self._segments[i])) for i in range(len(self._bases))]
+
+    def pageAddresses(self, pageSize):
+        "Returns the sorted start addresses of every page that holds data."
+
+        pages = []
+        for (start, end) in self.ranges():
+            page = start - (start % pageSize)
+            if pages and pages[-1] >= page:
+                page = pages[-1] + pageSize
+            while page < end:
+                pages.append(page)
+                page += pageSize
+        return pages
+
+    def endAddress(self):
+        "Returns the address just past the last byte of data."
+
+        if not self._bases:
+            return 0
+        return self._bases[-1] + len(self._segments[-1])
+
+    def dataSize(self):
+        "Returns the number of bytes of data held in the image."
+
+        return sum([len(segment) for segment in self._segments])
 
 
+class IntelHexException(Exception):
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
@@ -57,46 +57,332 @@
 #               any data is published by the Notification Center,
 #               regardless of its key.
 #
+#               Listeners are indexed by key, so publishing only looks
+#               at the listeners for that key plus the wildcard ones, and
+#               registering and unregistering take constant time.  The
+#               notification center only holds weak references to its
+#               listeners: a listener that is no longer referenced
+#               anywhere else (e.g. a closed window) is dropped
+#               automatically, so whoever creates a listener must keep a
+#               reference to it for as long as it should be notified.
+#               Listeners for a key are notified in the order they
+#               registered, followed by the wildcard listeners.
+#
+#               NotifyListeners() calls the listeners straight away, on
+#               the publisher's thread.  A center can also deliver
+#               asynchronously (see EnableAsyncDelivery()): then
+#               PostNotification() only puts the data on the center's
+#               queue and returns at once, and the queue is drained
+#               later by DispatchPending(), either from a dispatcher
+#               thread or from the GUI thread (e.g. with wx.CallAfter).
+#               Only the last value posted for each key is kept until it
+#               is delivered, and when the queue is full the oldest
+#               entry is dropped, so a slow listener never holds up the
+#               publisher.  Each listener gets everything queued for it
+#               in one batch: NotificationBatchCallback(notifications)
+#               is called with a list of (key, data) pairs if the
+#               listener has it, otherwise NotificationCallback(data) is
+#               called for each of them.  The time from posting to
+#               delivery is counted for each listener (see
+#               ListenerLatency()).
+#
 # author:       Michael Broxton and Josh Lifton
 #
 # Created:      A long time ago, in a galaxy far, far away...
 # Copyright:    (c) 2004 by MIT Media Laboratory
 #----------------------------------------------------------------------------
 
+import threading
+import time
+import traceback
+import weakref
+from collections import OrderedDict
+
+WILDCARD_KEY = 'ALL'
+
+#
+# The number of keys that can be waiting for asynchronous delivery before
+# the oldest is dropped.
+#
+DEFAULT_MAX_PENDING = 64
+
+#
+# Posting-to-delivery times of the asynchronous notifications received
+# by one listener.
+#
+class LatencyStats:
+    def __init__(self):
+        self.batches = 0
+        self.notifications = 0
+        self.totalLatency = 0.0
+        self.maxLatency = 0.0
+
+    def add(self, latency):
+        self.notifications += 1
+        self.totalLatency += latency
+        if latency > self.maxLatency:
+            self.maxLatency = latency
+
+    def meanLatency(self):
+        if self.notifications == 0:
+            return 0.0
+        return self.totalLatency / self.notifications
+
+    def __str__(self):
+        return '%d notifications in %d batches, mean %.1fms, max %.1fms' % (
+            self.notifications, self.batches, self.meanLatency() * 1000, self.maxLatency * 1000)
+
 class NotificationCenter:
     def __init__(self):
         #
-        # Create an empty list
+        # Listeners for each key, and wildcard listeners.  Each one maps
+        # id(listener) to a weak reference to the listener.
         #
-        self._listeners = []  
+        self._listeners = {}
+        self._wildcardListeners = OrderedDict()
+
+        #
+        # Asynchronous delivery.  '_pending' maps each key to the last
+        # (data, time first posted) that is waiting to be delivered.
+        #
+        self._asyncDelivery = False
+        self._pending = OrderedDict()
+        self._pendingLock = threading.Lock()
+        self._maxPending = DEFAULT_MAX_PENDING
+        self._wakeup = None
+        self._dispatcher = None
+        self._latency = weakref.WeakKeyDictionary()
+        self.droppedNotifications = 0
+
+    def _listenersFor(self, key, create = False):
+        if key == WILDCARD_KEY:
+            return self._wildcardListeners
+        listeners = self._listeners.get(key)
+        if listeners == None and create:
+            listeners = self._listeners[key] = OrderedDict()
+        return listeners
 
     #
     # Register the object 'listener' with this notification center for the
     # notification 'key'.
     #
     def RegisterListener(self, listener, key):
-        newTuple = (listener, key)
-        if newTuple not in self._listeners:
-            self._listeners.append(newTuple)
+        listeners = self._listenersFor(key, True)
+        ident = id(listener)
+        if ident in listeners:
+            return
+
+        #
+        # Drop the listener as soon as it is garbage collected.  The id
+        # is only removed if it still belongs to this (dead) listener.
+        #
+        center = weakref.ref(self)
+        def listenerDied(ref):
+            if center() != None:
+                listeners = center()._listenersFor(key)
+                if listeners != None and listeners.get(ident) is ref:
+                    center()._removeListener(key, ident)
+
+        listeners[ident] = weakref.ref(listener, listenerDied)
 
     #
     # Unregister the object 'listener' with this notification center for the
     # notification 'key'.
     #
     def UnregisterListener(self, listener, key):
-        newTuple = (listener, key)
-        if newTuple in self._listeners:
-            self._listeners.remove(newTuple)
+        listeners = self._listenersFor(key)
+        if listeners != None and id(listener) in listeners:
+            self._removeListener(key, id(listener))
 
+    def _removeListener(self, key, ident):
+        listeners = self._listenersFor(key)
+        del listeners[ident]
+        if key != WILDCARD_KEY and len(listeners) == 0:
+            del self._listeners[key]
 
     #
     # Notify all currently registered listeners that new data is
-    # available.  Each listener is checked to see if this listener is
-    # concerned with this particular piece of data.  This check is
-    # accomplished using the data key.  A data key of 'ALL' will
-    # ensure that the listener receives all data notifications.
+    # available.  Only the listeners registered for 'publisherKey' and
+    # the wildcard listeners (key 'ALL') are notified.  The listeners
+    # are copied first, so a listener may register or unregister
+    # listeners from its callback.
     #
     def NotifyListeners(self, data, publisherKey):
-        for x in self._listeners:
-            if (x[1] == 'ALL') or (x[1] == publisherKey):
-                (x[0]).NotificationCallback(data)
+        refs = []
+        listeners = self._listeners.get(publisherKey)
+        if listeners:
+            refs.extend(listeners.values())
+        if self._wildcardListeners:
+            refs.extend(self._wildcardListeners.values())
+
+        for ref in refs:
+            listener = ref()
+            if listener is not None:
+                listener.NotificationCallback(data)
+
+    #
+    # Switch this center to asynchronous delivery.  At most 'maxPending'
+    # keys are queued.  'wakeup()' is called (from the publisher's
+    # thread) whenever the queue stops being empty; it must not block,
+    # and should arrange for DispatchPending() to be called, e.g.
+    #
+    #     center.EnableAsyncDelivery(wakeup = lambda: wx.CallAfter(center.DispatchPending))
+    #
+    # Use StartDispatcher() instead to drain the queue from a thread of
+    # its own.
+    #
+    def EnableAsyncDelivery(self, maxPending = DEFAULT_MAX_PENDING, wakeup = None):
+        self._maxPending = maxPending
+        self._wakeup = wakeup
+        self._asyncDelivery = True
+
+    #
+    # Queue 'data' for the listeners of 'publisherKey' and return
+    # straight away.  Data already waiting for the same key is replaced.
+    # If asynchronous delivery is not enabled the listeners are notified
+    # at once, as by NotifyListeners().
+    #
+    def PostNotification(self, data, publisherKey):
+        if not self._asyncDelivery:
+            self.NotifyListeners(data, publisherKey)
+            return
+
+        self._pendingLock.acquire()
+        try:
+            wasEmpty = (len(self._pending) == 0)
+            entry = self._pending.get(publisherKey)
+            if entry != None:
+                # Keep the time of the first undelivered post
+                self._pending[publisherKey] = (data, entry[1])
+            else:
+                if len(self._pending) >= self._maxPending:
+                    self._pending.popitem(False)
+                    self.droppedNotifications += 1
+                self._pending[publisherKey] = (data, time.time())
+        finally:
+            self._pendingLock.release()
+
+        if wasEmpty and self._wakeup != None:
+            self._wakeup()
+
+    #
+    # Deliver everything on the queue, one batch per listener.  This is
+    # called from whichever thread the listeners expect to be called
+    # on.  Returns the number of notifications taken off the queue.
+    #
+    def DispatchPending(self):
+        self._pendingLock.acquire()
+        try:
+            pending = self._pending
+            self._pending = OrderedDict()
+        finally:
+            self._pendingLock.release()
+        if len(pending) == 0:
+            return 0
+
+        #
+        # Sort the notifications out by listener, keeping the order they
+        # were posted in.
+        #
+        batches = OrderedDict()
+        for (key, (data, posted)) in pending.items():
+            refs = []
+            listeners = self._listeners.get(key)
+            if listeners:
+                refs.extend(listeners.items())
+            if self._wildcardListeners:
+                refs.extend(self._wildcardListeners.items())
+            for (ident, ref) in refs:
+                if ident not in batches:
+                    batches[ident] = (ref, [])
+                batches[ident][1].append((key, data, posted))
+
+        for (ref, batch) in batches.values():
+            listener = ref()
+            if listener is None:
+                continue
+            #
+            # The queue has already been emptied, so a broken listener
+            # must not stop the others getting their notifications.
+            #
+            try:
+                if hasattr(listener, 'NotificationBatchCallback'):
+                    listener.NotificationBatchCallback([(key, data) for (key, data, posted) in batch])
+                else:
+                    for (key, data, posted) in batch:
+                        listener.NotificationCallback(data)
+            except Exception, e:
+                print 'Notification listener ' + repr(listener) + ' failed: ' + str(e)
+                traceback.print_exc()
+
+            now = time.time()
+            latency = self._latency.get(listener)
+            if latency == None:
+                latency = self._latency[listener] = LatencyStats()
+            latency.batches += 1
+            for (key, data, posted) in batch:
+                latency.add(now - posted)
+
+        return len(pending)
+
+    def PendingCount(self):
+        return len(self._pending)
+
+    #
+    # Returns the LatencyStats of 'listener', or None if nothing has
+    # been delivered to it asynchronously yet.
+    #
+    def ListenerLatency(self, listener):
+        return self._latency.get(listener)
+
+    #
+    # Drain the queue from a thread of its own, rather than having the
+    # caller do it.  This enables asynchronous delivery if it is not
+    # enabled already.
+    #
+    def StartDispatcher(self, maxPending = None):
+        if self._dispatcher != None:
+            return
+        if maxPending == None:
+            maxPending = self._maxPending
+        self._dispatcher = NotificationDispatcher(self)
+        self.EnableAsyncDelivery(maxPending, self._dispatcher.wakeup)
+        self._dispatcher.start()
+
+    def StopDispatcher(self):
+        if self._dispatcher == None:
+            return
+        dispatcher = self._dispatcher
+        self._dispatcher = None
+        self._wakeup = None
+        dispatcher.stop()
+        if dispatcher != threading.currentThread():
+            dispatcher.join()
+
+
+#
+# The thread started by NotificationCenter.StartDispatcher().  It sleeps
+# until something is posted, then delivers it.
+#
+class NotificationDispatcher(threading.Thread):
+    def __init__(self, center):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.center = center
+        self.event = threading.Event()
+        self.running = True
+
+    def wakeup(self):
+        self.event.set()
+
+    def stop(self):
+        self.running = False
+        self.event.set()
+
+    def run(self):
+        while self.running:
+            self.event.wait()
+            self.event.clear()
+            if not self.running:
+                break
+            self.center.DispatchPending()
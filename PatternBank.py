@@ -0,0 +1,208 @@
+#----------------------------------------------------------------------------
+# Name:         PatternBank.py
+# Purpose:      The whole pattern memory of a x0xb0x as one array, for
+#               editing every pattern at once.  The memory is held as a
+#               NUMBER_OF_BANKS * LOCATIONS_PER_BANK by NOTES_IN_PATTERN
+#               numpy array of note bytes, one row per pattern, in the
+#               order the x0xb0x stores them (see
+#               PatternFile.patternMemoryAddress).  The array is a view
+#               of a bytearray, so EEPROM images go in and come out
+#               without being copied.
+#
+#               The notes can be decoded into planes (arrays of the same
+#               shape holding the note numbers, accents, slides and
+#               transposes), and transposing, accent thinning and
+#               rotation work on every pattern in a bank, or in the
+#               whole memory, in a single array expression.
+#
+#               Banks and locations are numbered from 0 here, as in the
+#               pattern memory, and from 1 in pattern files.
+#
+#               This module needs numpy.
+#----------------------------------------------------------------------------
+
+from Globals import *
+from PatternFile import PATTERN_MEMORY_SIZE, ENTRY_SIZE
+from pattern import Pattern, internPattern, DECODE_TABLE, REST_NOTE, NULL_NOTE, NOTE_MASK, ACCENT_MASK, SLIDE_MASK, \
+     transposeTable
+import numpy
+
+PATTERN_COUNT = NUMBER_OF_BANKS * LOCATIONS_PER_BANK
+
+#
+# DECODE_TABLE as arrays, one for each plane.
+#
+NOTE_TABLE = numpy.array([note for (note, accent, slide, transpose) in DECODE_TABLE], numpy.uint8)
+ACCENT_TABLE = numpy.array([accent for (note, accent, slide, transpose) in DECODE_TABLE], numpy.bool_)
+SLIDE_TABLE = numpy.array([slide for (note, accent, slide, transpose) in DECODE_TABLE], numpy.bool_)
+TRANSPOSE_TABLE = numpy.array([transpose for (note, accent, slide, transpose) in DECODE_TABLE], numpy.int8)
+
+#
+# Makes rest bytes canonical, as pattern.REST_TABLE does.
+#
+REST_TABLE = numpy.arange(256, dtype = numpy.uint8)
+REST_TABLE[(REST_TABLE & NOTE_MASK) == REST_NOTE] = REST_NOTE
+
+class PatternBank:
+    #
+    # 'image' is a pattern memory image (PATTERN_MEMORY_SIZE bytes).  If
+    # it is a bytearray and 'copy' is False, the bank works on that
+    # bytearray itself.  Without an image, every pattern is empty.
+    #
+    def __init__(self, image = None, copy = True):
+        if image is None:
+            image = bytearray(chr(NULL_NOTE) * PATTERN_MEMORY_SIZE)
+        elif copy or not isinstance(image, bytearray):
+            image = bytearray(image)
+        if len(image) != PATTERN_MEMORY_SIZE:
+            raise PatternBankException('Pattern memory image is the wrong size.')
+
+        self.memory = image
+        self.patterns = numpy.frombuffer(self.memory, numpy.uint8).reshape(PATTERN_COUNT, NOTES_IN_PATTERN)
+
+    #
+    # The rows of the patterns in 'bank', for use as the 'rows' of the
+    # transforms below.  All the transforms default to every pattern.
+    #
+    def bankRows(self, bank):
+        return slice(bank * LOCATIONS_PER_BANK, (bank + 1) * LOCATIONS_PER_BANK)
+
+    def row(self, bank, loc):
+        return bank * LOCATIONS_PER_BANK + loc
+
+    #
+    # Single patterns.  These are copies: changing the Pattern does not
+    # change the bank.
+    #
+    def pattern(self, bank, loc):
+        return Pattern.fromByteString(bytearray(self.patterns[self.row(bank, loc)].tobytes()), False)
+
+    def setPattern(self, bank, loc, pattern):
+        self.patterns[self.row(bank, loc)] = numpy.frombuffer(pattern.toBuffer(), numpy.uint8)
+
+    #
+    # Every pattern, in memory order.  Identical patterns (e.g. the empty
+    # ones) share one interned, frozen Pattern.
+    #
+    def toPatterns(self):
+        return [internPattern(Pattern.fromByteString(bytearray(self.memory[i:i + NOTES_IN_PATTERN]), False))
+                for i in range(0, PATTERN_MEMORY_SIZE, NOTES_IN_PATTERN)]
+
+    #
+    # EEPROM images.  toEEPROMImage() returns a copy; the 'memory'
+    # bytearray is the image itself.
+    #
+    def toEEPROMImage(self):
+        return str(self.memory)
+
+    #
+    # Pattern files.  Entries without a location (bank or location 0)
+    # are ignored.  toPatternFile() writes every pattern, in memory
+    # order.
+    #
+    def fromPatternFile(self, patternFile):
+        if patternFile.numEntries() == 0:
+            return
+        entries = numpy.frombuffer(''.join(patternFile.entries), numpy.uint8).reshape(-1, ENTRY_SIZE)
+
+        banks = entries[:, 0].astype(numpy.int32)
+        locs = entries[:, 1].astype(numpy.int32)
+        valid = (banks >= 1) & (banks <= NUMBER_OF_BANKS) & (locs >= 1) & (locs <= LOCATIONS_PER_BANK)
+        rows = (banks[valid] - 1) * LOCATIONS_PER_BANK + (locs[valid] - 1)
+        self.patterns[rows] = entries[valid, 2:]
+
+    def toPatternFile(self):
+        import PatternFile
+        entries = numpy.empty((PATTERN_COUNT, ENTRY_SIZE), numpy.uint8)
+        entries[:, 0] = numpy.arange(PATTERN_COUNT) // LOCATIONS_PER_BANK + 1
+        entries[:, 1] = numpy.arange(PATTERN_COUNT) % LOCATIONS_PER_BANK + 1
+        entries[:, 2:] = self.patterns
+
+        data = entries.tobytes()
+        pf = PatternFile.PatternFile()
+        pf.entries = [data[i:i + ENTRY_SIZE] for i in range(0, len(data), ENTRY_SIZE)]
+        return pf
+
+    #
+    # The number of notes in each pattern.
+    #
+    def lengths(self, rows = slice(None)):
+        ends = (self.patterns[rows] == NULL_NOTE)
+        return numpy.where(ends.any(1), ends.argmax(1), NOTES_IN_PATTERN)
+
+    #
+    # True for each slot that holds a note (or rest) of its pattern.
+    #
+    def noteSlots(self, rows = slice(None)):
+        return numpy.arange(NOTES_IN_PATTERN) < self.lengths(rows)[:, numpy.newaxis]
+
+    #
+    # Make the bytes canonical, as Pattern does: rests are 0x00 and the
+    # slots after the end of each pattern are NULL_NOTE.
+    #
+    def normalize(self, rows = slice(None)):
+        patterns = REST_TABLE[self.patterns[rows]]
+        patterns[~self.noteSlots(rows)] = NULL_NOTE
+        self.patterns[rows] = patterns
+
+    #
+    # Returns the (notes, accents, slides, transposes) planes of the
+    # patterns.  Slots after the end of a pattern are rests.
+    #
+    def planes(self, rows = slice(None)):
+        patterns = self.patterns[rows]
+        slots = self.noteSlots(rows)
+        notes = numpy.where(slots, NOTE_TABLE[patterns], REST_NOTE).astype(numpy.uint8)
+        return (notes,
+                ACCENT_TABLE[patterns] & slots,
+                SLIDE_TABLE[patterns] & slots,
+                numpy.where(slots, TRANSPOSE_TABLE[patterns], TRANSPOSE_NONE).astype(numpy.int8))
+
+    #
+    # Write the planes back.  The lengths of the patterns stay the same;
+    # notes that can't be played become rests, as in pattern.noteByte.
+    #
+    def setPlanes(self, notes, accents, slides, transposes, rows = slice(None)):
+        notes = numpy.asarray(notes, numpy.int32)
+        rawnotes = notes + 12 * numpy.asarray(transposes, numpy.int32)
+        playable = (notes >= BOTTOM_NOTE) & (notes <= TOP_NOTE)
+        rawnotes |= numpy.where(accents, ACCENT_MASK, 0)
+        rawnotes |= numpy.where(slides, SLIDE_MASK, 0)
+        rawnotes = numpy.where(playable, rawnotes, REST_NOTE)
+        self.patterns[rows] = numpy.where(self.noteSlots(rows), rawnotes, NULL_NOTE)
+
+    #
+    # Transforms
+    #
+    def transpose(self, semitones, rows = slice(None)):
+        table = numpy.frombuffer(transposeTable(semitones), numpy.uint8)
+        self.patterns[rows] = table[self.patterns[rows]]
+
+    #
+    # Keep only every 'every'th accent of each pattern (the first, the
+    # 'every'+1th, ...) and drop the others.
+    #
+    def thinAccents(self, every, rows = slice(None)):
+        patterns = self.patterns[rows]
+        accents = ACCENT_TABLE[patterns] & self.noteSlots(rows)
+        counts = accents.cumsum(1)
+        drop = accents & ((counts - 1) % every != 0)
+        self.patterns[rows] = numpy.where(drop, patterns & (0xFF & ~ACCENT_MASK), patterns)
+
+    #
+    # Rotate each pattern by 'amount' steps within its own length, as
+    # Pattern.rotate() does.
+    #
+    def rotate(self, amount, rows = slice(None)):
+        patterns = self.patterns[rows]
+        lengths = numpy.maximum(self.lengths(rows), 1)[:, numpy.newaxis]
+        steps = numpy.arange(NOTES_IN_PATTERN)[numpy.newaxis, :]
+        sources = numpy.where(steps < lengths, (steps - amount) % lengths, steps)
+        self.patterns[rows] = patterns[numpy.arange(len(patterns))[:, numpy.newaxis], sources]
+
+
+class PatternBankException(Exception):
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
@@ -1,6 +1,6 @@
 import wx
 from Globals import *
-from pattern import Pattern
+from pattern import Pattern, DECODE_TABLE
 import wx.grid as gridlib
 from binascii import b2a_hex
 
@@ -373,31 +373,29 @@ class PatternEditGrid(gridlib.Grid):
             self.SetCellValue(EFFECT_ROW, i, '')
 
         for i in range(0, pattern.length()):
-            if pattern.note(i).note != REST_NOTE:
+            (note, accent, slide, transpose) = DECODE_TABLE[pattern.data[i]]
+            if note != REST_NOTE:
 
-                noteName = ''
-                for j in MIDI_Dict.keys():
-                    if pattern.note(i).note == MIDI_Dict[j]:
-                        noteName = j
+                noteName = MIDI_Names.get(note, '')
                 #
                 # Meme - for debugging
                 #
                 if noteName == '':
-                    print 'WARNING -- no note name found in dictionary for note ' + str(i) + '.  Value was ' + hex(pattern.note(i).note)
+                    print 'WARNING -- no note name found in dictionary for note ' + str(i) + '.  Value was ' + hex(note)
 
                 self.SetCellValue(NOTE_ROW, i, noteName)
                 self.SetCellValue(GRAPHIC_ROW, i, '1')
 
                 efx = ''
-                if pattern.note(i).accent:
+                if accent:
                     self.toggleEffect('A', i)
 
-                if pattern.note(i).slide:
+                if slide:
                     self.toggleEffect('S', i)
 
-                if pattern.note(i).transpose == TRANSPOSE_UP:
+                if transpose == TRANSPOSE_UP:
                     self.toggleEffect('U', i)
-                elif pattern.note(i).transpose == TRANSPOSE_DOWN:
+                elif transpose == TRANSPOSE_DOWN:
                     self.toggleEffect('D', i)
 
     def getPattern(self):
@@ -34,12 +34,31 @@
 
 from Globals import *
 from binascii import a2b_hex, b2a_hex
-from pattern import Pattern
+from pattern import Pattern, NULL_NOTE, internPattern
 
 
 FILE_VERSION = 100
 ENTRY_SIZE = 18
 
+#
+# The x0xb0x stores its patterns one after another in memory, bank by
+# bank, NOTES_IN_PATTERN bytes each.
+#
+PATTERN_MEMORY_SIZE = NUMBER_OF_BANKS * LOCATIONS_PER_BANK * NOTES_IN_PATTERN
+
+def patternMemoryAddress(bank, loc):
+    return (bank * LOCATIONS_PER_BANK + loc) * NOTES_IN_PATTERN
+
+#
+# Pattern file entries number the banks and locations from 1, as the
+# front panel does; (0, 0) means the pattern has no location.  Returns
+# the entry's memory address, or None.
+#
+def entryMemoryAddress(bank, loc):
+    if bank < 1 or bank > NUMBER_OF_BANKS or loc < 1 or loc > LOCATIONS_PER_BANK:
+        return None
+    return patternMemoryAddress(bank - 1, loc - 1)
+
 class PatternFile:
 
     def __init__(self):
@@ -97,11 +116,42 @@ class PatternFile:
         locByte = a2b_hex( (str('%02x' % loc)))
         self.entries.append(bankByte + locByte + pattern.toByteString())
         
+    #
+    # Returns the patterns in this file laid out as they are in the
+    # x0xb0x's pattern memory.  Slots that are not in the file are left
+    # empty, and so are entries without a location.
+    #
+    def toEEPROMImage(self):
+        image = bytearray(chr(NULL_NOTE) * PATTERN_MEMORY_SIZE)
+        for entry in self.entries:
+            addr = entryMemoryAddress(ord(entry[0]), ord(entry[1]))
+            if addr != None:
+                image[addr:addr + NOTES_IN_PATTERN] = entry[2:ENTRY_SIZE]
+        return str(image)
+
+    #
+    # Replace the patterns in this file with every pattern in an image of
+    # the x0xb0x's pattern memory.
+    #
+    def fromEEPROMImage(self, image):
+        if len(image) != PATTERN_MEMORY_SIZE:
+            raise PatternFileException('Pattern memory image is the wrong size.')
+
+        self.clearAllPatterns()
+        for bank in range(NUMBER_OF_BANKS):
+            for loc in range(LOCATIONS_PER_BANK):
+                addr = patternMemoryAddress(bank, loc)
+                self.entries.append(chr(bank + 1) + chr(loc + 1) + image[addr:addr + NOTES_IN_PATTERN])
+
+    #
+    # Returns the next [bank, loc, pattern] entry.  Identical patterns
+    # share one interned Pattern, which is frozen: copy() it to change it.
+    #
     def getNextPattern(self):
         if self.currentEntry < len(self.entries):
             bank = int( b2a_hex(self.entries[self.currentEntry][0]), 16 )
             loc = int( b2a_hex(self.entries[self.currentEntry][1]), 16 )
-            pattern = Pattern(self.entries[self.currentEntry][2:ENTRY_SIZE])
+            pattern = internPattern(Pattern(self.entries[self.currentEntry][2:ENTRY_SIZE]))
             
             self.currentEntry += 1;
 
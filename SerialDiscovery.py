@@ -0,0 +1,231 @@
+#----------------------------------------------------------------------------
+# Name:         SerialDiscovery.py
+# Purpose:      Locates x0xb0xes on the serial ports of this machine.
+#               Every candidate port is probed at the same time (one
+#               thread per port), so discovery takes a single probe
+#               timeout no matter how many USB-serial adapters are
+#               plugged in.  A port is first pinged using the c0ntr0l
+#               serial protocol, which finds x0xb0xes that are running
+#               their application.  If that fails, the AVR109 'S'
+#               (identify) query is sent to find x0xb0xes that are in
+#               bootload mode.
+#
+#               This file also contains the serial port watcher, which
+#               keeps the list of serial ports up to date as USB-serial
+#               adapters are plugged in and unplugged.
+#----------------------------------------------------------------------------
+
+from Globals import *
+from communication import DataLink
+import threading
+import time
+import glob
+import os
+
+X0XB0X_APP_MODE = 'app'
+X0XB0X_BOOTLOADER_MODE = 'bootloader'
+
+#
+# How long to wait for a reply to each probe, and how much longer than
+# that to give a port to open before it is given up on (some Bluetooth
+# serial ports block for a long time when they are opened).
+#
+PROBE_TIMEOUT = 0.25
+PROBE_OPEN_ALLOWANCE = 0.5
+
+#
+# Probe a single serial port.  Returns X0XB0X_APP_MODE or
+# X0XB0X_BOOTLOADER_MODE if a x0xb0x answered, or None if nothing did.
+#
+def probeSerialPort(portName, timeout = PROBE_TIMEOUT):
+    import serial
+    import AvrProgram
+
+    try:
+        serialconnection = serial.Serial(portName, DEFAULT_BAUD_RATE, timeout = timeout)
+    except serial.SerialException, e:
+        return None
+
+    try:
+        try:
+            if DataLink(serialconnection).sendPingMessage(timeout):
+                return X0XB0X_APP_MODE
+
+            serialconnection.flushInput()
+            if AvrProgram.probeBootloader(serialconnection, timeout) != None:
+                return X0XB0X_BOOTLOADER_MODE
+        except Exception, e:
+            print 'Exception occured while probing ' + portName + ': ' + str(e)
+        return None
+    finally:
+        serialconnection.close()
+
+#
+# Probe all of the ports in 'portNames' concurrently.  Returns a
+# dictionary that maps the name of every port that has a x0xb0x attached
+# to the mode the x0xb0x is in (X0XB0X_APP_MODE or X0XB0X_BOOTLOADER_MODE).
+#
+def discoverX0xb0x(portNames, timeout = PROBE_TIMEOUT):
+    results = {}
+
+    def probe(portName):
+        results[portName] = probeSerialPort(portName, timeout)
+
+    threads = []
+    for portName in portNames:
+        thread = threading.Thread(target = probe, args = (portName,))
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+
+    #
+    # A ping and an identify query are sent to each port, so allow for two
+    # probe timeouts.  Ports that still haven't finished by then are
+    # ignored.
+    #
+    deadline = time.time() + 2 * timeout + PROBE_OPEN_ALLOWANCE
+    for thread in threads:
+        thread.join(max(0, deadline - time.time()))
+
+    found = {}
+    for portName in portNames:
+        if results.get(portName) != None:
+            found[portName] = results[portName]
+
+    print 'Found x0xb0x on the following serial ports: ' + str(found)
+    return found
+
+
+#
+# The serial port device names that are searched for on posix systems.
+# /dev/serial/by-id contains stable, per-adapter names for USB-serial
+# adapters on Linux.  They are links to the /dev/ttyUSB* and /dev/ttyACM*
+# devices, so each adapter is only listed once, under its by-id name.
+#
+POSIX_SERIAL_PORT_PATTERNS = ['/dev/cu.*',
+                              '/dev/tts/ttyUSB*',
+                              '/dev/ttyUSB*',
+                              '/dev/ttyACM*',
+                              '/dev/serial/by-id/*']
+
+PREFERRED_PORT_PREFIX = '/dev/serial/by-id/'
+
+#
+# Returns the names of the serial ports on this machine.
+#
+def listSerialPorts():
+    if os.name == 'nt':
+        return ['COM1', 'COM2', 'COM3', 'COM4', 'COM5', 'COM6', 'COM7', 'COM8', 'COM9', 'COM10']
+
+    #
+    # Map each device to the name it is listed under, keeping the order
+    # in which the devices were found.
+    #
+    devices = []
+    names = {}
+    for pattern in POSIX_SERIAL_PORT_PATTERNS:
+        for name in sorted(glob.glob(pattern)):
+            device = os.path.realpath(name)
+            if device not in names:
+                devices.append(device)
+                names[device] = name
+            elif name.startswith(PREFERRED_PORT_PREFIX) and not names[device].startswith(PREFERRED_PORT_PREFIX):
+                names[device] = name
+    return [names[device] for device in devices]
+
+#
+# Returns the name in 'ports' of the serial port 'name', or None if it is
+# not there.  The port may be listed under another name for the same
+# device, e.g. a /dev/ttyUSB* port saved by an older version is listed
+# under its /dev/serial/by-id name.
+#
+def findSerialPort(name, ports):
+    if name in ports:
+        return name
+    device = os.path.realpath(name)
+    for port in ports:
+        if os.path.realpath(port) == device:
+            return port
+    return None
+
+
+#
+# How often the watcher checks for new or removed serial ports, and how
+# often it rescans the ports even if none of the device directories
+# appear to have changed.
+#
+PORT_WATCH_INTERVAL = 0.5
+PORT_RESCAN_INTERVAL = 10.0
+
+#
+# The serial port watcher is a background thread that keeps a cached list
+# of the serial ports on this machine.  Rather than rescanning all of the
+# device names on every poll, it only rescans them when the modification
+# time of one of the device directories changes (which happens whenever a
+# device node is created or removed), or every PORT_RESCAN_INTERVAL
+# seconds in case the platform doesn't update them.
+#
+# Whenever the list changes, callback(ports, added, removed) is called
+# from the watcher thread with the new list of ports and the names of the
+# ports that appeared and disappeared.
+#
+class SerialPortWatcher(threading.Thread):
+    def __init__(self, callback, interval = PORT_WATCH_INTERVAL):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._callback = callback
+        self._interval = interval
+        self._want_abort = 0
+
+        self.ports = listSerialPorts()
+        self._directoryStamps = self.stampDirectories()
+        self._lastScanTime = time.time()
+
+    def run(self):
+        while not self._want_abort:
+            time.sleep(self._interval)
+            self.poll()
+
+    def abort(self):
+        self._want_abort = 1
+
+    #
+    # Returns the modification times of the directories that serial
+    # device nodes live in.
+    #
+    def stampDirectories(self):
+        stamps = []
+        for pattern in POSIX_SERIAL_PORT_PATTERNS:
+            directory = os.path.dirname(pattern)
+            try:
+                stamps.append(os.stat(directory).st_mtime)
+            except OSError, e:
+                stamps.append(None)
+        return stamps
+
+    #
+    # Check for changes to the list of serial ports, and call the callback
+    # if there are any.
+    #
+    def poll(self):
+        if os.name == 'nt':
+            return
+
+        stamps = self.stampDirectories()
+        if (stamps == self._directoryStamps and
+            time.time() - self._lastScanTime < PORT_RESCAN_INTERVAL):
+            return
+        self._directoryStamps = stamps
+        self._lastScanTime = time.time()
+
+        ports = listSerialPorts()
+        if ports == self.ports:
+            return
+
+        added = [name for name in ports if name not in self.ports]
+        removed = [name for name in self.ports if name not in ports]
+        self.ports = ports
+
+        print 'Serial ports added: ' + str(added) + ' removed: ' + str(removed)
+        if not self._want_abort:
+            self._callback(ports, added, removed)
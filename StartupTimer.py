@@ -0,0 +1,50 @@
+#----------------------------------------------------------------------------
+# Name:         StartupTimer.py
+# Purpose:      Records how long the c0ntr0l application takes to reach
+#               the milestones of its startup sequence (e.g. the first
+#               paint of the main window, or the first connection to a
+#               x0xb0x).  The clock starts when this module is first
+#               imported, so it should be imported before anything else
+#               in c0ntr0l.py.
+#----------------------------------------------------------------------------
+
+import time
+
+STARTUP_FIRST_PAINT = 'first paint'
+STARTUP_CONNECTED = 'connected'
+
+_startTime = time.time()
+_events = []
+
+#
+# Record that the startup milestone 'event' has been reached.  Only the
+# first occurrence of each milestone is recorded.  Returns the number of
+# seconds since the application was launched.
+#
+def mark(event):
+    if elapsed(event) != None:
+        return elapsed(event)
+
+    seconds = time.time() - _startTime
+    _events.append((event, seconds))
+    print 'Startup: ' + event + ' after ' + str('%.3f' % seconds) + 's'
+    return seconds
+
+#
+# Returns the number of seconds it took to reach the milestone 'event',
+# or None if it has not been reached yet.
+#
+def elapsed(event):
+    for (name, seconds) in _events:
+        if name == event:
+            return seconds
+    return None
+
+#
+# Returns a printable summary of all of the milestones reached so far.
+#
+def report():
+    lines = ['Startup budget:']
+    for (name, seconds) in _events:
+        lines.append('  ' + name.ljust(16) + str('%8.3f' % seconds) + 's')
+    return '\n'.join(lines)
@@ -33,8 +33,15 @@
 # Copyright:    (c) 2005
 #----------------------------------------------------------------------------
 
+#
+# The startup timer is imported first so that its clock includes the time
+# spent importing everything else.
+#
+import StartupTimer
+
 ## import all of the wxPython GUI package
 import wx
+import sys
 
 from Globals import *
 import model
@@ -71,6 +78,13 @@ class x0xc0ntr0l_App(wx.App):
     # view objects.
     #
     def OnInit(self):
+        #
+        # When run with --startup-benchmark, the application connects to the
+        # x0xb0x as soon as it has started up, prints the startup budget and
+        # quits.
+        #
+        self.startupBenchmark = ('--startup-benchmark' in sys.argv)
+
         # Create the controller, then the model and the view.
         c = controller.Controller(self)
 
@@ -94,6 +108,15 @@ class x0xc0ntr0l_App(wx.App):
         # Return a success flag
         return True
 
+    #
+    # Called by the controller once the main window has been painted and
+    # the serial ports have been discovered.
+    #
+    def RunStartupBenchmark(self):
+        self.v.mainWindow.ConnectX0xb0x()
+        print StartupTimer.report()
+        self.c.quitApp()
+
     def OnExit(self):
         # Save the configuration to file and exit.
 
@@ -6,6 +6,7 @@ from DataFidelity import crc8
 from Globals import *
 from pattern import Pattern
 import time
+import os
 
 #
 # Messages from the c0ntr0l software to the x0xb0x.
@@ -57,7 +58,7 @@ class DataLink:
             self.s.write(packetToSend)
         except Exception, e:
             print 'Exception occured in sendBasicPacket(): ' + str(e)
-            raise CommException('Error occured in sendBasicPacket()')
+            self.raiseCommException('Error occured in sendBasicPacket()')
 
     def getBasicPacket(self, timeout = DEFAULT_TIMEOUT) :
         try:
@@ -73,13 +74,39 @@ class DataLink:
             return packet
         except Exception, e:
             print 'Exception occured in getBasicPacket(): ' + str(e)
-            raise CommException('Error occured in getBasicPacket()')
+            self.raiseCommException('Error occured in getBasicPacket()')
 
     def packetWaiting(self):
         try:
             return self.s.inWaiting()
         except Exception, e:
-            raise CommException('Error occured in packetWaiting()')
+            self.raiseCommException('Error occured in packetWaiting()')
+
+    def flushInput(self):
+        try:
+            self.s.flushInput()
+        except Exception, e:
+            print 'Exception occured in flushInput(): ' + str(e)
+            self.raiseCommException('Error occured in flushInput()')
+
+    #
+    # Returns true if the serial port has gone away, e.g. because the
+    # USB-serial adapter was unplugged.  This can only be detected on posix
+    # systems, where the device node disappears from /dev.
+    #
+    def portLost(self):
+        if os.name == 'posix':
+            return not os.path.exists(self.s.portstr)
+        return False
+
+    #
+    # Raise a PortLostException if the serial port has gone away, or a
+    # plain CommException otherwise.
+    #
+    def raiseCommException(self, message):
+        if self.portLost():
+            raise PortLostException(message + ': serial port ' + self.s.portstr + ' was lost')
+        raise CommException(message)
 
     def getPushedPacket(self):
         # this is a packet that the x0x pushed without warning (tempo usually)
@@ -89,10 +116,10 @@ class DataLink:
         return None
         
 #----------------- Specific Packet Types ---------------------------------
-    def sendPingMessage(self):
-        self.s.flushInput()
+    def sendPingMessage(self, timeout = DEFAULT_TIMEOUT):
+        self.flushInput()
         self.sendBasicPacket(PING_MSG)
-        packet = self.getBasicPacket()
+        packet = self.getBasicPacket(timeout)
         if packet.isCorrect:
             packet.printMe()
             print "PACKET OK!";
@@ -106,7 +133,7 @@ class DataLink:
         #
         # Convert pattern to binary
         #
-        self.s.flushInput()
+        self.flushInput()
         self.sendBasicPacket(PLAY_PATTERN_MSG, content = pattern.toByteString())
         packet = self.getBasicPacket()
         if packet.isCorrect:
@@ -116,7 +143,7 @@ class DataLink:
             print 'Bad Packet!'
 
     def sendStopPatternMessage(self):
-        self.s.flushInput()
+        self.flushInput()
         self.sendBasicPacket(STOP_PATTERN_MSG)
         packet = self.getBasicPacket()
         if packet.isCorrect:
@@ -126,7 +153,7 @@ class DataLink:
             print 'Bad packet!'
             
     def sendReadPatternMessage(self, bank, loc):
-        self.s.flushInput()
+        self.flushInput()
         self.sendBasicPacket(READ_PATTERN_MSG, content = chr(bank) + chr(loc))
 
         packet = self.getBasicPacket()
@@ -149,15 +176,19 @@ class DataLink:
         #
         # Convert pattern to binary
         #
-        self.s.flushInput()
+        self.flushInput()
         self.sendBasicPacket(WRITE_PATTERN_MSG, content = chr(bank) + chr(loc) + pattern.toByteString())
 
+        #
+        # Returns true if the x0xb0x acknowledged the write.
+        #
         packet = self.getBasicPacket()
         if packet.isCorrect:
             packet.printMe()
         else:
             packet.printMe()
             print 'Bad Packet!'
+        return packet.isCorrect
 
     #
     # Sequencer run/stop control
@@ -201,17 +232,23 @@ class DataLink:
     # Sync and tempo messages
     #
     def sendSetSyncPacket(self, source) :
-        self.sendBasicPacket(SET_SYNC, content = [dec2hex(source)])
+        self.flushInput()
+
+        self.sendBasicPacket(SET_SYNC_MSG, content = chr(source))
         packet = self.getBasicPacket()
-        print packet
+        if packet.isCorrect:
+            print "PACKET OK!";
+        else:
+            packet.printMe()
+            print 'Bad packet!'
 
     def sendGetSyncPacket(self) :
-        self.sendBasicPacket(GET_SYNC)
+        self.sendBasicPacket(GET_SYNC_MSG)
         packet = self.getBasicPacket()
         print packet
 
     def sendGetTempoPacket(self) :
-        self.s.flushInput()
+        self.flushInput()
 
         self.sendBasicPacket(GET_TEMPO_MSG)
 
@@ -226,7 +263,7 @@ class DataLink:
             return 0
 
     def sendSetTempoPacket(self, tempo) :
-        self.s.flushInput()
+        self.flushInput()
 
         self.sendBasicPacket(SET_TEMPO_MSG, content = chr(tempo >> 8)+
                                                        chr(tempo & 0xFF))
@@ -259,6 +296,12 @@ class CommException(Exception):
     def __str__(self):
         return repr(self.value)
 
+#
+# Raised when the serial port disappears in the middle of a transfer.
+#
+class PortLostException(CommException):
+    pass
+
 class BadPacketException(Exception):
     def __init__(self, value):
         self.value = value
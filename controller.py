@@ -55,6 +55,11 @@ class Controller:
     #
     ##
 
+    def discoverSerialPorts(self):
+        self.model.discoverSerialPorts()
+        if self.app.startupBenchmark:
+            wx.CallAfter(self.app.RunStartupBenchmark)
+
     def sendPing(self):
         return self.model.runTest()
 
@@ -66,9 +71,15 @@ class Controller:
     
     def selectSerialPort(self, port):
         return self.model.selectSerialPort(port)
+
+    def findX0xb0xPort(self):
+        return self.model.findX0xb0xPort()
     
     def connectSerialPort(self):
         return self.model.connectSerialPort()
+
+    def reconnectSerialPort(self):
+        return self.model.reconnectSerialPort()
     
     def writePattern(self, pattern, bank, loc):
         return self.model.writePattern(pattern, bank, loc)
@@ -104,7 +115,7 @@ class Controller:
         return self.model.readTempo()
 
     def setSync(self, sync):
-        pass
+        return self.model.setSync(SYNC_Dict[sync])
 
     def uploadHexfile(self, filename):
         return self.model.uploadHexfile(filename)
@@ -117,6 +128,12 @@ class Controller:
     def updateSerialStatus(self, state):
         return self.view.updateSerialStatus(state)
     
+    def updateConnectionState(self, state):
+        return self.view.updateConnectionState(state)
+
+    def showFlashProgress(self, metrics):
+        return self.view.showFlashProgress(metrics)
+
     def updateSelectedSerialPort(self, name):
         return self.view.updateSelectedSerialPort(name)
         
@@ -1,18 +1,29 @@
 
 from Globals import *
-import serial
-import AvrProgram 
 from pattern import Pattern
-import IntelHexFormat
-import PatternFile
 from communication import *
+import StartupTimer
 import time
 from threading import *
 from binascii import a2b_hex
+from NotificationCenter import NotificationCenter
 
 import wx
 import os
-import glob
+
+#
+# How many times a pattern transfer is retried during a backup, restore or
+# erase job, and how long a job waits for a lost serial port to come back.
+#
+JOB_RETRIES = 3
+PORT_RECOVERY_TIMEOUT = 60.0
+PORT_RECOVERY_POLL_INTERVAL = 0.5
+
+#
+# Note that the serial, firmware (AvrProgram, FirmwareCache) and pattern
+# archive (PatternFile) modules are imported by the methods that use them
+# rather than here.  This keeps them off of the application's startup path.
+#
 
 class Model:
             
@@ -20,6 +31,32 @@ class Model:
         self.controller = controller
         self.serialconnection = None
         self.worker = None
+        self.portWatcher = None
+        self.isConnected = False
+        self.portLost = False
+        self.currentSerialPort = ''
+        self.serialPorts = []
+        self.commlock = False
+        self.jobRunning = False
+
+        #
+        # The last known state of the x0xb0x.  This is restored when the
+        # serial port is reconnected.  None means the state is unknown.
+        #
+        self.tempo = None
+        self.syncMode = None
+        self.playingPattern = None
+
+        #
+        # Packets pushed by the x0xb0x (e.g. tempo changes) are read by
+        # the worker thread, and handed over to the GUI thread through
+        # this queue, so the worker never waits for the window to be
+        # redrawn.  Only the latest tempo is shown if several arrive
+        # before the GUI gets to them.
+        #
+        self.pushedData = NotificationCenter()
+        self.pushedData.EnableAsyncDelivery(wakeup = self.pushedDataWaiting)
+        self.pushedData.RegisterListener(self, TEMPO_MSG)
 
     #
     # This function is called once the model, view, and controller have
@@ -27,37 +64,37 @@ class Model:
     # initialization code is carried out.
     #
     def initialize(self):
+        #
+        # Start with an empty active pattern
+        #
+        self.currentPattern = Pattern('')
+        self.controller.updateCurrentPattern(self.currentPattern)
+
+    #
+    # Discover the serial ports on this machine.  This is called by the
+    # view (through the controller) once the main window has been painted
+    # for the first time, so that it does not hold up application startup.
+    #
+    def discoverSerialPorts(self):
+        import SerialDiscovery
 
         #
         # We first have to discover the names of the serial ports.  The method for
         # doing this varies slightly from platform to platform.
         #
-        # Meme - Linux support has not yet been implemented here.
-        #
-	print "OS is "+os.name
-        if os.name == 'posix':
-            self.serialPorts = glob.glob('/dev/cu.*') + glob.glob('/dev/tts/ttyUSB*') + glob.glob('/dev/ttyUSB*')
-        elif os.name == 'nt':
-            self.serialPorts = ['COM1', 'COM2', 'COM3', 'COM4', 'COM5', 'COM6', 'COM7', 'COM8', 'COM9', 'COM10']
-
+        print "OS is "+os.name
+        self.serialPorts = SerialDiscovery.listSerialPorts()
         print "Found the following serial ports: "+str(self.serialPorts)
 
-
-        #
-        # Check to make sure there are valid serial ports.  If not, quit
-        # with an error message.
-        #
-        if len(self.serialPorts) == 0:
-            self.controller.displayModalStatusError('Error: The c0ntr0l application could not find any suitable serial ports.  Please check to make sure that you have one installed.')
-            self.controller.quitApp()
+        self.currentSerialPort = str(self.controller.GetConfigValue('serialport'))
+        if self.currentSerialPort == "" and len(self.serialPorts) > 0:
+            #
+            # No serial port found in the preference file.  Use the first
+            # port in the list.
+            #
+            self.currentSerialPort = self.serialPorts[0]
         else:
-            self.currentSerialPort = str(self.controller.GetConfigValue('serialport'))
-            if self.currentSerialPort == "":
-                #
-                # No serial port found in the preference file.  Use the first
-                # port in the list.
-                #
-                self.currentSerialPort = self.serialPorts[0]
+            self.findCurrentSerialPort()
 
         #
         # Update the menu names in the GUI to reflect the serial port
@@ -70,20 +107,83 @@ class Model:
             #
             self.controller.updateSelectedSerialPort(self.currentSerialPort)
         else:
-            self.controller.updateStatusText("Error: Previously selected serial port not available.  Please select a new port.")
+            #
+            # The port watcher will pick up any adapters that are plugged in
+            # later, so there is no need to quit here.  The previously
+            # selected port is reopened if its device comes back.
+            #
+            if len(self.serialPorts) == 0:
+                self.controller.updateStatusText('No serial ports found.  Please plug in your x0xb0x.')
+            else:
+                self.controller.updateStatusText("Error: Previously selected serial port not available.  Waiting for it to be plugged in, or please select a new port.")
             self.controller.updateSerialStatus(False);
-                
+            self.portLost = (self.currentSerialPort != "")
+
         #
-        # Start with an empty active pattern
+        # Watch for serial ports being added and removed from now on.
         #
-        self.currentPattern = Pattern('')
-        self.controller.updateCurrentPattern(self.currentPattern)
+        self.portWatcher = SerialDiscovery.SerialPortWatcher(self.serialPortsChanged)
+        self.portWatcher.start()
+
+    #
+    # Called by the port watcher thread when serial ports appear or
+    # disappear.  The real work is done in the GUI thread.
+    #
+    def serialPortsChanged(self, ports, added, removed):
+        wx.CallAfter(self.updateSerialPorts, ports, added, removed)
+
+    def updateSerialPorts(self, ports, added, removed):
+        if not self.controller:
+            return
+
+        self.serialPorts = ports
+        self.findCurrentSerialPort()
+        self.controller.updateSerialPortNames(self.serialPorts)
+        if self.currentSerialPort in self.serialPorts:
+            self.controller.updateSelectedSerialPort(self.currentSerialPort)
+
+        #
+        # A running pattern job recovers from a lost port by itself.
+        #
+        if self.jobRunning:
+            return
+
+        if self.isConnected and (self.currentSerialPort in removed):
+            #
+            # The x0xb0x we were talking to has been unplugged.  Close the
+            # port and remember to reopen it when the device comes back.
+            #
+            self.closeSerialPort()
+            self.portLost = True
+            self.controller.updateConnectionState(False)
+            self.controller.updateStatusText('The x0xb0x on ' + self.currentSerialPort + ' was unplugged.  Waiting for it to come back...')
+
+        elif self.portLost and (self.currentSerialPort in added):
+            self.portLost = False
+            if self.reconnectSerialPort():
+                self.controller.updateConnectionState(True)
+                self.controller.updateStatusText('Reconnected to the x0xb0x on ' + self.currentSerialPort + '.')
+
+    #
+    # The current serial port may be listed under another name for the
+    # same device (see SerialDiscovery.findSerialPort).  Switch to that
+    # name, and save it as the selected port.
+    #
+    def findCurrentSerialPort(self):
+        import SerialDiscovery
+
+        port = SerialDiscovery.findSerialPort(self.currentSerialPort, self.serialPorts)
+        if (port != None) and (port != self.currentSerialPort):
+            self.currentSerialPort = port
+            self.controller.SetConfigValue('serialport', port)
 
     def destroy(self):
         #
         # Clean up
         #
         self.controller = None
+        if self.portWatcher:
+            self.portWatcher.abort()
         self.closeSerialPort()
 
         
@@ -103,6 +203,8 @@ class Model:
         return val
     
     def openSerialPort(self):
+        import serial
+
         #
         # Attempt to open the serial port.  
         #
@@ -128,12 +230,14 @@ class Model:
             return False
 
     def closeSerialPort(self):
+        self.isConnected = False
         if self.serialconnection:
-            if self.worker:
-                self.worker.abort()
-                self.worker = None
-            time.sleep(1);
-            self.serialconnection.close()
+            self.stopWorker()
+            try:
+                self.serialconnection.close()
+            except Exception, e:
+                # The device may already be gone if it was unplugged.
+                print 'Exception occured while closing the serial port: ' + str(e)
             #
             # A slight special case.  If the program is closing, the GUI is already
             # gone so we cannot update any longer.  Checx to see if the controller
@@ -143,15 +247,82 @@ class Model:
                 self.controller.updateStatusText('Closed serial port ' + self.currentSerialPort)
                 self.controller.updateSerialStatus(False)
 
+    #
+    # Stop the thread that reads pushed packets, and wait for it to finish
+    # so that it is no longer using the serial port.  The worker only
+    # blocks while reading a packet, so this takes at most one packet
+    # timeout.
+    #
+    def stopWorker(self):
+        if self.worker:
+            self.worker.abort()
+            self.worker.join(DEFAULT_TIMEOUT + 0.5)
+            self.worker = None
+
     def connectSerialPort(self):
         if self.serialconnection:
-            if self.worker:
-                self.worker.abort()
-                self.worker = None
+            self.stopWorker()
             self.worker = WorkerThread(self)
+            self.isConnected = True
+            self.portLost = False
+            StartupTimer.mark(StartupTimer.STARTUP_CONNECTED)
                                        
+    #
+    # Close and reopen the serial port, check that the x0xb0x is still
+    # there, and restore the tempo, sync mode and playing pattern that it
+    # had before.  Returns true if the x0xb0x was reconnected.
+    #
+    def reconnectSerialPort(self):
+        self.closeSerialPort()
+        if not self.openSerialPort():
+            return False
+
+        if not self.runTest():
+            self.closeSerialPort()
+            self.controller.updateStatusText('Did not find x0xb0x on ' + self.currentSerialPort)
+            return False
+
+        self.restoreDeviceState()
+        self.connectSerialPort()
+        return True
+
+    def restoreDeviceState(self):
+        if self.tempo != None:
+            self.setTempo(self.tempo)
+            self.controller.updateTempo(self.tempo)
+        if self.syncMode != None:
+            self.setSync(self.syncMode)
+        if self.playingPattern != None:
+            self.playPattern(self.playingPattern)
+
+    #
+    # Probe every serial port at once for a x0xb0x.  Returns the name of a
+    # port that has a x0xb0x running its application attached (the
+    # currently selected port is preferred), or None if there isn't one.
+    #
+    def findX0xb0xPort(self):
+        import SerialDiscovery
+
+        self.controller.updateStatusText('Looking for a x0xb0x on ' + str(len(self.serialPorts)) + ' serial ports...')
+        found = SerialDiscovery.discoverX0xb0x(self.serialPorts)
+
+        if found.get(self.currentSerialPort) == SerialDiscovery.X0XB0X_APP_MODE:
+            return self.currentSerialPort
+        for name in self.serialPorts:
+            if found.get(name) == SerialDiscovery.X0XB0X_APP_MODE:
+                return name
+
+        for name in self.serialPorts:
+            if found.get(name) == SerialDiscovery.X0XB0X_BOOTLOADER_MODE:
+                self.controller.updateStatusText('Found a x0xb0x in bootload mode on ' + name + '.')
+                return None
+        self.controller.updateStatusText('Did not find x0xb0x')
+        return None
+
     def selectSerialPort(self, name):
         if name in self.serialPorts:
+            if str(name) != self.currentSerialPort:
+                self.portLost = False
             self.currentSerialPort = str(name)
             self.controller.SetConfigValue('serialport', self.currentSerialPort)
             self.controller.updateStatusText('')
@@ -164,20 +335,36 @@ class Model:
     # Parse a IHX file and upload it to the bootloader.
     #
     def uploadHexfile(self, filename):
+        import serial
+        import AvrProgram
+        import FirmwareCache
+        import FlashMetrics
+
         #
         # Meme - Add some robust error handling here.
         #
-        ihx = IntelHexFormat.IntelHexFile(filename)
+        ihx = FirmwareCache.loadFirmware(filename)
         if self.serialconnection and (AvrProgram.findAVRBoard(self.serialconnection) == True):
 
             self.controller.updateStatusText('Uploading firmware....')
+            metrics = FlashMetrics.FlashMetrics()
+            self.controller.showFlashProgress(metrics)
             try:
-                AvrProgram.doFlashProgramming(self.serialconnection, ihx.toByteString())
-                
-            except serial.SerialException, e:
-                self.controller.updateStatusText('Programming failed: ' + e.value)
+                try:
+                    AvrProgram.doFlashProgramming(self.serialconnection, ihx.toByteString(),
+                                                  verify = True, metrics = metrics)
+
+                except (AvrProgram.AVRException, serial.SerialException), e:
+                    self.controller.updateStatusText('Programming failed: ' + str(e))
+                    return
+            finally:
+                #
+                # Close the progress dialog even if programming failed.
+                #
+                if metrics.event != FlashMetrics.FINISHED:
+                    metrics.finish()
 
-            self.controller.updateStatusText('Firmware Upload Complete.')
+            self.controller.updateStatusText('Firmware Upload Complete.  ' + metrics.summary())
 
 
     def readPattern(self, bank, loc):
@@ -227,6 +414,7 @@ class Model:
             self.commlock = True
             self.dataLink.sendPlayPatternMessage(pattern)
             self.commlock = False
+            self.playingPattern = pattern
             self.controller.updateStatusText('Playing pattern')
             return True
         except BadPacketException, e:
@@ -243,6 +431,7 @@ class Model:
             self.commlock = True
             self.dataLink.sendStopPatternMessage()
             self.commlock = False
+            self.playingPattern = None
             self.controller.updateStatusText('Stopped playing pattern')
             return True
         except BadPacketException, e:
@@ -254,19 +443,100 @@ class Model:
             self.commlock = False
             return False
     
+    #
+    # Run a job that transfers one pattern at a time to or from the x0xb0x.
+    # 'action' is called with each item in 'items' in turn.  If the serial
+    # port is lost part way through (e.g. the USB cable is bumped), the job
+    # is paused until the same device reappears, then the port is
+    # reconnected and the job resumes with the item that was being
+    # transferred.  Each item is retried (or recovered) up to JOB_RETRIES
+    # times.
+    #
+    def runPatternJob(self, description, items, action):
+        if not self.isConnected:
+            raise AttributeError('Not connected')
+
+        self.jobRunning = True
+        try:
+            i = 0
+            retries = 0
+            while i < len(items):
+                try:
+                    self.commlock = True
+                    action(items[i])
+                    self.commlock = False
+                    i += 1
+                    retries = 0
+                except CommException, e:
+                    retries += 1
+                    if retries > JOB_RETRIES or not self.waitForPortRecovery(description, i, len(items)):
+                        raise
+                except BadPacketException, e:
+                    retries += 1
+                    if retries > JOB_RETRIES:
+                        raise
+                    if self.dataLink.portLost():
+                        if not self.waitForPortRecovery(description, i, len(items)):
+                            raise PortLostException(str(e))
+                        continue
+                    print 'Retrying ' + description + ' at item ' + str(i) + ': ' + str(e)
+        finally:
+            self.jobRunning = False
+            self.commlock = False
+
+    #
+    # Wait for the lost serial port to reappear and reconnect to it.
+    # Returns true if the x0xb0x was reconnected, or false if it did not
+    # come back within PORT_RECOVERY_TIMEOUT seconds.
+    #
+    def waitForPortRecovery(self, description, done, total):
+        self.commlock = False
+        self.closeSerialPort()
+        self.controller.updateStatusText('Lost the x0xb0x on ' + self.currentSerialPort + ' during ' + description +
+                                         ' (' + str(done) + '/' + str(total) + ').  Waiting for it to come back...')
+
+        deadline = time.time() + PORT_RECOVERY_TIMEOUT
+        while time.time() < deadline:
+            wx.SafeYield(None, True)
+            time.sleep(PORT_RECOVERY_POLL_INTERVAL)
+            if self.serialPortPresent() and self.reconnectSerialPort():
+                self.controller.updateStatusText('Reconnected.  Resuming ' + description + ' (' + str(done) + '/' + str(total) + ')...')
+                return True
+
+        #
+        # Give up, but let the port watcher reconnect if the device comes
+        # back later.
+        #
+        self.portLost = True
+        self.controller.updateConnectionState(False)
+        self.controller.updateStatusText('The x0xb0x on ' + self.currentSerialPort + ' did not come back.')
+        return False
+
+    def serialPortPresent(self):
+        import SerialDiscovery
+
+        if self.portWatcher:
+            return self.currentSerialPort in self.portWatcher.ports
+        return self.currentSerialPort in SerialDiscovery.listSerialPorts()
+
     def backupAllPatterns(self, toFile):
+        import PatternFile
         pf = PatternFile.PatternFile()
+
+        def readSlot(slot):
+            (bank, loc) = slot
+            pattern = self.dataLink.sendReadPatternMessage(bank - 1, loc - 1)
+            pf.appendPattern(pattern, bank, loc)
+
         try:
-            for bank in range(1, NUMBER_OF_BANKS + 1):
-                for loc in range(1, LOCATIONS_PER_BANK + 1):
-                    self.commlock = True
-                    pattern = self.dataLink.sendReadPatternMessage(bank - 1, loc - 1)
-                    pf.appendPattern(pattern, bank, loc)
+            self.runPatternJob('EEPROM download', self.allPatternSlots(), readSlot)
             pf.writeFile(toFile)
             self.controller.updateStatusText('EEPROM download was succesful.')
         except BadPacketException, e:
             self.controller.displayModalStatusError('An unexpected communication error occured while downloading patterns.  Pattern file was not saved.')
-        except AttribuetError, e:
+        except CommException, e:
+            self.controller.displayModalStatusError('The connection to the x0xb0x was lost while downloading patterns.  Pattern file was not saved.')
+        except AttributeError, e:
             self.controller.displayModalStatusError('No serial port connected.  Please select a serial port and try again.')
         except IOError, e:
             self.controller.displayModalStatusError('Error writing x0xb0x pattern file.')
@@ -275,16 +545,25 @@ class Model:
         self.commlock = False
 
     def restoreAllPatterns(self, fromFile):
+        import PatternFile
         pf = PatternFile.PatternFile()
+
+        def writeSlot(entry):
+            [bank, loc, pattern] = entry
+            if not self.dataLink.sendWritePatternMessage(pattern, bank - 1, loc - 1):
+                raise BadPacketException('The x0xb0x did not acknowledge the pattern.')
+
         try:
             pf.readFile(fromFile)
+            entries = []
             for i in range(pf.numEntries()):
-                [bank, loc, pattern] = pf.getNextPattern()
-                self.commlock = True
-                self.dataLink.sendWritePatternMessage(pattern, bank - 1, loc - 1)
+                entries.append(pf.getNextPattern())
+            self.runPatternJob('EEPROM upload', entries, writeSlot)
             self.controller.updateStatusText('EEPROM upload was succesful.')
         except BadPacketException, e:
-            self.controller.displayModalStatusError('An unexpected communication error occured while downloading patterns.  Pattern file was not saved.')
+            self.controller.displayModalStatusError('An unexpected communication error occured while uploading patterns.  Some patterns may not have been restored.')
+        except CommException, e:
+            self.controller.displayModalStatusError('The connection to the x0xb0x was lost while uploading patterns.  Some patterns may not have been restored.')
         except AttributeError, e:
             self.controller.displayModalStatusError('No serial port connected.  Please select a serial port and try again.')
         except IOError, e:
@@ -294,18 +573,32 @@ class Model:
         self.commlock = False
                             
     def eraseAllPatterns(self):
+        def eraseSlot(slot):
+            (bank, loc) = slot
+            if not self.dataLink.sendWritePatternMessage(Pattern(), bank - 1, loc - 1):
+                raise BadPacketException('The x0xb0x did not acknowledge the pattern.')
+
         try:
-            for bank in range(1, NUMBER_OF_BANKS + 1):
-                for loc in range(1, LOCATIONS_PER_BANK + 1):
-                    self.commlock = True
-                    self.dataLink.sendWritePatternMessage(Pattern(), bank - 1, loc - 1)
+            self.runPatternJob('EEPROM erase', self.allPatternSlots(), eraseSlot)
             self.controller.updateStatusText('EEPROM successfully erased.')
         except BadPacketException, e:
-            self.controller.displayModalStatusError('An unexpected communication error occured while downloading patterns.  Pattern file was not saved.')
+            self.controller.displayModalStatusError('An unexpected communication error occured while erasing patterns.')
+        except CommException, e:
+            self.controller.displayModalStatusError('The connection to the x0xb0x was lost while erasing patterns.')
         except AttributeError, e:
             self.controller.displayModalStatusError('No serial port connected.  Please select a serial port and try again.')
         self.commlock = False
 
+    #
+    # Returns a list of every (bank, loc) pair, numbered from 1.
+    #
+    def allPatternSlots(self):
+        slots = []
+        for bank in range(1, NUMBER_OF_BANKS + 1):
+            for loc in range(1, LOCATIONS_PER_BANK + 1):
+                slots.append((bank, loc))
+        return slots
+
     def sendToggleSequencerMessage(self):
         self.commlock = True
         self.dataLink.sendRunStop()
@@ -316,6 +609,7 @@ class Model:
         try:
             tempo = self.dataLink.sendGetTempoPacket()
             self.commlock = False
+            self.tempo = tempo
             self.controller.updateTempo(tempo)
             return True
         except BadPacketException, e:
@@ -333,6 +627,7 @@ class Model:
         try:
             self.dataLink.sendSetTempoPacket(tempo)
             self.commlock = False
+            self.tempo = tempo
             return True
         except BadPacketException, e:
             self.controller.updateStatusText('Packet error occured: ' + str(e))
@@ -343,6 +638,25 @@ class Model:
             self.commlock = False
             return False
         
+    #
+    # Set the sync source to one of the SYNC_* constants in Globals.py.
+    #
+    def setSync(self, source):
+        self.commlock = True
+        try:
+            self.dataLink.sendSetSyncPacket(source)
+            self.commlock = False
+            self.syncMode = source
+            return True
+        except BadPacketException, e:
+            self.controller.updateStatusText('Packet error occured: ' + str(e))
+            self.commlock = False
+            return False
+        except AttributeError, e:
+            self.controller.updateStatusText('Error: Not connected.  Please choose a serial port from the Serial menu.')
+            self.commlock = False
+            return False
+
     def serialPortBusy(self):
         return self.commlock
     
@@ -358,7 +672,30 @@ class Model:
         if (packet.messageType() == TEMPO_MSG):
             tempo = (ord(a2b_hex(packet.contentList[0]))<< 8) + ord(a2b_hex(packet.contentList[1]))
             #print 'tempo = '+str(tempo)
-            self.controller.updateTempo(tempo)
+            self.tempo = tempo
+            self.pushedData.PostNotification(tempo, TEMPO_MSG)
+
+    #
+    # Called on the worker thread when the pushed data queue stops being
+    # empty.
+    #
+    def pushedDataWaiting(self):
+        if self.controller != None:
+            wx.CallAfter(self.pushedData.DispatchPending)
+
+    #
+    # The pushed data, delivered on the GUI thread.
+    #
+    def NotificationBatchCallback(self, notifications):
+        #
+        # Deliveries that were queued before the model was destroyed may
+        # still arrive.
+        #
+        if self.controller == None:
+            return
+        for (key, data) in notifications:
+            if key == TEMPO_MSG:
+                self.controller.updateTempo(data)
         
 class WorkerThread(Thread):
     def __init__(self, model):
@@ -376,12 +713,20 @@ class WorkerThread(Thread):
         while True:
             if (not self._model.serialPortBusy()):
                 #print '.'
-                v = self._model.packetWaiting()
-                if (v != 0):
-                    #print '!'+str(v)
-                    self._model.processPushedPacket()
-                else:
-                    time.sleep(.1)
+                try:
+                    v = self._model.packetWaiting()
+                    if (v != 0):
+                        #print '!'+str(v)
+                        self._model.processPushedPacket()
+                    else:
+                        time.sleep(.1)
+                except CommException, e:
+                    #
+                    # The serial port has gone away.  The port watcher or
+                    # a running pattern job takes care of reconnecting.
+                    #
+                    print 'Worker thread exiting: ' + str(e)
+                    return
                 
             if self._want_abort:
                 #wxPostEvent(self._notify_window,ResultEvent(None))
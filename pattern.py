@@ -1,4 +1,5 @@
 from Globals import *
+import weakref
 
 NOTE_MASK = 0x3F
 SLIDE_MASK = 0x80
@@ -11,156 +12,400 @@ C4 = 0x2F
 REST_NOTE = 0x00
 NULL_NOTE = 0xFF
 
-class Pattern:
+#
+# Makes rest bytes canonical: a note number of zero is a rest, whatever its
+# accent and slide bits say.  Used with bytearray.translate().
+#
+REST_TABLE = ''.join([chr(0) if (i & NOTE_MASK) == REST_NOTE else chr(i) for i in range(256)])
 
-    def appendNote(self, noteNum, accent, slide, transpose):
-        note = Note()
-        note.parseNoteArgs(noteNum, accent, slide, transpose)
-        self.notes.append(note)
-
-    def shift(self, shiftamt):
-        while (shiftamt != 0):
-            if (shiftamt > 0):
-                tempnote = self.notes[0]
-                for i in range( 0, self.length() - 1 ):
-                    self.notes[i] = self.notes[i+1]
-                self.notes[self.length()-1] = tempnote
-                shiftamt-=1
-            if (shiftamt < 0):
-                tempnote = self.notes[self.length() - 1]
-                for i in range(1, self.length() ):
-                    self.notes[self.length()-i] = self.notes[self.length()-1-i]
-                self.notes[0] = tempnote
-                shiftamt+=1
+#
+# A pattern is kept the way the x0xb0x keeps it: NOTES_IN_PATTERN note
+# bytes, ended by NULL_NOTE if the pattern is shorter, in a bytearray.
+# The notes are only decoded when they are looked at (see NoteView), so
+# patterns are cheap to create, copy and store in large numbers.
+#
+# The bytes are kept canonical: rests are always 0x00 and the slots after
+# the end of the pattern are always NULL_NOTE.  So two patterns are equal
+# if their bytes are.
+#
+# A pattern can be frozen (see freeze() and internPattern()), after which
+# every attempt to change it raises PatternException; copy() returns a
+# pattern that can be changed again.  Only frozen patterns can be
+# hashed, so only they can be dictionary keys.
+#
+class Pattern(object):
+    __slots__ = ('data', 'size', 'frozen', '__weakref__')
 
+    def __eq__(self, other):
+        if not isinstance(other, Pattern):
+            return NotImplemented
+        return self.data == other.data
+
+    def __ne__(self, other):
+        if not isinstance(other, Pattern):
+            return NotImplemented
+        return self.data != other.data
+
+    def __hash__(self):
+        if not self.frozen:
+            raise TypeError('only frozen patterns can be hashed')
+        return hash(str(self.data))
+
+    def freeze(self):
+        self.frozen = True
+        return self
+
+    def checkNotFrozen(self):
+        if self.frozen:
+            raise PatternException("Attempted to change a frozen pattern")
+
+    def appendNote(self, noteNum, accent, slide, transpose):
+        self.checkNotFrozen()
+        if self.size >= NOTES_IN_PATTERN:
+            raise PatternException("Attempted to add a note to a full pattern")
+        self.data[self.size] = ENCODE_TABLE.get((noteNum, accent, slide, transpose), REST_NOTE)
+        self.size += 1
 
-        
     #
     # Init with a pattern
     #
     def __init__(self, pstring = ''):
+        self.frozen = False
+        self.setBytes(bytearray(pstring[0:NOTES_IN_PATTERN]))
 
-        self.notes = []
-        
-        for i in range( len(pstring) ):
-            if ord(pstring[i]) == NULL_NOTE:
-                break
-            else:
-                note = Note()
-                note.parseNoteByte( pstring[i] )
-                self.notes.append( note )
+    #
+    # Make a pattern from its bytes.  If 'data' is a bytearray of
+    # NOTES_IN_PATTERN bytes and 'copy' is False, the pattern uses (and
+    # normalizes) that bytearray rather than a copy of it.
+    #
+    @classmethod
+    def fromByteString(cls, data, copy = True):
+        pattern = cls.__new__(cls)
+        pattern.frozen = False
+        if copy or not isinstance(data, bytearray) or len(data) != NOTES_IN_PATTERN:
+            data = bytearray(data[0:NOTES_IN_PATTERN])
+        pattern.setBytes(data)
+        return pattern
+
+    def setBytes(self, data):
+        self.checkNotFrozen()
+        size = data.find(chr(NULL_NOTE))
+        if size < 0:
+            size = len(data)
+        if len(data) < NOTES_IN_PATTERN:
+            data.extend(chr(NULL_NOTE) * (NOTES_IN_PATTERN - len(data)))
+        data[size:NOTES_IN_PATTERN] = chr(NULL_NOTE) * (NOTES_IN_PATTERN - size)
+        data[0:size] = data[0:size].translate(REST_TABLE)
+        self.data = data
+        self.size = size
 
     def note(self, note):
-        if note < self.length:
-            return self.notes[note]
+        if note < self.size:
+            return NoteView(self, note)
         else:
             raise PatternException("Attempted to access a note number greater than current pattern size")
 
+    def notes(self):
+        return [NoteView(self, i) for i in range(self.size)]
+
     def toByteString(self):
-        pstring = ''
-        for i in range( NOTES_IN_PATTERN ):
-            if i < len(self.notes):
-                pstring = pstring + self.notes[i].toByte()
-            else:
-                pstring = pstring + chr(NULL_NOTE)
-        return pstring
+        return str(self.data)
+
+    #
+    # The bytes of the pattern without copying them.
+    #
+    def toBuffer(self):
+        return buffer(self.data)
+
+    def copy(self):
+        return Pattern.fromByteString(self.data)
 
     def length(self):
-        return len(self.notes)
+        return self.size
+
+    #
+    # Transforms.  Each one works on the notes from 'start' up to (not
+    # including) 'end', by default the whole pattern, and changes the
+    # pattern in place.
+    #
+    def _range(self, start, end):
+        if end == None or end > self.size:
+            end = self.size
+        if start < 0:
+            start = 0
+        return (start, end)
+
+    #
+    # Rotate the notes by 'amount' steps: later if it is positive,
+    # earlier if it is negative.  Notes that fall off one end come back
+    # in at the other.
+    #
+    def rotate(self, amount, start = 0, end = None):
+        self.checkNotFrozen()
+        (start, end) = self._range(start, end)
+        n = end - start
+        if n <= 0:
+            return
+        k = (n - amount) % n + start
+        self.data[start:end] = self.data[k:end] + self.data[start:k]
+
+    def reverse(self, start = 0, end = None):
+        self.checkNotFrozen()
+        (start, end) = self._range(start, end)
+        self.data[start:end] = self.data[start:end][::-1]
+
+    #
+    # Transpose the notes by 'semitones'.  The transpose flags are
+    # changed along with the notes; notes that would go past the
+    # lowest or highest note the x0xb0x can play are folded back by
+    # octaves.
+    #
+    def transpose(self, semitones, start = 0, end = None):
+        self.checkNotFrozen()
+        (start, end) = self._range(start, end)
+        self.data[start:end] = self.data[start:end].translate(transposeTable(semitones))
+
+    #
+    # Accent and slide masks have bit i set if note i has the accent (or
+    # slide).  Rests never have either.
+    #
+    def flagMask(self, flag):
+        mask = 0
+        for i in range(self.size):
+            if self.data[i] & flag:
+                mask |= (1 << i)
+        return mask
+
+    def setFlagMask(self, flag, mask, start = 0, end = None):
+        self.checkNotFrozen()
+        (start, end) = self._range(start, end)
+        data = self.data
+        for i in range(start, end):
+            if data[i] != REST_NOTE:
+                if mask & (1 << i):
+                    data[i] |= flag
+                else:
+                    data[i] &= ~flag
+
+    def accentMask(self):
+        return self.flagMask(ACCENT_MASK)
+
+    def setAccentMask(self, mask, start = 0, end = None):
+        self.setFlagMask(ACCENT_MASK, mask, start, end)
+
+    def slideMask(self):
+        return self.flagMask(SLIDE_MASK)
+
+    def setSlideMask(self, mask, start = 0, end = None):
+        self.setFlagMask(SLIDE_MASK, mask, start, end)
 
 
     def printMe(self):
         print '---> Pattern '
-        for i in range(len(self.notes)):
-            patstr = str(self.notes[i].note)
+        for note in self.notes():
+            patstr = str(note.note)
             efxstr = '        '
-            if self.notes[i].accent:
+            if note.accent:
                 efxstr += 'A '
-            if self.notes[i].slide:
+            if note.slide:
                 efxstr += 'S '
-            if self.notes[i].transpose == TRANSPOSE_DOUBLE_UP:
+            if note.transpose == TRANSPOSE_DOUBLE_UP:
                 efxstr += 'UU'
-            if self.notes[i].transpose == TRANSPOSE_UP:
+            if note.transpose == TRANSPOSE_UP:
                 efxstr += 'U '
-            if self.notes[i].transpose == TRANSPOSE_DOWN:
+            if note.transpose == TRANSPOSE_DOWN:
                 efxstr += 'D '
             print patstr + efxstr
         print '---->'
         
 
 #
-# Note object
-#
-# All notes are initialized as rests.
+# Patterns that are the same share one Pattern object through this pool,
+# so that the many copies of a pattern in banks, dumps and pattern files
+# are only held once.  A pattern stays in the pool while it is in use.
+# Interned patterns are frozen, since a change to one would change every
+# place it is used.  'pattern' must not share its bytearray with
+# anything else (see Pattern.fromByteString).
 #
-class Note:
+_internedPatterns = weakref.WeakValueDictionary()
 
-    def __init__(self):
-        self.setToRest()
+def internPattern(pattern):
+    key = str(pattern.data)
+    interned = _internedPatterns.get(key)
+    if interned is None:
+        _internedPatterns[key] = interned = pattern.freeze()
+    return interned
 
-    def setToRest(self):
-        self.note = REST_NOTE
-        self.accent = False
-        self.slide = False
-        self.transpose = TRANSPOSE_NONE
 
-    def parseNoteByte(self, byteNote):
+#
+# Note byte codec.  Every note byte decodes to a (note number, accent,
+# slide, transpose) tuple, so decoding is a lookup in a 256 entry table.
+# The byte for each playable note is in a dictionary keyed the same way.
+# Both tables are built once, when the module is imported.
+#
+def _decodeNoteByte(byte):
+    rawNote = byte & NOTE_MASK
+    if rawNote == REST_NOTE:
+        return (REST_NOTE, False, False, TRANSPOSE_NONE)
+
+    accent = (byte & ACCENT_MASK) != 0
+    slide = (byte & SLIDE_MASK) != 0
+    if (rawNote > C4):
+        return (rawNote - 24, accent, slide, TRANSPOSE_DOUBLE_UP)
+    elif (rawNote > C3):
+        return (rawNote - 12, accent, slide, TRANSPOSE_UP)
+    elif (rawNote < C2):
+        return (rawNote + 12, accent, slide, TRANSPOSE_DOWN)
+    return (rawNote, accent, slide, TRANSPOSE_NONE)
+
+def _encodeTable():
+    table = {}
+    offsets = {TRANSPOSE_DOUBLE_UP: 24, TRANSPOSE_UP: 12, TRANSPOSE_DOWN: -12, TRANSPOSE_NONE: 0}
+    for noteNum in range(BOTTOM_NOTE, TOP_NOTE + 1):
+        for (transpose, offset) in offsets.items():
+            for accent in (False, True):
+                for slide in (False, True):
+                    rawnote = noteNum + offset
+                    if accent:
+                        rawnote |= ACCENT_MASK
+                    if slide:
+                        rawnote |= SLIDE_MASK
+                    table[(noteNum, accent, slide, transpose)] = rawnote
+    return table
+
+DECODE_TABLE = [_decodeNoteByte(byte) for byte in range(256)]
+ENCODE_TABLE = _encodeTable()
 
-        self.accent = not ((ord(byteNote) & ACCENT_MASK) == 0)
-        self.slide = not ((ord(byteNote) & SLIDE_MASK) == 0)
-        rawNote = ord(byteNote) & NOTE_MASK
+#
+# Returns the note byte for a note number, accent, slide and transpose.
+# Anything that is not a playable note is a rest.
+#
+def noteByte(noteNum, accent, slide, transpose):
+    return ENCODE_TABLE.get((noteNum, accent, slide, transpose), REST_NOTE)
 
-        if rawNote == REST_NOTE:
-            self.setToRest()
-            return self
+#
+# Returns the (note number, accent, slide, transpose) of a note byte.
+#
+def parseNoteByte(byte):
+    return DECODE_TABLE[byte]
 
-        # Otherwise, this isn't a rest note:
-        
-        if (rawNote > C4):
-            self.transpose = TRANSPOSE_DOUBLE_UP
-            rawNote = rawNote - 24
-        elif (rawNote > C3):
-            self.transpose = TRANSPOSE_UP
-            rawNote = rawNote - 12
-        elif (rawNote < C2):
-            self.transpose = TRANSPOSE_DOWN
-            rawNote = rawNote + 12
-        else:
-            self.transpose = TRANSPOSE_NONE
+#
+# Returns the name of a note number (see MIDI_Dict), or '' for a rest or
+# an unknown note.
+#
+def noteName(noteNum):
+    return MIDI_Names.get(noteNum, '')
 
-        self.note = rawNote
 
-    def parseNoteArgs(self, noteNum, accent, slide, transpose):
-        if (noteNum < BOTTOM_NOTE) or (noteNum > TOP_NOTE) or (noteNum == REST_NOTE):
-            self.setToRest()
-            return self
+#
+# The note bytes (without the accent and slide bits) of the lowest and
+# highest notes the x0xb0x can play, i.e. the bottom note transposed
+# down and the top note transposed up twice.  Within this range a note
+# byte is simply the pitch, so transposing is adding to it.
+#
+LOWEST_PITCH = BOTTOM_NOTE - 12
+HIGHEST_PITCH = TOP_NOTE + 24
 
-        self.note = noteNum
-        self.accent = accent
-        self.slide = slide
-        self.transpose = transpose
+_transposeTables = {}
 
-    def toByte(self):        
+#
+# Returns the translate table that transposes note bytes by 'semitones'
+# (see Pattern.transpose()).  Rests and NULL_NOTE are left alone.
+#
+def transposeTable(semitones):
+    table = _transposeTables.get(semitones)
+    if table != None:
+        return table
+
+    table = []
+    for byte in range(256):
+        pitch = byte & NOTE_MASK
+        if pitch == REST_NOTE or byte == NULL_NOTE:
+            table.append(chr(byte))
+            continue
+        pitch += semitones
+        while pitch < LOWEST_PITCH:
+            pitch += 12
+        while pitch > HIGHEST_PITCH:
+            pitch -= 12
+        table.append(chr((byte & ~NOTE_MASK) | pitch))
+    table = _transposeTables[semitones] = ''.join(table)
+    return table
 
-        if self.transpose == TRANSPOSE_DOUBLE_UP:
-            rawnote = self.note + 24
+#
+# Apply one of the Pattern transforms to many patterns, e.g.
+#
+#     transformPatterns(patterns, Pattern.transpose, 5)
+#
+# A pattern that is in the list more than once is only transformed once.
+#
+def transformPatterns(patterns, transform, *args):
+    done = set()
+    for pattern in patterns:
+        if id(pattern) not in done:
+            done.add(id(pattern))
+            transform(pattern, *args)
 
-        elif self.transpose == TRANSPOSE_UP:
-            rawnote = self.note + 12
 
-        elif self.transpose == TRANSPOSE_DOWN:
-            rawnote = self.note - 12
+#
+# A view of one note of a pattern.  The note is decoded from the
+# pattern's bytes when it is looked at, and setting any of its
+# attributes writes the byte straight back.
+#
+class NoteView(object):
+    __slots__ = ('pattern', 'index')
 
-        else:
-            rawnote = self.note
+    def __init__(self, pattern, index):
+        self.pattern = pattern
+        self.index = index
 
-        if self.accent:
-            rawnote |= ACCENT_MASK
+    def parse(self):
+        return DECODE_TABLE[self.pattern.data[self.index]]
 
-        if self.slide:
-            rawnote |= SLIDE_MASK
+    def set(self, noteNum, accent, slide, transpose):
+        self.pattern.checkNotFrozen()
+        self.pattern.data[self.index] = ENCODE_TABLE.get((noteNum, accent, slide, transpose), REST_NOTE)
 
-        return chr(rawnote)
+    def setToRest(self):
+        self.pattern.checkNotFrozen()
+        self.pattern.data[self.index] = REST_NOTE
+
+    def isRest(self):
+        return self.pattern.data[self.index] == REST_NOTE
+
+    def toByte(self):
+        return chr(self.pattern.data[self.index])
+
+    def name(self):
+        return noteName(self.note)
+
+    def _getNote(self):
+        return self.parse()[0]
+    def _setNote(self, noteNum):
+        (note, accent, slide, transpose) = self.parse()
+        self.set(noteNum, accent, slide, transpose)
+    note = property(_getNote, _setNote)
+
+    def _getAccent(self):
+        return self.parse()[1]
+    def _setAccent(self, accent):
+        (note, oldAccent, slide, transpose) = self.parse()
+        self.set(note, accent, slide, transpose)
+    accent = property(_getAccent, _setAccent)
+
+    def _getSlide(self):
+        return self.parse()[2]
+    def _setSlide(self, slide):
+        (note, accent, oldSlide, transpose) = self.parse()
+        self.set(note, accent, slide, transpose)
+    slide = property(_getSlide, _setSlide)
+
+    def _getTranspose(self):
+        return self.parse()[3]
+    def _setTranspose(self, transpose):
+        (note, accent, slide, oldTranspose) = self.parse()
+        self.set(note, accent, slide, transpose)
+    transpose = property(_getTranspose, _setTranspose)
 
 
 
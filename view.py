@@ -39,6 +39,26 @@ class View:
         except Exception, e:
             print 'Exception occured: ' + str(e)
             
+    #
+    # True means a x0xb0x is connected and the controls that talk to it
+    # should be enabled, false if it is not.
+    #
+    def updateConnectionState(self, state):
+        if state == True:
+            self.mainWindow.x0xb0xEnable()
+        else:
+            self.mainWindow.x0xb0xDisable()
+
+    #
+    # Show the progress of a firmware upload that reports to 'metrics'.
+    #
+    def showFlashProgress(self, metrics):
+        #
+        # Keep the dialog's listener alive, the metrics only hold a weak
+        # reference to it.
+        #
+        self.flashProgress = FlashProgressDialog(self.mainWindow, metrics)
+
     def updateSelectedSerialPort(self, name):
         menuId = self.mainWindow.portMenu.FindItem(name)
         if menuId != wx.NOT_FOUND: